@@ -3,5 +3,6 @@ echo "Creating Cassandra keyspace ${RAW_KEYSPACE}"
 python3 /usr/local/bin/create_keyspace.py \
     -d ${CASSANDRA_HOST} \
     -k ${RAW_KEYSPACE} \
-    -s /opt/graphsense/schema.cql
+    -s ${RAW_SCHEMA:-/opt/graphsense/schema.cql} \
+    ${RAW_TABLE_PROFILE:+-p ${RAW_TABLE_PROFILE}}
 exec "$@"
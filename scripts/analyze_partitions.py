@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Estimate the Cassandra partition sizes of the tables written by
+blocksci_export.py and recommend bucket sizes and the tx prefix length.
+
+Rows are built with the table builders of the export for windows of
+consecutive blocks, sampled evenly across the chain or covering all of it,
+and their serialized size is estimated as in the export metrics. Bucket
+sizes apply to the whole keyspace, so they are chosen for the heaviest
+window; the tables partitioned by a hash prefix (the tx lookup table and
+the address index) are sized for the projected number of txs, as their
+partitions keep growing with the chain.
+'''
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import json
+
+import numpy as np
+import blocksci
+
+from blocksci_export import (ADDRESS_PREFIX_LENGTH, BLOCK_BUCKET_SIZE,
+                             TX_BUCKET_SIZE, TX_HASH_PREFIX_LENGTH,
+                             address_tx_summaries, block_summaries,
+                             block_tx_summaries, configure_caches, row_size,
+                             tx_io_summaries, tx_short_summary, tx_summary)
+
+
+BLOCK_BUCKET_SIZES = (10, 20, 50, 100, 200, 500, 1_000)
+TX_BUCKET_SIZES = (1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000)
+TX_PREFIX_LENGTHS = (3, 4, 5, 6, 7, 8)
+ADDRESS_PREFIX_LENGTHS = (2, 3, 4, 5, 6)
+
+
+def sample_windows(num_blocks, window_size, num_windows=None):
+    '''Return (start, end) block ranges of windows evenly spread across the
+    chain; all of it without num_windows.
+
+    >>> sample_windows(1_000, 10, 3)
+    [(0, 10), (495, 505), (990, 1000)]
+
+    >>> sample_windows(25, 10)
+    [(0, 10), (10, 20), (20, 25)]
+    '''
+
+    if num_windows is None or num_windows * window_size >= num_blocks:
+        return [(start, min(start + window_size, num_blocks))
+                for start in range(0, num_blocks, window_size)]
+    starts = np.unique(np.linspace(0, num_blocks - window_size,
+                                   num_windows).astype(int))
+    return [(int(start), int(start) + window_size) for start in starts]
+
+
+def init_worker(config_file, cache_size):
+    global CHAIN
+    CHAIN = blocksci.Blockchain(config_file)
+    configure_caches(cache_size)
+
+
+def window_stats(window):
+    '''Return row counts and estimated bytes per table of a block window.'''
+
+    (start, end) = window
+    block_range = CHAIN[start:end]
+    tx_bytes = 0
+    lookup_bytes = 0
+    address_tx_bytes = 0
+    num_txs = 0
+    num_address_txs = 0
+    for tx in block_range.txes:
+        ios = tx_io_summaries(tx)
+        tx_bytes += row_size(tx_summary(tx, deferred_coinjoin=True, ios=ios))
+        lookup_bytes += row_size(tx_short_summary(tx.hash, tx.index))
+        address_rows = address_tx_summaries(tx.index, *ios)
+        address_tx_bytes += sum(row_size(x) for x in address_rows)
+        num_txs += 1
+        num_address_txs += len(address_rows)
+    return {'start': start,
+            'end': end,
+            'blocks': end - start,
+            'txs': num_txs,
+            'address_txs': num_address_txs,
+            'block_bytes': sum(row_size(x)
+                               for x in block_summaries(block_range)),
+            'block_tx_bytes': sum(row_size(x)
+                                  for x in block_tx_summaries(block_range)),
+            'tx_bytes': tx_bytes,
+            # the lookup and address rows without their hex prefix
+            'lookup_bytes': lookup_bytes - num_txs * TX_HASH_PREFIX_LENGTH,
+            'address_tx_bytes': (address_tx_bytes -
+                                 num_address_txs * ADDRESS_PREFIX_LENGTH)}
+
+
+def bucket_estimates(windows, rows_key, bytes_key, bucket_sizes):
+    '''Return the estimated rows and bytes per partition for each bucket
+    size, as (median, max) over the windows.
+
+    >>> windows = [{'blocks': 10, 'block_bytes': 1_000},
+    ...            {'blocks': 10, 'block_bytes': 3_000}]
+    >>> bucket_estimates(windows, 'blocks', 'block_bytes', (100,))
+    [{'bucket_size': 100, 'rows': 100, 'median_bytes': 20000.0, \
+'max_bytes': 30000.0}]
+    '''
+
+    bytes_per_row = np.array([x[bytes_key] / x[rows_key]
+                              for x in windows if x[rows_key]])
+    return [{'bucket_size': size,
+             'rows': size,
+             'median_bytes': float(np.median(bytes_per_row) * size),
+             'max_bytes': float(bytes_per_row.max() * size)}
+            for size in bucket_sizes]
+
+
+def prefix_estimates(windows, rows_key, bytes_key, projected_txs,
+                     prefix_lengths):
+    '''Return the estimated rows and bytes per partition of a table
+    partitioned by a hex hash prefix for each prefix length; hashes are
+    uniformly distributed. Rows per tx are taken from the windows.
+
+    >>> prefix_estimates([{'txs': 10, 'lookup_bytes': 400}], 'txs',
+    ...                  'lookup_bytes', 16 ** 4, (4,))
+    [{'prefix_length': 4, 'rows': 1.0, 'median_bytes': 44.0, \
+'max_bytes': 44.0}]
+    '''
+
+    txs = sum(x['txs'] for x in windows)
+    num_rows = sum(x[rows_key] for x in windows)
+    bytes_per_row = sum(x[bytes_key] for x in windows) / max(num_rows, 1)
+    estimates = []
+    for length in prefix_lengths:
+        rows = projected_txs * num_rows / txs / 16 ** length
+        size = rows * (bytes_per_row + length)
+        estimates.append({'prefix_length': length, 'rows': rows,
+                          'median_bytes': size, 'max_bytes': size})
+    return estimates
+
+
+def recommend(estimates, key, target_bytes, largest=True):
+    '''Return the largest (or smallest) parameter whose estimated maximum
+    partition size stays within target_bytes, else the best available.
+
+    >>> estimates = [{'bucket_size': 10, 'max_bytes': 5},
+    ...              {'bucket_size': 100, 'max_bytes': 50}]
+    >>> recommend(estimates, 'bucket_size', 20)
+    10
+    >>> recommend(estimates, 'bucket_size', 1)
+    10
+    '''
+
+    fitting = [x[key] for x in estimates if x['max_bytes'] <= target_bytes]
+    if not fitting:
+        return min(estimates, key=lambda x: x['max_bytes'])[key]
+    return max(fitting) if largest else min(fitting)
+
+
+def print_estimates(table, estimates, key, current, recommended):
+    print(f'{table}')
+    print(f'  {key:>14} {"rows":>12} {"median MB":>10} {"max MB":>10}')
+    for x in estimates:
+        marks = ''.join(mark for (value, mark) in
+                        ((current, ' current'), (recommended, ' recommended'))
+                        if value == x[key])
+        print(f'  {x[key]:>14,} {x["rows"]:>12,.0f} '
+              f'{x["median_bytes"] / 1e6:>10.2f} '
+              f'{x["max_bytes"] / 1e6:>10.2f}{marks}')
+
+
+def create_parser():
+    parser = ArgumentParser(description='Estimate partition sizes of the '
+                                        'exported tables and recommend '
+                                        'bucket sizes',
+                            epilog='GraphSense - http://graphsense.info')
+    parser.add_argument('-c', '--config', dest='blocksci_config',
+                        required=True,
+                        help='BlockSci configuration file')
+    parser.add_argument('--windows', dest='num_windows', type=int,
+                        default=100,
+                        help='number of sampled block windows (default 100)')
+    parser.add_argument('--window-size', type=int, default=10,
+                        help='number of consecutive blocks per window '
+                             '(default 10)')
+    parser.add_argument('--full', action='store_true',
+                        help='walk the whole chain instead of sampling')
+    parser.add_argument('--target-partition-mb', type=float, default=10,
+                        help='maximum estimated partition size '
+                             '(default 10 MB)')
+    parser.add_argument('--growth', type=float, default=2.0,
+                        help='projected growth factor of the number of txs, '
+                             'for sizing the tables partitioned by a hash '
+                             'prefix (default 2.0)')
+    parser.add_argument('--processes', dest='num_proc', type=int, default=1,
+                        help='number of processes (default 1)')
+    parser.add_argument('--cache-size', type=int, default=250_000,
+                        help='size of the address and output caches per '
+                             'process (default 250000)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write window statistics, estimates and '
+                             'recommendations as JSON')
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+
+    chain = blocksci.Blockchain(args.blocksci_config)
+    windows = sample_windows(len(chain), args.window_size,
+                             None if args.full else args.num_windows)
+    print(f'Analyzing {sum(y - x for (x, y) in windows):,} of '
+          f'{len(chain):,} blocks in {len(windows):,} windows')
+
+    with Pool(args.num_proc, initializer=init_worker,
+              initargs=(args.blocksci_config, args.cache_size)) as pool:
+        stats = pool.map(window_stats, windows)
+
+    total_txs = chain[-1].txes[-1].index + 1
+    target_bytes = args.target_partition_mb * 1e6
+    estimates = {
+        'block': bucket_estimates(stats, 'blocks', 'block_bytes',
+                                  BLOCK_BUCKET_SIZES),
+        'block_transactions': bucket_estimates(stats, 'blocks',
+                                               'block_tx_bytes',
+                                               BLOCK_BUCKET_SIZES),
+        'transaction': bucket_estimates(stats, 'txs', 'tx_bytes',
+                                        TX_BUCKET_SIZES),
+        'transaction_by_tx_prefix': prefix_estimates(
+            stats, 'txs', 'lookup_bytes', total_txs * args.growth,
+            TX_PREFIX_LENGTHS),
+        'address_transactions': prefix_estimates(
+            stats, 'address_txs', 'address_tx_bytes',
+            total_txs * args.growth, ADDRESS_PREFIX_LENGTHS)
+    }
+    # both block tables share block_id_group
+    block_estimates = [max(x, y, key=lambda z: z['max_bytes'])
+                       for (x, y) in zip(estimates['block'],
+                                         estimates['block_transactions'])]
+    recommended = {
+        'block_bucket_size': recommend(block_estimates, 'bucket_size',
+                                       target_bytes),
+        'tx_bucket_size': recommend(estimates['transaction'], 'bucket_size',
+                                    target_bytes),
+        'tx_prefix_length': recommend(
+            estimates['transaction_by_tx_prefix'], 'prefix_length',
+            target_bytes, largest=False),
+        'address_prefix_length': recommend(
+            estimates['address_transactions'], 'prefix_length',
+            target_bytes, largest=False)
+    }
+
+    print(f'Estimated partition sizes ({total_txs:,} txs, lookup table and '
+          f'address index projected to {total_txs * args.growth:,.0f} txs)')
+    for table in ('block', 'block_transactions'):
+        print_estimates(table, estimates[table], 'bucket_size',
+                        BLOCK_BUCKET_SIZE, recommended['block_bucket_size'])
+    print_estimates('transaction', estimates['transaction'], 'bucket_size',
+                    TX_BUCKET_SIZE, recommended['tx_bucket_size'])
+    print_estimates('transaction_by_tx_prefix',
+                    estimates['transaction_by_tx_prefix'], 'prefix_length',
+                    TX_HASH_PREFIX_LENGTH, recommended['tx_prefix_length'])
+    print_estimates('address_transactions',
+                    estimates['address_transactions'], 'prefix_length',
+                    ADDRESS_PREFIX_LENGTH,
+                    recommended['address_prefix_length'])
+    print('Recommended export arguments for a new keyspace:')
+    print(f'    --block-bucket-size {recommended["block_bucket_size"]} '
+          f'--tx-bucket-size {recommended["tx_bucket_size"]} '
+          f'--tx-prefix-length {recommended["tx_prefix_length"]} '
+          f'--address-prefix-length '
+          f'{recommended["address_prefix_length"]}')
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'config': vars(args), 'windows': stats,
+                       'estimates': estimates, 'recommended': recommended},
+                      fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
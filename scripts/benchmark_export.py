@@ -0,0 +1,914 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Benchmark the table builders of blocksci_export.py on a synthetic chain.
+
+The chain is generated from configurable tx, input and output distributions
+and exposes the part of the BlockSci API used by the export; rows are
+written to an in-process Cassandra stand-in with configurable latency and
+failure injection, or to the file sinks. Every stage runs in a process of
+its own, so that wall time, CPU time and peak RSS are measured per stage.
+'''
+
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime as dt
+from functools import partial
+from multiprocessing import Pipe, Process
+import enum
+import hashlib
+import heapq
+import importlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from cassandra import OperationTimedOut
+import numpy as np
+
+from tx_io_codec import b58check_encode, segwit_encode
+
+
+STAGES = ('tx', 'tx+block_tx', 'tx+address_tx', 'address_tx', 'block_tx',
+          'coinjoin', 'block', 'aggregates')
+DEFAULT_STAGES = ('tx', 'block_tx', 'coinjoin', 'block')
+
+
+class address_type(enum.Enum):
+    '''BlockSci address types, with the same names and repr.'''
+
+    nonstandard = 1
+    pubkey = 2
+    pubkeyhash = 3
+    multisig_pubkey = 4
+    scripthash = 5
+    multisig = 6
+    nulldata = 7
+    witness_pubkeyhash = 8
+    witness_scripthash = 9
+    witness_unknown = 10
+
+    def __repr__(self):
+        return 'address_type.' + self.name
+
+
+# share of output address types, roughly following recent Bitcoin blocks
+ADDRESS_TYPE_WEIGHTS = {
+    address_type.pubkeyhash: 0.40,
+    address_type.witness_pubkeyhash: 0.30,
+    address_type.scripthash: 0.15,
+    address_type.witness_scripthash: 0.05,
+    address_type.multisig: 0.03,
+    address_type.pubkey: 0.02,
+    address_type.nulldata: 0.03,
+    address_type.nonstandard: 0.015,
+    address_type.witness_unknown: 0.005
+}
+
+ADDRESS_TYPES = list(address_type)
+
+
+class Hash:
+    '''Block or tx hash, formatted as hex string like BlockSci's uint256.'''
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value.hex()
+
+
+class Address:
+
+    __slots__ = ('type', 'address_num')
+
+    def __init__(self, addr_type, address_num):
+        self.type = addr_type
+        self.address_num = address_num
+
+    @property
+    def address_string(self):
+        # base58check and bech32 strings of Bitcoin's lengths, derived from
+        # the address number
+        digest = hashlib.blake2b(
+            self.address_num.to_bytes(8, 'little') + bytes([self.type.value]),
+            digest_size=32).digest()
+        if self.type == address_type.witness_pubkeyhash:
+            return segwit_encode(0, 'bc', digest[:20])
+        if self.type == address_type.witness_scripthash:
+            return segwit_encode(0, 'bc', digest)
+        if self.type == address_type.scripthash:
+            return b58check_encode(b'\x05' + digest[:20])
+        return b58check_encode(b'\x00' + digest[:20])
+
+    @property
+    def addresses(self):
+        '''Public keys of a multisig address (2 or 3).'''
+        return [Address(address_type.pubkey, self.address_num * 3 + k)
+                for k in range(2 + self.address_num % 2)]
+
+
+class OutputRef:
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class Output:
+
+    __slots__ = ('address', 'value', 'address_type')
+
+    def __init__(self, chain, pos):
+        self.address_type = ADDRESS_TYPES[chain.out_type[pos] - 1]
+        self.address = Address(self.address_type, int(chain.out_addr[pos]))
+        self.value = int(chain.out_value[pos])
+
+
+class Input(Output):
+
+    __slots__ = ('spent_tx_index', 'spent_output')
+
+    def __init__(self, chain, pos):
+        spent_tx = int(chain.in_spent_tx[pos])
+        spent_output = int(chain.in_spent_output[pos])
+        super().__init__(chain, chain.out_offsets[spent_tx] + spent_output)
+        self.spent_tx_index = spent_tx
+        self.spent_output = OutputRef(spent_output)
+
+
+class Tx:
+    '''Synthetic counterpart of blocksci.Tx(index, chain).'''
+
+    def __init__(self, index, chain):
+        self.index = index
+        self.chain = chain
+
+    @property
+    def hash(self):
+        return Hash(self.chain.tx_hash[self.index].tobytes())
+
+    @property
+    def block_height(self):
+        return int(self.chain.tx_block[self.index])
+
+    @property
+    def block_time(self):
+        return dt.fromtimestamp(
+            int(self.chain.block_timestamp[self.block_height]))
+
+    @property
+    def is_coinbase(self):
+        return bool(self.chain.tx_is_coinbase[self.index])
+
+    @property
+    def input_count(self):
+        return int(self.chain.tx_input_count[self.index])
+
+    @property
+    def output_count(self):
+        return int(self.chain.tx_output_count[self.index])
+
+    @property
+    def input_value(self):
+        return int(self.chain.tx_input_value[self.index])
+
+    @property
+    def output_value(self):
+        return int(self.chain.tx_output_value[self.index])
+
+    @property
+    def inputs(self):
+        (start, end) = self.chain.in_offsets[self.index:self.index + 2]
+        return [Input(self.chain, pos) for pos in range(start, end)]
+
+    @property
+    def outputs(self):
+        (start, end) = self.chain.out_offsets[self.index:self.index + 2]
+        return [Output(self.chain, pos) for pos in range(start, end)]
+
+
+class TxRange:
+    '''Consecutive txs with array-valued attributes, like BlockSci's.'''
+
+    def __init__(self, chain, start, end):
+        self.chain = chain
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return (Tx(i, self.chain) for i in range(self.start, self.end))
+
+    def __getitem__(self, i):
+        return Tx(range(self.start, self.end)[i], self.chain)
+
+    @property
+    def index(self):
+        return np.arange(self.start, self.end)
+
+    @property
+    def is_coinbase(self):
+        return self.chain.tx_is_coinbase[self.start:self.end]
+
+    @property
+    def input_count(self):
+        return self.chain.tx_input_count[self.start:self.end]
+
+    @property
+    def output_count(self):
+        return self.chain.tx_output_count[self.start:self.end]
+
+    @property
+    def input_value(self):
+        return self.chain.tx_input_value[self.start:self.end]
+
+    @property
+    def output_value(self):
+        return self.chain.tx_output_value[self.start:self.end]
+
+
+class Block:
+
+    def __init__(self, chain, height):
+        self.chain = chain
+        self.height = height
+
+    @property
+    def hash(self):
+        return Hash(self.chain.block_hash[self.height].tobytes())
+
+    @property
+    def timestamp(self):
+        return int(self.chain.block_timestamp[self.height])
+
+    @property
+    def time(self):
+        return dt.utcfromtimestamp(self.timestamp)
+
+    @property
+    def tx_count(self):
+        return int(self.chain.block_tx_count[self.height])
+
+    @property
+    def txes(self):
+        start = int(self.chain.block_first_tx[self.height])
+        return TxRange(self.chain, start, start + self.tx_count)
+
+
+class BlockRange:
+    '''Consecutive blocks with array-valued attributes, like BlockSci's.'''
+
+    def __init__(self, chain, start, end):
+        self.chain = chain
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return (Block(self.chain, h) for h in range(self.start, self.end))
+
+    def __getitem__(self, i):
+        return Block(self.chain, range(self.start, self.end)[i])
+
+    @property
+    def height(self):
+        return np.arange(self.start, self.end)
+
+    @property
+    def hash(self):
+        return [Hash(x.tobytes())
+                for x in self.chain.block_hash[self.start:self.end]]
+
+    @property
+    def timestamp(self):
+        return self.chain.block_timestamp[self.start:self.end]
+
+    @property
+    def time(self):
+        return self.timestamp.astype('datetime64[s]').astype('datetime64[ns]')
+
+    @property
+    def tx_count(self):
+        return self.chain.block_tx_count[self.start:self.end]
+
+    @property
+    def input_count(self):
+        return self.chain.block_input_count[self.start:self.end]
+
+    @property
+    def output_count(self):
+        return self.chain.block_output_count[self.start:self.end]
+
+    @property
+    def txes(self):
+        first_tx = self.chain.block_first_tx
+        end = (first_tx[self.end] if self.end < len(self.chain)
+               else len(self.chain.tx_block))
+        return TxRange(self.chain, int(first_tx[self.start]), int(end))
+
+
+class SyntheticChain:
+    '''Randomly generated chain, reproducible from its parameters.
+
+    Tx counts per block are Poisson distributed, with an optional huge block
+    every `huge_block_interval` blocks; input and output counts per tx are
+    geometrically distributed. Inputs spend outputs of txs a geometrically
+    distributed distance back, and a share of outputs reuses the address of
+    an earlier output.
+    '''
+
+    def __init__(self, num_blocks=2_000, txs_per_block=200,
+                 inputs_per_tx=2.0, outputs_per_tx=2.5,
+                 huge_block_interval=0, huge_block_txs=20_000,
+                 spend_distance=5_000, address_reuse=0.3, seed=0):
+        rng = np.random.default_rng(seed)
+
+        tx_counts = 1 + rng.poisson(max(0, txs_per_block - 1), num_blocks)
+        if huge_block_interval:
+            tx_counts[huge_block_interval - 1::huge_block_interval] = \
+                huge_block_txs
+        self.block_tx_count = tx_counts
+        self.block_first_tx = np.concatenate(([0], np.cumsum(tx_counts)[:-1]))
+        self.block_timestamp = (1_600_000_000 + 600 * np.arange(num_blocks) +
+                                rng.integers(0, 600, num_blocks))
+        self.block_hash = rng.integers(0, 256, (num_blocks, 32),
+                                       dtype=np.uint8)
+
+        num_txs = int(tx_counts.sum())
+        self.tx_block = np.repeat(np.arange(num_blocks), tx_counts)
+        self.tx_hash = rng.integers(0, 256, (num_txs, 32), dtype=np.uint8)
+        self.tx_is_coinbase = np.zeros(num_txs, dtype=bool)
+        self.tx_is_coinbase[self.block_first_tx] = True
+
+        # outputs
+        output_counts = rng.geometric(1 / outputs_per_tx, num_txs)
+        self.out_offsets = np.concatenate(([0], np.cumsum(output_counts)))
+        num_outputs = int(self.out_offsets[-1])
+        weights = np.array(list(ADDRESS_TYPE_WEIGHTS.values()))
+        self.out_type = rng.choice(
+            [x.value for x in ADDRESS_TYPE_WEIGHTS], num_outputs,
+            p=weights / weights.sum())
+        self.out_addr = np.arange(num_outputs)
+        reused = rng.random(num_outputs) < address_reuse
+        self.out_addr[reused] = (rng.random(reused.sum()) *
+                                 self.out_addr[reused]).astype(np.int64)
+        self.out_value = rng.integers(546, 10**8, num_outputs)
+        self.out_value[self.out_type == address_type.nulldata.value] = 0
+
+        # inputs; coinbase txs have none
+        input_counts = rng.geometric(1 / inputs_per_tx, num_txs)
+        input_counts[self.tx_is_coinbase] = 0
+        self.in_offsets = np.concatenate(([0], np.cumsum(input_counts)))
+        num_inputs = int(self.in_offsets[-1])
+        in_tx = np.repeat(np.arange(num_txs), input_counts)
+        distance = rng.geometric(1 / spend_distance, num_inputs)
+        self.in_spent_tx = in_tx - np.minimum(distance, in_tx)
+        self.in_spent_output = (rng.random(num_inputs) *
+                                output_counts[self.in_spent_tx]
+                                ).astype(np.int64)
+        in_value = self.out_value[self.out_offsets[self.in_spent_tx] +
+                                  self.in_spent_output]
+
+        self.tx_input_count = input_counts
+        self.tx_output_count = output_counts
+        in_cumsum = np.concatenate(([0], np.cumsum(in_value)))
+        self.tx_input_value = in_cumsum[self.in_offsets[1:]] - \
+            in_cumsum[self.in_offsets[:-1]]
+        out_cumsum = np.concatenate(([0], np.cumsum(self.out_value)))
+        self.tx_output_value = out_cumsum[self.out_offsets[1:]] - \
+            out_cumsum[self.out_offsets[:-1]]
+
+        self.block_input_count = np.bincount(
+            self.tx_block, weights=input_counts,
+            minlength=num_blocks).astype(np.int64)
+        self.block_output_count = np.bincount(
+            self.tx_block, weights=output_counts,
+            minlength=num_blocks).astype(np.int64)
+
+    def __len__(self):
+        return len(self.block_tx_count)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            heights = range(len(self))[key]
+            return BlockRange(self, heights.start, heights.stop)
+        return Block(self, range(len(self))[key])
+
+    def summary(self):
+        return {'blocks': len(self),
+                'txs': len(self.tx_block),
+                'inputs': int(self.in_offsets[-1]),
+                'outputs': int(self.out_offsets[-1]),
+                'max_block_txs': int(self.block_tx_count.max())}
+
+
+def is_coinjoin(tx):
+    '''Simplified coinjoin heuristic: enough inputs for one participant per
+    pair of outputs, and one equal-valued output per participant.'''
+    if tx.input_count < 2 or tx.output_count < 3:
+        return False
+    participants = (tx.output_count + 1) // 2
+    if participants > tx.input_count:
+        return False
+    values = Counter(x.value for x in tx.outputs)
+    return values.most_common(1)[0][1] >= participants
+
+
+def load_exporter():
+    '''Import blocksci_export with the synthetic chain standing in for the
+    blocksci package.'''
+    module = types.ModuleType('blocksci')
+    module.address_type = address_type
+    module.Tx = Tx
+    module.Blockchain = SyntheticChain
+    module.heuristics = types.SimpleNamespace(is_coinjoin=is_coinjoin)
+    sys.modules['blocksci'] = module
+    return importlib.import_module('blocksci_export')
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+class FakeFuture:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = None
+        self.outcome = None
+
+    def add_callbacks(self, callback, errback, callback_args=(),
+                      errback_args=()):
+        with self.lock:
+            self.callbacks = (callback, callback_args, errback, errback_args)
+            outcome = self.outcome
+        if outcome is not None:
+            self.run_callbacks()
+
+    def complete(self, exc=None):
+        with self.lock:
+            self.outcome = (exc,)
+            callbacks = self.callbacks
+        if callbacks is not None:
+            self.run_callbacks()
+
+    def run_callbacks(self):
+        (callback, callback_args, errback, errback_args) = self.callbacks
+        (exc,) = self.outcome
+        if exc is None:
+            callback(None, *callback_args)
+        else:
+            errback(exc, *errback_args)
+
+
+class FakeBatchStatement:
+    '''Stand-in for BatchStatement, which cannot bind the unprepared
+    statements of FakeSession.'''
+
+    def __init__(self, batch_type=None):
+        self.batch_type = batch_type
+        self.statements = []
+
+    def add(self, statement, parameters=None):
+        self.statements.append((statement, parameters))
+
+
+class FakeSession:
+    '''Stand-in for a Cassandra session.
+
+    Asynchronous requests complete after an exponentially distributed
+    latency, from a single event loop thread like the driver's; a share of
+    them fails with InjectedFailure. Each statement of a batch after the
+    first adds `batch_row_cost` times the mean latency. With more than
+    `capacity` pending requests, latency grows with the number of pending
+    requests, and requests slower than `timeout` fail with
+    OperationTimedOut.
+    '''
+
+    def __init__(self, keyspace, latency=0.001, failure_rate=0.0, seed=0,
+                 batch_row_cost=0.05, capacity=0, timeout=None):
+        self.keyspace = keyspace
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.batch_row_cost = batch_row_cost
+        self.capacity = capacity
+        self.timeout = timeout
+        self.default_timeout = None
+        self.rng = random.Random(seed + os.getpid())
+        self.pending = []
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.event_loop, daemon=True)
+        self.thread.start()
+
+    def prepare(self, cql):
+        return cql
+
+    def execute(self, statement, parameters=None):
+        time.sleep(self.latency)
+        return []
+
+    def execute_async(self, statement, parameters=None):
+        future = FakeFuture()
+        delay = self.rng.expovariate(1 / self.latency) if self.latency else 0
+        if isinstance(statement, FakeBatchStatement):
+            delay += (len(statement.statements) - 1) * \
+                self.batch_row_cost * self.latency
+        exc = (InjectedFailure('injected write failure')
+               if self.rng.random() < self.failure_rate else None)
+        with self.cond:
+            if self.capacity and len(self.pending) > self.capacity:
+                delay *= len(self.pending) / self.capacity
+            if self.timeout is not None and delay > self.timeout:
+                delay = self.timeout
+                exc = OperationTimedOut('simulated client timeout')
+            heapq.heappush(self.pending,
+                           (time.monotonic() + delay, self.seq, future, exc))
+            self.seq += 1
+            self.cond.notify()
+        return future
+
+    def event_loop(self):
+        while True:
+            with self.cond:
+                while self.running and (
+                        not self.pending or
+                        self.pending[0][0] > time.monotonic()):
+                    timeout = (self.pending[0][0] - time.monotonic()
+                               if self.pending else None)
+                    self.cond.wait(timeout)
+                if not self.running:
+                    return
+                due = []
+                now = time.monotonic()
+                while self.pending and self.pending[0][0] <= now:
+                    due.append(heapq.heappop(self.pending))
+            for (_, _, future, exc) in due:
+                future.complete(exc)
+
+    def shutdown(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+
+class FakeCluster:
+    '''Stand-in for a Cassandra cluster.
+
+    Like the driver, whose threads do not survive a fork, a cluster that
+    has connected cannot connect again in a forked process: there the
+    driver waits forever, here connect raises an error.
+    '''
+
+    def __init__(self, latency=0.001, failure_rate=0.0, seed=0,
+                 batch_row_cost=0.05, capacity=0, timeout=None):
+        self.pid = None
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.batch_row_cost = batch_row_cost
+        self.capacity = capacity
+        self.timeout = timeout
+        self.metadata = types.SimpleNamespace(
+            keyspaces={'benchmark': types.SimpleNamespace(
+                tables={'export_progress': None})})
+
+    def connect(self, keyspace=None):
+        if self.pid not in (None, os.getpid()):
+            raise RuntimeError(f'cluster connected in process {self.pid} '
+                               f'used after fork')
+        self.pid = os.getpid()
+        return FakeSession(keyspace, self.latency, self.failure_rate,
+                           self.seed, self.batch_row_cost, self.capacity,
+                           self.timeout)
+
+    def shutdown(self):
+        pass
+
+
+def resource_usage():
+    '''Return CPU seconds and peak RSS in MB of this process and of all
+    its terminated children.'''
+    usage = [resource.getrusage(x) for x in (resource.RUSAGE_SELF,
+                                             resource.RUSAGE_CHILDREN)]
+    return {'user_seconds': sum(x.ru_utime for x in usage),
+            'system_seconds': sum(x.ru_stime for x in usage),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': max(x.ru_maxrss for x in usage) / 1024}
+
+
+def run_stage(exporter, stage, chain, sink_factory, args):
+    '''Export all blocks of the chain in one stage.'''
+
+    block_intervals = [(0, len(chain))]
+    options = {'checkpoint_interval': args.checkpoint_interval}
+    profiler = None
+    if args.profile:
+        profiler = exporter.Profiler(os.path.join(args.profile, stage),
+                                     args.profile_mode)
+    # like the export, connect before the worker pool is forked
+    sink = sink_factory()
+    pool = exporter.WorkerPool(sink_factory, chain, args.num_proc,
+                               args.batch_size, profiler=profiler)
+
+    if stage in ('tx', 'tx+block_tx', 'tx+address_tx', 'address_tx'):
+        stages = tuple(stage.split('+'))
+        qm = exporter.TxQueryManager(
+            pool=pool,
+            txs='tx' in stages,
+            block_txs='block_tx' in stages,
+            address_txs='address_tx' in stages,
+            stages=stages,
+            cache_size=args.cache_size,
+            compact_tx_io=args.tx_io_encoding == 'compact', **options)
+        qm.execute(exporter.TxQueryManager.insert,
+                   exporter.tx_work_units(chain, block_intervals,
+                                          args.num_chunks))
+    elif stage == 'aggregates':
+        qm = exporter.AggregateQueryManager(pool=pool, **options)
+        qm.execute(exporter.AggregateQueryManager.insert,
+                   [(start, end, len(chain)) for (start, end)
+                    in exporter.schedule_work_units(chain, block_intervals,
+                                                    args.num_chunks)])
+    else:
+        manager = {'block': exporter.BlockQueryManager,
+                   'block_tx': exporter.BlockTxQueryManager,
+                   'coinjoin': exporter.CoinjoinQueryManager}[stage]
+        if stage == 'block_tx':
+            options['max_batch_txs'] = exporter.max_batch_txs(args)
+        qm = manager(pool=pool, **options)
+        qm.execute(manager.insert,
+                   exporter.schedule_work_units(chain, block_intervals,
+                                                args.num_chunks))
+    pool.close()
+    sink.close()
+
+
+def stage_process(exporter, stage, chain, sink_factory, args, conn):
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    start = time.perf_counter()
+    run_stage(exporter, stage, chain, sink_factory, args)
+    wall_seconds = time.perf_counter() - start
+
+    totals = {}
+    latency = exporter.Histogram()
+    extraction = exporter.Histogram()
+    concurrency_limit = 0
+    for ((name, _), value) in exporter.METRICS.drain().items():
+        if name == 'concurrency_limit':
+            concurrency_limit = max(concurrency_limit, value)
+        elif name == 'write_latency_seconds':
+            latency.merge(value)
+        elif name == 'extract_seconds':
+            extraction.merge(value)
+        elif name.endswith('_total'):
+            totals[name] = totals.get(name, 0) + value
+
+    result = {'wall_seconds': wall_seconds,
+              'rows': totals.get('rows_total', 0),
+              'bytes': totals.get('bytes_total', 0),
+              'retries': totals.get('retries_total', 0),
+              'failed_rows': totals.get('failed_rows_total', 0),
+              'extract_seconds': extraction.sum,
+              'concurrency_limit': concurrency_limit,
+              'mean_write_latency_ms':
+                  1e3 * latency.sum / latency.count if latency.count else 0}
+    result.update(resource_usage())
+    result['rows_per_second'] = result['rows'] / wall_seconds
+    result['mb_per_second'] = result['bytes'] / wall_seconds / 1e6
+    result['cpu_percent'] = 100 * (result['user_seconds'] +
+                                   result['system_seconds']) / wall_seconds
+    conn.send(result)
+
+
+def print_results(results, baseline=None):
+    print(f'{"stage":<14} {"rows":>10} {"seconds":>8} {"rows/s":>10} '
+          f'{"MB/s":>7} {"user":>7} {"sys":>6} {"CPU%":>6} {"RSS MB":>7} '
+          f'{"extract":>8} {"lat ms":>7} {"retries":>7} {"limit":>5}')
+    for (stage, r) in results.items():
+        line = (f'{stage:<14} {r["rows"]:>10,.0f} {r["wall_seconds"]:>8.2f} '
+                f'{r["rows_per_second"]:>10,.0f} {r["mb_per_second"]:>7.2f} '
+                f'{r["user_seconds"]:>7.2f} {r["system_seconds"]:>6.2f} '
+                f'{r["cpu_percent"]:>6.0f} {r["peak_rss_mb"]:>7.0f} '
+                f'{r["extract_seconds"]:>8.2f} '
+                f'{r["mean_write_latency_ms"]:>7.2f} {r["retries"]:>7,.0f} '
+                f'{r.get("concurrency_limit", 0):>5,.0f}')
+        if baseline and stage in baseline:
+            previous = baseline[stage]['rows_per_second']
+            line += f' {r["rows_per_second"] / previous - 1:+.1%}'
+        print(line)
+
+
+def create_parser():
+    parser = ArgumentParser(description='Benchmark the BlockSci export on a '
+                                        'synthetic chain',
+                            epilog='GraphSense - http://graphsense.info')
+    group = parser.add_argument_group('synthetic chain')
+    group.add_argument('--blocks', dest='num_blocks', type=int,
+                       default=2_000,
+                       help='number of blocks (default 2000)')
+    group.add_argument('--txs-per-block', type=float, default=200,
+                       help='mean number of txs per block (default 200)')
+    group.add_argument('--inputs-per-tx', type=float, default=2.0,
+                       help='mean number of inputs per tx (default 2.0)')
+    group.add_argument('--outputs-per-tx', type=float, default=2.5,
+                       help='mean number of outputs per tx (default 2.5)')
+    group.add_argument('--huge-block-interval', type=int, default=0,
+                       help='make every N-th block a huge block '
+                            '(default 0, none)')
+    group.add_argument('--huge-block-txs', type=int, default=20_000,
+                       help='number of txs of huge blocks (default 20000)')
+    group.add_argument('--spend-distance', type=float, default=5_000,
+                       help='mean distance in txs between an input and the '
+                            'output it spends (default 5000)')
+    group.add_argument('--address-reuse', type=float, default=0.3,
+                       help='share of outputs to previously used addresses '
+                            '(default 0.3)')
+    group.add_argument('--seed', type=int, default=0,
+                       help='random seed (default 0)')
+
+    group = parser.add_argument_group('sink')
+    group.add_argument('--sink', default='cassandra',
+                       choices=['cassandra', 'parquet', 'csv'],
+                       help='write to a simulated Cassandra session or to '
+                            'files in a temporary directory '
+                            '(default "cassandra")')
+    group.add_argument('--latency', type=float, default=1.0,
+                       help='mean simulated write latency in milliseconds '
+                            '(default 1.0)')
+    group.add_argument('--failure-rate', type=float, default=0.0,
+                       help='share of simulated writes failing '
+                            '(default 0.0)')
+    group.add_argument('--batch-row-cost', type=float, default=0.05,
+                       help='simulated latency of each further statement '
+                            'of a batch, relative to the mean latency '
+                            '(default 0.05)')
+    group.add_argument('--capacity', type=int, default=0,
+                       help='number of pending requests per session beyond '
+                            'which the simulated latency grows; 0 for no '
+                            'limit (default 0)')
+    group.add_argument('--timeout', type=float,
+                       help='simulated client timeout in milliseconds')
+    group.add_argument('--write-mode', default='rows',
+                       choices=['rows', 'batches'],
+                       help='write single rows or partition batches '
+                            '(default "rows")')
+    group.add_argument('--max-batch-bytes', type=int, default=48 * 1024,
+                       help='upper limit of the adaptive batch size '
+                            '(default 49152)')
+
+    group = parser.add_argument_group('export')
+    group.add_argument('--stages', nargs='+', choices=STAGES,
+                       default=list(DEFAULT_STAGES),
+                       help='stages to run; "tx+block_tx" and '
+                            '"tx+address_tx" are fused transaction passes '
+                            '(default: tx block_tx coinjoin block)')
+    group.add_argument('--tx-io-encoding', default='udt',
+                       choices=['udt', 'compact'],
+                       help='encoding of tx inputs and outputs '
+                            '(default "udt")')
+    group.add_argument('--processes', dest='num_proc', type=int, default=1,
+                       help='number of processes (default 1)')
+    group.add_argument('--batch-size', type=int, default=100,
+                       help='number of rows extracted per batch '
+                            '(default 100)')
+    group.add_argument('--concurrency', type=int, default=100,
+                       help='maximum number of in-flight write requests per '
+                            'process (default 100)')
+    group.add_argument('--max-concurrency', type=int,
+                       help='adapt the number of in-flight write requests '
+                            'up to this value')
+    group.add_argument('--latency-target', type=float, default=0.5,
+                       help='99th percentile latency target of the '
+                            'adaptive concurrency in seconds (default 0.5)')
+    group.add_argument('--max-retries', type=int, default=10,
+                       help='number of retries before a row is journaled '
+                            '(default 10)')
+    group.add_argument('--memory-budget', type=int, default=256,
+                       metavar='MIB',
+                       help='estimated size of the rows in flight or '
+                            'buffered per process (default 256)')
+    group.add_argument('--cache-size', type=int, default=250_000,
+                       help='size of the address and output caches '
+                            '(default 250000)')
+    group.add_argument('--checkpoint-interval', type=int, default=100,
+                       help='batches between progress checkpoints '
+                            '(default 100)')
+    group.add_argument('--chunks', dest='num_chunks', type=int,
+                       help='number of work units (default 8 * `NUM_PROC`)')
+    group.add_argument('--profile', metavar='DIR',
+                       help='profile the workers and write the merged '
+                            'reports of every stage to DIR/STAGE')
+    group.add_argument('--profile-mode', default='deterministic',
+                       choices=['deterministic', 'sampling'],
+                       help='cProfile or stack sampling (default '
+                            '"deterministic")')
+
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write configuration and results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='show the change in rows/s relative to the '
+                             'results of an earlier run')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the progress output of the export')
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    if not args.num_chunks:
+        args.num_chunks = 8 * args.num_proc
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['results']
+
+    exporter = load_exporter()
+    exporter.BatchStatement = FakeBatchStatement
+
+    start = time.perf_counter()
+    chain = SyntheticChain(args.num_blocks, args.txs_per_block,
+                           args.inputs_per_tx, args.outputs_per_tx,
+                           args.huge_block_interval, args.huge_block_txs,
+                           args.spend_distance, args.address_reuse,
+                           args.seed)
+    print(f'Synthetic chain ({time.perf_counter() - start:.1f}s): ' +
+          ', '.join(f'{v:,} {k}' for (k, v) in chain.summary().items()))
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_export-')
+    try:
+        results = {}
+        for stage in args.stages:
+            if args.sink == 'cassandra':
+                cluster_factory = partial(
+                    FakeCluster, args.latency / 1e3, args.failure_rate,
+                    args.seed, args.batch_row_cost, args.capacity,
+                    args.timeout / 1e3 if args.timeout else None)
+                max_batch_bytes = (args.max_batch_bytes
+                                   if args.write_mode == 'batches' else None)
+                sink_factory = partial(exporter.CassandraSink.connect,
+                                       cluster_factory,
+                                       'benchmark', args.concurrency,
+                                       os.path.join(work_dir, 'journal'),
+                                       args.max_retries, max_batch_bytes,
+                                       args.max_concurrency,
+                                       args.latency_target,
+                                       args.memory_budget * 2**20)
+            else:
+                output_dir = os.path.join(work_dir, stage)
+                if args.sink == 'parquet':
+                    sink_factory = partial(
+                        exporter.ParquetSink, output_dir,
+                        max_buffer_bytes=args.memory_budget * 2**20,
+                        compact_tx_io=args.tx_io_encoding == 'compact')
+                else:
+                    sink_factory = partial(
+                        exporter.CsvSink, output_dir,
+                        max_buffer_bytes=args.memory_budget * 2**20)
+
+            (receiver, sender) = Pipe(duplex=False)
+            process = Process(target=stage_process,
+                              args=(exporter, stage, chain, sink_factory,
+                                    args, sender))
+            process.start()
+            sender.close()
+            try:
+                results[stage] = receiver.recv()
+            except EOFError:
+                print(f'Error: stage {stage} failed')
+                raise SystemExit(1)
+            finally:
+                process.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results, baseline)
+
+    if args.output:
+        config = {k: v for (k, v) in vars(args).items()
+                  if k not in ('output', 'compare', 'verbose')}
+        config['chain'] = chain.summary()
+        with open(args.output, 'w') as fh:
+            json.dump({'config': config, 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from abc import ABC
-from argparse import ArgumentParser
-from collections import deque
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser, Namespace
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime as dt
-from functools import wraps
-from itertools import islice
+from functools import lru_cache, partial, wraps
 from multiprocessing import Pool, Value
+import cProfile
+import csv
+import hashlib
+import heapq
+import json
+import os
+import pstats
+import signal
+import threading
 import time
 
+from cassandra import OperationTimedOut, WriteTimeout
 from cassandra.cluster import Cluster
-from cassandra.concurrent import execute_concurrent_with_args
-from cassandra.query import SimpleStatement
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.protocol import OverloadedErrorMessage
+from cassandra.query import (BatchStatement, BatchType, SimpleStatement,
+                             UNSET_VALUE)
 import numpy as np
 import blocksci
 
+from tx_io_codec import decode_tx_ios, encode_address, encode_tx_ios
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 
 # dict(zip(blocksci.address_type.types,
 #      range(1, len(blocksci.address_type.types) + 1)))
@@ -35,6 +56,112 @@ address_type = {
 TX_HASH_PREFIX_LENGTH = 5
 TX_BUCKET_SIZE = 25_000
 BLOCK_BUCKET_SIZE = 100
+# hex digits of the SHA-256 digest of an address partitioning
+# address_transactions
+ADDRESS_PREFIX_LENGTH = 4
+
+# columns of the aggregate statistics tables, after their key
+AGGREGATE_COLUMNS = ('no_blocks', 'no_txs', 'no_inputs', 'no_outputs',
+                     'total_input', 'total_output', 'total_fees',
+                     'coinbase_output')
+SECONDS_PER_DAY = 86_400
+
+# partitioning parameters, in the column order of the configuration table,
+# with their defaults; a keyspace keeps those of its first export
+PARTITIONING_DEFAULTS = {
+    'block_bucket_size': BLOCK_BUCKET_SIZE,
+    'tx_prefix_length': TX_HASH_PREFIX_LENGTH,
+    'tx_bucket_size': TX_BUCKET_SIZE,
+    'address_prefix_length': ADDRESS_PREFIX_LENGTH
+}
+
+# in follow mode, updates with up to this many txs are exported without
+# forking worker processes
+FOLLOW_INLINE_TXS = 100_000
+
+# column names per table, in the order of the row tuples built below
+# (see scripts/schema.cql)
+TABLE_COLUMNS = {
+    'block': ('block_id_group', 'block_id', 'block_hash',
+              'timestamp', 'no_transactions'),
+    'transaction': ('tx_id_group', 'tx_id', 'tx_hash', 'block_id',
+                    'timestamp', 'coinbase', 'total_input', 'total_output',
+                    'inputs', 'outputs', 'coinjoin'),
+    'transaction_by_tx_prefix': ('tx_prefix', 'tx_hash', 'tx_id'),
+    'block_transactions': ('block_id_group', 'block_id', 'txs'),
+    'summary_statistics': ('id', 'timestamp', 'no_blocks', 'no_txs'),
+    'configuration': ('id', 'block_bucket_size', 'tx_prefix_length',
+                      'tx_bucket_size', 'address_prefix_length'),
+    'transaction_coinjoin': ('tx_id_group', 'tx_id', 'coinjoin'),
+    'address_transactions': ('address_prefix', 'address', 'tx_id',
+                             'is_outgoing', 'value'),
+    'daily_statistics': ('date',) + AGGREGATE_COLUMNS,
+    'block_group_statistics': ('block_id_group',) + AGGREGATE_COLUMNS
+}
+
+# row sets written as a subset of the columns of another table
+TABLE_TARGETS = {
+    'transaction_coinjoin': 'transaction'
+}
+
+# primary key columns per table; these are always the leading columns in
+# TABLE_COLUMNS
+PRIMARY_KEYS = {
+    'block': ('block_id_group', 'block_id'),
+    'transaction': ('tx_id_group', 'tx_id'),
+    'transaction_by_tx_prefix': ('tx_prefix', 'tx_hash'),
+    'block_transactions': ('block_id_group', 'block_id'),
+    'summary_statistics': ('id',),
+    'configuration': ('id',),
+    'transaction_coinjoin': ('tx_id_group', 'tx_id'),
+    'address_transactions': ('address_prefix', 'address', 'tx_id',
+                             'is_outgoing'),
+    'daily_statistics': ('date',),
+    'block_group_statistics': ('block_id_group',)
+}
+
+# field names of the user-defined types stored in list columns
+TX_IO_FIELDS = ('address', 'value', 'address_type')
+TX_SUMMARY_FIELDS = ('tx_id', 'no_inputs', 'no_outputs',
+                     'total_input', 'total_output')
+UDT_FIELDS = {
+    'inputs': TX_IO_FIELDS,
+    'outputs': TX_IO_FIELDS,
+    'txs': TX_SUMMARY_FIELDS
+}
+
+# errors signalling that the cluster cannot keep up with the write load
+OVERLOAD_ERRORS = (OperationTimedOut, OverloadedErrorMessage, WriteTimeout)
+
+# tables whose rows are grouped into single-partition batches by
+# --write-mode batches; the partition key is the first column
+BATCH_TABLES = ('block', 'transaction', 'block_transactions',
+                'transaction_coinjoin')
+
+# Cassandra's default max_mutation_size (half of commitlog_segment_size);
+# larger rows are rejected
+MAX_MUTATION_BYTES = 16 * 1024 * 1024
+# estimated size of the rows a process keeps in flight or buffered
+MEMORY_BUDGET = 256 * 1024 * 1024
+# approximate memory of the statistics of one tx while block_transactions
+# rows are built
+TX_STATS_MEMORY = 256
+
+# bucket columns used to partition file output; the lookup table is not
+# partitioned, since its 16^TX_HASH_PREFIX_LENGTH prefixes would result in
+# far too many small files
+PARTITION_COLUMNS = {
+    'block': 'block_id_group',
+    'transaction': 'tx_id_group',
+    'block_transactions': 'block_id_group',
+    'transaction_coinjoin': 'tx_id_group'
+}
+
+
+# address types without an address string, see addr_str()
+ADDRESS_TYPES_WITHOUT_STR = (blocksci.address_type.nonstandard,
+                             blocksci.address_type.nulldata,
+                             blocksci.address_type.witness_unknown)
 
 
 def timing(f):
@@ -48,6 +175,14 @@ def timing(f):
     return wrap
 
 
+def connect_cluster(db_nodes, port):
+    '''Return a cluster that routes requests to a replica of their partition
+    (for batches, the partition of their first statement).'''
+    return Cluster(db_nodes, port=port,
+                   load_balancing_policy=TokenAwarePolicy(
+                       DCAwareRoundRobinPolicy()))
+
+
 def query_most_recent_block(cluster, keyspace):
     '''Fetch most recent entry from blocks table, else return None.'''
 
@@ -69,250 +204,1932 @@ def query_most_recent_block(cluster, keyspace):
     return latest_block
 
 
+def csv_value(value, udt_fields=None):
+    '''Format a column value for bulk loading from CSV.
+
+    >>> csv_value(bytearray.fromhex('00ff'))
+    '0x00ff'
+
+    >>> csv_value(True)
+    'true'
+
+    >>> csv_value(None)
+    ''
+
+    >>> csv_value([(['1A1zP1'], 50, 3)], TX_IO_FIELDS)
+    '[{"address": ["1A1zP1"], "value": 50, "address_type": 3}]'
+    '''
+
+    if value is None:
+        return ''
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + value.hex()
+    if isinstance(value, (bool, np.bool_)):
+        return 'true' if value else 'false'
+    if udt_fields is not None:
+        return json.dumps([dict(zip(udt_fields, x)) for x in value],
+                          default=int)
+    return value
+
+
+def insert_cql(table):
+    '''Return the prepared INSERT statement for a table in TABLE_COLUMNS.
+
+    >>> insert_cql('transaction_by_tx_prefix')
+    'INSERT INTO transaction_by_tx_prefix (tx_prefix, tx_hash, tx_id) \
+VALUES (?, ?, ?)'
+
+    >>> insert_cql('transaction_coinjoin')
+    'INSERT INTO transaction (tx_id_group, tx_id, coinjoin) VALUES (?, ?, ?)'
+    '''
+
+    columns = TABLE_COLUMNS[table]
+    target = TABLE_TARGETS.get(table, table)
+    return (f'INSERT INTO {target} ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})')
+
+
+def delete_cql(table):
+    '''Return the prepared DELETE statement for a row of a table.
+
+    >>> delete_cql('transaction_by_tx_prefix')
+    'DELETE FROM transaction_by_tx_prefix WHERE tx_prefix=? AND tx_hash=?'
+    '''
+
+    return (f'DELETE FROM {table} WHERE ' +
+            ' AND '.join(f'{x}=?' for x in PRIMARY_KEYS[table]))
+
+
+class ProgressLedger(ABC):
+    '''Record export progress per table stage, in block heights.
+
+    For every stage (`tx`, `block_tx`, `address_tx`, `block`, ...) the
+    ledger keeps the next block to export after the last completed run (the
+    frontier), and the watermark of every work unit of a run in progress.
+    '''
+
+    @abstractmethod
+    def load(self, stage):
+        '''Return the frontier and the (start, end, watermark) tuples of all
+        recorded work units of a stage.'''
+
+    @abstractmethod
+    def checkpoint(self, stage, unit_start, unit_end, watermark):
+        '''Record the watermark of a work unit.'''
+
+    @abstractmethod
+    def complete(self, stage, block_index_range):
+        '''Advance the frontier and drop the work units of a completed
+        run.'''
+
+    def remaining(self, stage, block_index_range):
+        '''Return the block intervals of a range not yet exported.'''
+        (frontier, units) = self.load(stage)
+        completed = [(start, watermark) for (start, _, watermark) in units]
+        if frontier is not None:
+            completed.append((0, frontier))
+        return subtract_intervals(block_index_range, completed)
+
+    @staticmethod
+    def next_frontier(frontier, block_index_range):
+        '''Advance the frontier if a completed range connects to it.
+
+        >>> ProgressLedger.next_frontier(None, (100, 200))
+        200
+
+        >>> ProgressLedger.next_frontier(150, (100, 200))
+        200
+
+        >>> ProgressLedger.next_frontier(50, (100, 200))
+        50
+        '''
+        (start, end) = block_index_range
+        if frontier is None:
+            return end
+        if start <= frontier:
+            return max(frontier, end)
+        return frontier
+
+
+class NullLedger(ProgressLedger):
+    '''Record nothing; used if no ledger is available.'''
+
+    def load(self, stage):
+        return (None, [])
+
+    def checkpoint(self, stage, unit_start, unit_end, watermark):
+        pass
+
+    def complete(self, stage, block_index_range):
+        pass
+
+
+class CassandraLedger(ProgressLedger):
+    '''Keep the progress ledger in the `export_progress` table.'''
+
+    def __init__(self, session):
+        self.session = session
+        self.checkpoint_stmt = session.prepare(
+            '''INSERT INTO export_progress
+               (table_name, chunk_start, chunk_end, watermark)
+               VALUES (?, ?, ?, ?)''')
+
+    def load(self, stage):
+        result = self.session.execute(
+            '''SELECT next_block, chunk_start, chunk_end, watermark
+               FROM export_progress WHERE table_name=%s''', (stage,))
+        frontier = None
+        units = []
+        for row in result:
+            frontier = row.next_block
+            if row.chunk_start is not None:
+                units.append((row.chunk_start, row.chunk_end, row.watermark))
+        return (frontier, units)
+
+    def checkpoint(self, stage, unit_start, unit_end, watermark):
+        self.session.execute(self.checkpoint_stmt,
+                             (stage, unit_start, unit_end, watermark))
+
+    def complete(self, stage, block_index_range):
+        (frontier, _) = self.load(stage)
+        frontier = self.next_frontier(frontier, block_index_range)
+        self.session.execute(
+            '''UPDATE export_progress SET next_block=%s
+               WHERE table_name=%s''', (frontier, stage))
+        self.session.execute(
+            '''DELETE FROM export_progress WHERE table_name=%s
+               AND chunk_start >= %s AND chunk_start < %s''',
+            (stage, *block_index_range))
+
+
+class FileLedger(ProgressLedger):
+    '''Keep the progress ledger as JSON lines next to file sink output.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def append(self, entry):
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        with open(self.file_name, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+
+    def load(self, stage):
+        frontier = None
+        units = {}
+        if os.path.exists(self.file_name):
+            with open(self.file_name) as fh:
+                for line in fh:
+                    entry = json.loads(line)
+                    if entry['stage'] != stage:
+                        continue
+                    if 'next_block' in entry:
+                        frontier = entry['next_block']
+                        (start, end) = entry['completed']
+                        units = {k: v for (k, v) in units.items()
+                                 if not start <= k < end}
+                    else:
+                        units[entry['start']] = (entry['start'],
+                                                 entry['end'],
+                                                 entry['watermark'])
+        return (frontier, list(units.values()))
+
+    def checkpoint(self, stage, unit_start, unit_end, watermark):
+        self.append({'stage': stage, 'start': unit_start, 'end': unit_end,
+                     'watermark': watermark})
+
+    def complete(self, stage, block_index_range):
+        (frontier, _) = self.load(stage)
+        self.append({'stage': stage,
+                     'next_block': self.next_frontier(frontier,
+                                                      block_index_range),
+                     'completed': list(block_index_range)})
+
+
+# exported metrics, with their Prometheus type and help text; all metrics
+# are labelled with the stage that produced them
+METRIC_TYPES = {
+    'rows_total': ('counter', 'Rows written per table'),
+    'bytes_total': ('counter', 'Estimated bytes written per table'),
+    'retries_total': ('counter', 'Write requests re-submitted after an error'),
+    'failed_rows_total': ('counter',
+                          'Rows recorded in the failure journal'),
+    'extract_seconds': ('histogram',
+                        'Time to extract a batch of rows from BlockSci'),
+    'write_latency_seconds': ('histogram',
+                              'Latency of write requests or file writes'),
+    'in_flight_max': ('gauge',
+                      'Maximum number of in-flight write requests'),
+    'batch_limit_bytes': ('gauge', 'Maximum adapted batch size in bytes'),
+    'concurrency_limit': ('gauge',
+                          'Maximum adapted limit of in-flight write requests'),
+    'in_flight_bytes_max': ('gauge',
+                            'Maximum estimated size of in-flight rows'),
+    'large_rows_total': ('counter',
+                         'Rows larger than half the mutation size limit'),
+    'cache_hits_total': ('counter',
+                         'Lookups served by the address and output caches'),
+    'cache_misses_total': ('counter',
+                           'Lookups missing the address and output caches'),
+    'stage_seconds_total': ('counter', 'Wall-clock time spent in a stage')
+}
+
+METRIC_PREFIX = 'graphsense_export_'
+
+
+def value_size(value):
+    '''Estimate the serialized size of a column value in bytes.
+
+    >>> value_size(bytearray(32))
+    32
+
+    >>> value_size([(['1A1zP1'], 50, 3)])
+    34
+    '''
+
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return 4 + sum(value_size(x) for x in value)
+    return 8
+
+
+def row_size(row):
+    '''Estimate the serialized size of a row in bytes.
+
+    >>> row_size((3, 'abc', None))
+    11
+    '''
+
+    return sum(value_size(x) for x in row)
+
+
+def format_labels(labels):
+    '''Format label pairs for the Prometheus text format.
+
+    >>> format_labels((('stage', 'tx'), ('table', 'transaction')))
+    '{stage="tx",table="transaction"}'
+    '''
+
+    return '{' + ','.join(f'{k}={json.dumps(str(v))}'
+                          for (k, v) in labels) + '}'
+
+
+class Histogram:
+    '''Cumulative histogram with fixed bucket bounds in seconds.'''
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [x + y for (x, y) in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+        return self
+
+    def cumulative(self):
+        '''Return (upper bound, cumulative count) pairs.
+
+        >>> h = Histogram()
+        >>> for x in (0.002, 0.002, 100):
+        ...     h.observe(x)
+        >>> h.cumulative()[:3], h.cumulative()[-1]
+        ([('0.001', 0), ('0.0025', 2), ('0.005', 2)], ('+Inf', 3))
+        '''
+        bounds = [str(x) for x in self.BUCKETS] + ['+Inf']
+        return list(zip(bounds, np.cumsum(self.counts).tolist()))
+
+
+class Metrics:
+    '''Counters, gauges and histograms of one process.
+
+    Values are keyed by metric name and label pairs. Workers hand their
+    values to the parent process with `drain()` after every work unit, where
+    they are combined with `merge()`: counters and histograms are added up,
+    gauges keep their maximum.
+    '''
+
+    def __init__(self, stage=None):
+        self.stage = stage
+        self.values = {}
+        self.lock = threading.Lock()
+        # destination and constant labels of exported metrics
+        self.file_name = None
+        self.const_labels = ()
+
+    def key(self, name, labels):
+        return (name, (('stage', self.stage),) + tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = Histogram()
+            self.values[key].observe(value)
+
+    def gauge(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def record_rows(self, table, sizes):
+        self.inc('rows_total', len(sizes), table=table)
+        self.inc('bytes_total', sum(sizes), table=table)
+
+    def drain(self):
+        '''Return and reset the values collected so far.'''
+        with self.lock:
+            (values, self.values) = (self.values, {})
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for (key, value) in values.items():
+                if key not in self.values:
+                    self.values[key] = value
+                elif isinstance(value, Histogram):
+                    self.values[key].merge(value)
+                elif METRIC_TYPES[key[0]][0] == 'gauge':
+                    self.values[key] = max(self.values[key], value)
+                else:
+                    self.values[key] += value
+
+    @contextmanager
+    def timed_stage(self, stage):
+        '''Label metrics recorded in this process with a stage, record the
+        duration of the stage and export all metrics once it is done.'''
+        self.stage = stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc('stage_seconds_total', time.perf_counter() - start)
+            if self.file_name:
+                self.write()
+
+    def rates(self):
+        '''Return rows and bytes per second of every table and stage.'''
+        with self.lock:
+            values = dict(self.values)
+        durations = {labels[0][1]: value for ((name, labels), value)
+                     in values.items() if name == 'stage_seconds_total'}
+        rates = {}
+        for ((name, labels), value) in sorted(values.items()):
+            if name not in ('rows_total', 'bytes_total'):
+                continue
+            (stage, table) = (dict(labels)['stage'], dict(labels)['table'])
+            if not durations.get(stage):
+                continue
+            unit = name.split('_')[0]
+            rates.setdefault((stage, table), {})[f'{unit}_per_second'] = \
+                value / durations[stage]
+        return rates
+
+    def to_prometheus(self, const_labels=()):
+        '''Format all values in the Prometheus text exposition format.
+
+        >>> m = Metrics('tx')
+        >>> m.inc('rows_total', 100, table='transaction')
+        >>> print(m.to_prometheus((('keyspace', 'btc_raw'),)), end='')
+        # HELP graphsense_export_rows_total Rows written per table
+        # TYPE graphsense_export_rows_total counter
+        graphsense_export_rows_total{keyspace="btc_raw",stage="tx",\
+table="transaction"} 100
+        '''
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name in sorted(set(name for (name, _) in values)):
+            (metric_type, help_text) = METRIC_TYPES[name]
+            metric = METRIC_PREFIX + name
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+            for ((key_name, labels), value) in sorted(values.items()):
+                if key_name != name:
+                    continue
+                labels = tuple(const_labels) + labels
+                if metric_type != 'histogram':
+                    lines.append(f'{metric}{format_labels(labels)} {value}')
+                    continue
+                for (bound, count) in value.cumulative():
+                    bucket_labels = format_labels(labels + (('le', bound),))
+                    lines.append(f'{metric}_bucket{bucket_labels} {count}')
+                lines.append(f'{metric}_sum{format_labels(labels)} '
+                             f'{value.sum}')
+                lines.append(f'{metric}_count{format_labels(labels)} '
+                             f'{value.count}')
+        return ''.join(line + '\n' for line in lines)
+
+    def to_json(self, const_labels=()):
+        with self.lock:
+            values = dict(self.values)
+        metrics = {}
+        for ((name, labels), value) in sorted(values.items()):
+            entry = dict(tuple(const_labels) + labels)
+            if isinstance(value, Histogram):
+                entry.update(buckets=dict(value.cumulative()),
+                             sum=value.sum, count=value.count)
+            else:
+                entry['value'] = value
+            metrics.setdefault(METRIC_PREFIX + name, []).append(entry)
+        metrics[METRIC_PREFIX + 'rates'] = [
+            dict(tuple(const_labels), stage=stage, table=table, **rates)
+            for ((stage, table), rates) in sorted(self.rates().items())]
+        return json.dumps(metrics, indent=2) + '\n'
+
+    def write(self):
+        '''Write all values to a JSON file (`.json` extension) or to a
+        Prometheus textfile, replacing the file atomically.'''
+        if self.file_name.endswith('.json'):
+            content = self.to_json(self.const_labels)
+        else:
+            content = self.to_prometheus(self.const_labels)
+        tmp_file_name = f'{self.file_name}.{os.getpid()}.tmp'
+        with open(tmp_file_name, 'w') as fh:
+            fh.write(content)
+        os.replace(tmp_file_name, self.file_name)
+
+    def print_rates(self):
+        for ((stage, table), rates) in sorted(self.rates().items()):
+            print(f'{stage:<10} {table:<26} '
+                  f'{rates["rows_per_second"]:>12,.0f} rows/s '
+                  f'{rates["bytes_per_second"] / 1e6:>10,.2f} MB/s')
+
+
+# metrics of the current process; reset in every worker process
+METRICS = Metrics()
+
+
+def report_progress(counter, count, unit, every=1e4, sink=None):
+    '''Add to a shared counter and print the total whenever it crosses a
+    multiple of `every`, followed by the write limits of sink.'''
+    with counter.get_lock():
+        previous = counter.value
+        counter.value += count
+        total = counter.value
+    if previous // every != total // every:
+        status = sink.status() if sink is not None else ''
+        print(f'#{unit} {total:,.0f}' + (f' ({status})' if status else ''))
+
+
+def work_unit_blocks(params):
+    '''Return the block range [start, end) of the parameters of a work unit,
+    or None for work units not given by block heights.
+
+    >>> work_unit_blocks((100, 200, 5000, 9000))
+    (100, 200)
+    >>> work_unit_blocks(799)
+    (799, 800)
+    >>> work_unit_blocks(('block', 3, 300, 400, False)) is None
+    True
+    '''
+
+    if isinstance(params, int):
+        return (params, params + 1)
+    if all(isinstance(x, int) for x in params[:2]):
+        return tuple(params[:2])
+    return None
+
+
+class Profiler:
+    '''Profiles of the work units of every stage, in all worker processes.
+
+    With mode "deterministic", work units are run under cProfile; with mode
+    "sampling", the stack of the worker is sampled every `interval` seconds
+    of CPU time. Only work units overlapping the block window [start, end)
+    are profiled, all of them without a window. Workers accumulate one
+    profile per stage and write it to `directory/workers` after every
+    profiled work unit; `report()` merges the profiles of all workers into
+    one report per stage.
+    '''
+
+    MODES = ('deterministic', 'sampling')
+
+    def __init__(self, directory, mode='deterministic', window=None,
+                 interval=0.005):
+        self.directory = directory
+        self.mode = mode
+        self.window = window
+        self.interval = interval
+        self.profiles = {}
+        self.samples = None
+        # remove profiles of earlier runs
+        os.makedirs(self.worker_dir, exist_ok=True)
+        for file_name in os.listdir(self.worker_dir):
+            os.remove(os.path.join(self.worker_dir, file_name))
+
+    @property
+    def worker_dir(self):
+        return os.path.join(self.directory, 'workers')
+
+    def covers(self, params):
+        if self.window is None:
+            return True
+        blocks = work_unit_blocks(params)
+        return (blocks is not None and blocks[0] < self.window[1] and
+                self.window[0] < blocks[1])
+
+    def run(self, stage, fun, params):
+        '''Run fun on a work unit and add it to the profile of its stage.'''
+        file_name = os.path.join(self.worker_dir, f'{stage}.{os.getpid()}')
+        if self.mode == 'deterministic':
+            profile = self.profiles.setdefault(stage, cProfile.Profile())
+            profile.enable()
+            try:
+                return fun(params)
+            finally:
+                profile.disable()
+                profile.dump_stats(file_name + '.prof')
+
+        self.samples = self.profiles.setdefault(stage, Counter())
+        handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            return fun(params)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, handler)
+            with open(file_name + '.folded', 'w') as fh:
+                fh.writelines(f'{stack} {count}\n'
+                              for (stack, count) in self.samples.items())
+
+    def sample(self, signum, frame):
+        # frames of this worker below run(), outermost first
+        stack = []
+        while frame is not None and frame.f_code is not Profiler.run.__code__:
+            code = frame.f_code
+            stack.append(f'{code.co_name} '
+                         f'({os.path.basename(code.co_filename)}:'
+                         f'{code.co_firstlineno})')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        '''Merge the profiles of all workers, per stage.
+
+        Writes STAGE.prof (pstats) and STAGE.txt (functions by cumulative
+        time) for deterministic profiles, or STAGE.folded (collapsed stacks
+        for flame graph tools) for sampled ones.'''
+        stages = {}
+        for file_name in sorted(os.listdir(self.worker_dir)):
+            (stage, _, extension) = file_name.split('.')
+            stages.setdefault((stage, extension), []).append(
+                os.path.join(self.worker_dir, file_name))
+        for ((stage, extension), files) in sorted(stages.items()):
+            base_name = os.path.join(self.directory, stage)
+            if extension == 'prof':
+                pstats.Stats(*files).dump_stats(base_name + '.prof')
+                with open(base_name + '.txt', 'w') as fh:
+                    stats = pstats.Stats(*files, stream=fh)
+                    stats.sort_stats('cumulative').print_stats(50)
+            else:
+                samples = Counter()
+                for file_name in files:
+                    with open(file_name) as fh:
+                        for line in fh:
+                            (stack, count) = line.rsplit(' ', 1)
+                            samples[stack] += int(count)
+                with open(base_name + '.folded', 'w') as fh:
+                    fh.writelines(f'{stack} {count}\n' for (stack, count)
+                                  in sorted(samples.items()))
+            print(f'Profile of stage {stage}: {base_name}.{extension}')
+
+
+class Sink(ABC):
+    '''Destination for the rows produced by the table builders.'''
+
+    def write(self, table, rows):
+        sizes = [row_size(row) for row in rows]
+        METRICS.record_rows(table, sizes)
+        self.write_rows(table, rows, sizes)
+
+    def write_rows(self, table, rows, sizes):
+        pass
+
+    def flush(self):
+        pass
+
+    def ledger(self):
+        return NullLedger()
+
+    def status(self):
+        '''Return the current write limits for progress output.'''
+        return ''
+
+    def configuration(self, keyspace):
+        '''Return the partitioning parameters recorded by an earlier export,
+        or None.'''
+        return None
+
+    def tx_io_encoding(self):
+        '''Return the encoding of tx inputs and outputs expected by the
+        destination ('udt' or 'compact'), or None if any is accepted.'''
+        return None
+
+    def has_table(self, table):
+        return True
+
+    def has_column(self, table, column):
+        return True
+
+    def close(self):
+        self.flush()
+
+
+def backoff_delay(attempt, base_delay=0.1, max_delay=30.0):
+    '''Return the exponential backoff delay in seconds before a retry.
+
+    >>> [backoff_delay(i) for i in range(4)]
+    [0.1, 0.2, 0.4, 0.8]
+
+    >>> backoff_delay(20)
+    30.0
+    '''
+
+    return min(max_delay, base_delay * 2 ** attempt)
+
+
+class RetryQueue:
+    '''Rows waiting for re-submission, ordered by the time they are due.'''
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, table, row, attempt):
+        due = time.monotonic() + backoff_delay(attempt)
+        heapq.heappush(self.heap, (due, self.seq, table, row, attempt))
+        self.seq += 1
+
+    def pop_due(self):
+        '''Remove and return all entries whose retry is due.'''
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            (_, _, table, row, attempt) = heapq.heappop(self.heap)
+            due.append((table, row, attempt))
+        return due
+
+    def next_delay(self):
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+
+def journal_encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'blob': value.hex()}
+    if isinstance(value, np.integer):
+        return int(value)
+    raise TypeError(f'Cannot encode {type(value)}')
+
+
+def journal_decode(obj):
+    if list(obj) == ['blob']:
+        return bytearray.fromhex(obj['blob'])
+    return obj
+
+
+class FailureJournal:
+    '''Record rows that could not be written as JSON lines.
+
+    Each process appends to its own file in the journal directory; the file
+    is only created once the first row has failed permanently. Rows are
+    appended both from the writing thread and from the driver's event loop
+    thread.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fh = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, table, row, exc):
+        entry = {'table': table, 'row': row, 'error': str(exc)}
+        line = json.dumps(entry, default=journal_encode) + '\n'
+        with self.lock:
+            if self.fh is None:
+                os.makedirs(self.directory, exist_ok=True)
+                file_name = f'failures-{os.getpid()}-{time.time_ns()}.jsonl'
+                self.fh = open(os.path.join(self.directory, file_name), 'a')
+            self.fh.write(line)
+            self.fh.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+    @staticmethod
+    def files(directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, x) for x in os.listdir(directory)
+                      if x.startswith('failures-') and x.endswith('.jsonl'))
+
+    @staticmethod
+    def read(file_name):
+        '''Yield (table, row) pairs from a journal file.'''
+        with open(file_name) as fh:
+            for line in fh:
+                entry = json.loads(line, object_hook=journal_decode)
+                yield (entry['table'], entry['row'])
+
+
+class BatchSizeController:
+    '''Adapt the byte limit of write batches: grow it additively while
+    batches succeed within the latency target, halve it when a batch fails
+    or is slow.
+
+    >>> c = BatchSizeController(16384, minimum=1024, maximum=65536)
+    >>> c.on_success(0.01); c.limit
+    20480
+    >>> c.on_success(10.0); c.limit
+    10240
+    >>> c.on_failure(); c.on_failure(); c.on_failure(); c.on_failure()
+    >>> c.limit
+    1024
+    '''
+
+    def __init__(self, limit, minimum=1024, maximum=1024 ** 2, step=4096,
+                 latency_target=0.2):
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.latency_target = latency_target
+
+    def on_success(self, latency):
+        if latency > self.latency_target:
+            self.decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + self.step)
+
+    def on_failure(self):
+        self.decrease()
+
+    def decrease(self):
+        self.limit = max(self.minimum, self.limit // 2)
+
+
+class ConcurrencyController:
+    '''Adapt the limit of in-flight requests (AIMD): after every window of
+    `limit` completed requests, raise it by one while the window's 99th
+    percentile latency stays within the latency target, and lower it by a
+    tenth otherwise. Timeouts and overload errors halve it, at most once per
+    window, as the requests in flight at that time tend to fail together.
+
+    >>> c = ConcurrencyController(20, maximum=100, latency_target=0.1)
+    >>> for _ in range(20): c.on_success(0.01)
+    >>> (c.limit, c.p99)
+    (21, 0.01)
+    >>> c.on_overload(); c.on_overload(); c.limit
+    10
+    >>> for _ in range(20): c.on_success(0.5)
+    >>> c.limit
+    9
+    >>> fixed = ConcurrencyController(50)
+    >>> fixed.on_overload(); fixed.limit
+    50
+    '''
+
+    min_window = 20
+
+    def __init__(self, limit, minimum=None, maximum=None,
+                 latency_target=0.5):
+        self.limit = limit
+        # without bounds, the limit is fixed
+        self.minimum = limit if minimum is None and maximum is None \
+            else minimum or 1
+        self.maximum = maximum or limit
+        self.latency_target = latency_target
+        self.latencies = []
+        self.completed = 0
+        self.backed_off = False
+        self.p99 = None
+
+    @property
+    def adaptive(self):
+        return self.minimum != self.maximum
+
+    def on_success(self, latency):
+        self.latencies.append(latency)
+        self.complete()
+
+    def on_overload(self):
+        if not self.backed_off:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.backed_off = True
+        self.complete()
+
+    def complete(self):
+        self.completed += 1
+        if self.completed < max(self.limit, self.min_window):
+            return
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            self.p99 = latencies[int(0.99 * (len(latencies) - 1))]
+        if self.p99 is not None and self.p99 > self.latency_target:
+            self.limit = max(self.minimum,
+                             self.limit - max(1, self.limit // 10))
+        elif not self.backed_off:
+            self.limit = min(self.maximum, self.limit + 1)
+        self.latencies = []
+        self.completed = 0
+        self.backed_off = False
+
+
+class CassandraSink(Sink):
+    '''Write rows to Cassandra using prepared INSERT statements.
+
+    Statements are executed asynchronously, keeping at most `concurrency`
+    requests in flight, so that extraction continues while earlier rows are
+    still being written. With `max_concurrency`, the limit adapts between 1
+    and `max_concurrency` to the observed latency and to timeouts (see
+    ConcurrencyController). Failed writes are re-submitted with exponential
+    backoff from the writing thread; rows still failing after `max_retries`
+    attempts are recorded in the failure journal.
+
+    If `max_batch_bytes` is set, rows of BATCH_TABLES are collected per
+    partition and written in UNLOGGED batches, whose size limit adapts to
+    the observed batch latency and failures. Rows of a failed batch are
+    retried individually.
+
+    Independent of the number of requests, the estimated size of in-flight
+    rows and unsent batches is kept within `max_in_flight_bytes`. Rows
+    larger than half of `max_mutation_bytes` are reported; rows exceeding
+    it would be rejected by Cassandra and are journaled right away.
+    '''
+
+    def __init__(self, cluster, keyspace, concurrency=100,
+                 journal_dir='failed_writes', max_retries=10,
+                 max_batch_bytes=None, max_concurrency=None,
+                 latency_target=0.5, max_in_flight_bytes=MEMORY_BUDGET,
+                 max_mutation_bytes=MAX_MUTATION_BYTES):
+        self.cluster = cluster
+        self.own_cluster = False
+        self.concurrency = ConcurrencyController(
+            concurrency, maximum=max_concurrency,
+            latency_target=latency_target)
+        self.max_retries = max_retries
+        self.session = cluster.connect(keyspace)
+        self.session.default_timeout = 60
+        self.prepared_stmts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.in_flight_bytes = 0
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_in_flight_bytes_seen = 0
+        self.max_mutation_bytes = max_mutation_bytes
+        self.in_flight_cond = threading.Condition()
+        self.retries = RetryQueue()
+        self.journal = FailureJournal(journal_dir)
+        self.batch_size = None
+        if max_batch_bytes:
+            self.batch_size = BatchSizeController(
+                min(16 * 1024, max_batch_bytes), maximum=max_batch_bytes)
+        # rows and estimated size of unsent batches per (table, partition)
+        self.batches = {}
+        self.batched_bytes = 0
+
+    @classmethod
+    def connect(cls, cluster_factory, *args, **kwargs):
+        '''Return a sink on a cluster of its own, shut down with the sink.
+
+        Every process needs its own cluster: the driver threads of a
+        cluster connected before the worker pool is forked do not exist in
+        the workers, and connecting it there waits for them forever.
+        '''
+        sink = cls(cluster_factory(), *args, **kwargs)
+        sink.own_cluster = True
+        return sink
+
+    def prepared_stmt(self, table):
+        if table not in self.prepared_stmts:
+            self.prepared_stmts[table] = self.session.prepare(
+                insert_cql(table))
+        return self.prepared_stmts[table]
+
+    def write_rows(self, table, rows, sizes):
+        batched = self.batch_size is not None and table in BATCH_TABLES
+        for (row, size) in zip(rows, sizes):
+            if size > self.max_mutation_bytes // 2 and \
+                    self.oversized(table, row, size):
+                continue
+            if batched:
+                self.add_to_batch(table, row, size)
+            else:
+                self.execute_async(table, row, size=size)
+        self.resubmit_due()
+
+    def oversized(self, table, row, size):
+        '''Report a row near the mutation size limit; return True if it
+        exceeds the limit and has been journaled instead.'''
+        METRICS.inc('large_rows_total', table=table)
+        key = {x: row[TABLE_COLUMNS[table].index(x)]
+               for x in PRIMARY_KEYS[table]}
+        if size <= self.max_mutation_bytes:
+            print(f'Warning: {table} row {key} has about {size:,} bytes, '
+                  f'close to the mutation size limit')
+            return False
+        print(f'Error: {table} row {key} has about {size:,} bytes, more '
+              f'than the mutation size limit; journaling it')
+        self.journal.append(table, row, f'row of about {size:,} bytes '
+                                        f'exceeds the mutation size limit')
+        METRICS.inc('failed_rows_total', table=table)
+        return True
+
+    def acquire(self, size):
+        '''Wait until another request of size bytes may be in flight; a
+        single request larger than the byte budget is sent on its own.'''
+        with self.in_flight_cond:
+            while self.in_flight >= self.concurrency.limit or (
+                    self.in_flight and
+                    self.in_flight_bytes + size > self.max_in_flight_bytes):
+                self.in_flight_cond.wait()
+            self.in_flight += 1
+            self.in_flight_bytes += size
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.max_in_flight_bytes_seen = max(
+                self.max_in_flight_bytes_seen, self.in_flight_bytes)
+
+    def release(self, size):
+        # called with in_flight_cond held
+        self.in_flight -= 1
+        self.in_flight_bytes -= size
+        self.in_flight_cond.notify_all()
+
+    @staticmethod
+    def bind_params(row):
+        # leave null columns unset, which avoids writing tombstones
+        return [UNSET_VALUE if x is None else x for x in row]
+
+    def execute_async(self, table, row, attempt=0, size=None):
+        if size is None:
+            size = row_size(row)
+        prepared_stmt = self.prepared_stmt(table)
+        self.acquire(size)
+        future = self.session.execute_async(prepared_stmt,
+                                            self.bind_params(row))
+        future.add_callbacks(self.on_success, self.on_error,
+                             callback_args=(table, time.perf_counter(), size),
+                             errback_args=(table, row, attempt, size))
+
+    def add_to_batch(self, table, row, size):
+        key = (table, row[0])
+        batch = self.batches.get(key)
+        if batch is not None and batch[1] + size > self.batch_size.limit:
+            self.send_batch(key)
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = [[], 0]
+        batch[0].append(row)
+        batch[1] += size
+        self.batched_bytes += size
+        if self.batched_bytes > self.max_in_flight_bytes // 2:
+            # send the largest unsent batches instead of buffering more
+            for key in sorted(self.batches, key=lambda x: self.batches[x][1],
+                              reverse=True):
+                self.send_batch(key)
+                if self.batched_bytes <= self.max_in_flight_bytes // 4:
+                    break
+
+    def send_batch(self, key):
+        (rows, size) = self.batches.pop(key)
+        self.batched_bytes -= size
+        self.execute_batch_async(key[0], rows, size)
+
+    def execute_batch_async(self, table, rows, size):
+        if len(rows) == 1:
+            self.execute_async(table, rows[0], size=size)
+            return
+        prepared_stmt = self.prepared_stmt(table)
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for row in rows:
+            batch.add(prepared_stmt, self.bind_params(row))
+        self.acquire(size)
+        future = self.session.execute_async(batch)
+        future.add_callbacks(self.on_batch_success, self.on_batch_error,
+                             callback_args=(table, time.perf_counter(), size),
+                             errback_args=(table, rows, size))
+
+    def on_batch_success(self, _result, table, start, size):
+        latency = time.perf_counter() - start
+        METRICS.observe('write_latency_seconds', latency, table=table)
+        with self.in_flight_cond:
+            self.batch_size.on_success(latency)
+            self.concurrency.on_success(latency)
+            self.release(size)
+
+    def on_batch_error(self, exc, table, rows, size):
+        # retry the rows individually, so that a single oversized or
+        # failing row does not fail the whole partition again
+        with self.in_flight_cond:
+            self.batch_size.on_failure()
+            if isinstance(exc, OVERLOAD_ERRORS):
+                self.concurrency.on_overload()
+            for row in rows:
+                self.retries.push(table, row, 0)
+            METRICS.inc('retries_total', len(rows), table=table)
+            self.release(size)
+
+    def on_success(self, _result, table, start, size):
+        latency = time.perf_counter() - start
+        METRICS.observe('write_latency_seconds', latency, table=table)
+        with self.in_flight_cond:
+            self.concurrency.on_success(latency)
+            self.release(size)
+
+    def on_error(self, exc, table, row, attempt, size):
+        # runs in the driver's event loop thread, so rows are only queued
+        # here and re-submitted by the writing thread
+        with self.in_flight_cond:
+            if isinstance(exc, OVERLOAD_ERRORS):
+                self.concurrency.on_overload()
+            if attempt < self.max_retries:
+                self.retries.push(table, row, attempt)
+                METRICS.inc('retries_total', table=table)
+            else:
+                print(f'Giving up on {table} row after {attempt + 1} '
+                      f'attempts: {exc}')
+                self.journal.append(table, row, exc)
+                METRICS.inc('failed_rows_total', table=table)
+            self.release(size)
+
+    def resubmit_due(self):
+        with self.in_flight_cond:
+            due = self.retries.pop_due()
+        for (table, row, attempt) in due:
+            self.execute_async(table, row, attempt + 1)
+
+    def flush(self):
+        for key in list(self.batches):
+            self.send_batch(key)
+        while True:
+            self.resubmit_due()
+            with self.in_flight_cond:
+                if self.in_flight == 0 and len(self.retries) == 0:
+                    break
+                self.in_flight_cond.wait(self.retries.next_delay())
+        if self.max_in_flight:
+            METRICS.gauge('in_flight_max', self.max_in_flight)
+            METRICS.gauge('in_flight_bytes_max', self.max_in_flight_bytes_seen)
+            self.max_in_flight = 0
+            self.max_in_flight_bytes_seen = 0
+        if self.batch_size is not None:
+            METRICS.gauge('batch_limit_bytes', self.batch_size.limit)
+        METRICS.gauge('concurrency_limit', self.concurrency.limit)
+
+    def status(self):
+        status = (f'{self.in_flight} of {self.concurrency.limit} in flight, '
+                  f'{self.in_flight_bytes / 2**20:,.1f} MiB')
+        if self.concurrency.p99 is not None:
+            status += f', p99 {self.concurrency.p99 * 1e3:.0f} ms'
+        if self.batch_size is not None:
+            status += f', batch limit {self.batch_size.limit:,} B'
+        return status
+
+    def ledger(self):
+        keyspace = self.cluster.metadata.keyspaces[self.session.keyspace]
+        if 'export_progress' not in keyspace.tables:
+            print('Warning: table export_progress does not exist, '
+                  'progress will not be recorded')
+            return NullLedger()
+        return CassandraLedger(self.session)
+
+    def configuration(self, keyspace):
+        columns = ', '.join(PARTITIONING_DEFAULTS)
+        result = self.session.execute(
+            f'SELECT {columns} FROM configuration WHERE id=%s', [keyspace])
+        for row in result:
+            return dict(zip(PARTITIONING_DEFAULTS, row))
+        return None
+
+    def tx_io_encoding(self):
+        keyspace = self.cluster.metadata.keyspaces[self.session.keyspace]
+        table = keyspace.tables.get('transaction')
+        if table is None:
+            return None
+        # see schema_compact.cql
+        return 'compact' if table.columns['inputs'].cql_type == 'blob' \
+            else 'udt'
+
+    def has_table(self, table):
+        keyspace = self.cluster.metadata.keyspaces[self.session.keyspace]
+        return table in keyspace.tables
+
+    def has_column(self, table, column):
+        keyspace = self.cluster.metadata.keyspaces[self.session.keyspace]
+        return table in keyspace.tables and \
+            column in keyspace.tables[table].columns
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        self.session.shutdown()
+        if self.own_cluster:
+            self.cluster.shutdown()
+
+
+class FileSink(Sink):
+    '''Buffer rows per table and write them to files below OUTPUT_DIR.
+
+    Every flush writes a new file per table, named after the writing process
+    and a running counter, so that concurrent workers never share a file.
+    A table is flushed once it buffers `buffer_size` rows, and the largest
+    buffers once all buffers hold more than `max_buffer_bytes`.
+    '''
+
+    def __init__(self, output_dir, buffer_size=100_000,
+                 max_buffer_bytes=MEMORY_BUDGET):
+        self.output_dir = output_dir
+        self.buffer_size = buffer_size
+        self.max_buffer_bytes = max_buffer_bytes
+        self.buffers = {}
+        # estimated size of the rows in every buffer
+        self.buffer_bytes = {}
+        self.file_count = 0
+
+    def file_name(self, extension):
+        return f'part-{os.getpid()}-{self.file_count}.{extension}'
+
+    def ledger(self):
+        return FileLedger(os.path.join(self.output_dir, '_progress.jsonl'))
+
+    def write_rows(self, table, rows, sizes):
+        buffer = self.buffers.setdefault(table, [])
+        buffer.extend(rows)
+        self.buffer_bytes[table] = self.buffer_bytes.get(table, 0) + sum(sizes)
+        if len(buffer) >= self.buffer_size:
+            self.flush_table(table)
+        while sum(self.buffer_bytes.values()) > self.max_buffer_bytes:
+            self.flush_table(max(self.buffer_bytes,
+                                 key=self.buffer_bytes.get))
+
+    def flush_table(self, table):
+        self.buffer_bytes.pop(table, None)
+        rows = self.buffers.pop(table, None)
+        if not rows:
+            return
+        table_dir = os.path.join(self.output_dir, table)
+        os.makedirs(table_dir, exist_ok=True)
+        start = time.perf_counter()
+        self.write_file(table, table_dir, rows)
+        METRICS.observe('write_latency_seconds', time.perf_counter() - start,
+                        table=table)
+        self.file_count += 1
+
+    def write_file(self, table, table_dir, rows):
+        pass
+
+    def flush(self):
+        for table in list(self.buffers):
+            self.flush_table(table)
+
+
+class ParquetSink(FileSink):
+    '''Write rows to Parquet files, partitioned like the Cassandra tables.
+
+    Files are written to `OUTPUT_DIR/<table>/<partition column>=<value>/`,
+    so that the output can be loaded by Spark as Hive-partitioned datasets.
+    '''
+
+    def __init__(self, output_dir, buffer_size=100_000,
+                 max_buffer_bytes=MEMORY_BUDGET, compact_tx_io=False):
+        if pa is None:
+            raise RuntimeError('Parquet output requires the pyarrow package')
+        super().__init__(output_dir, buffer_size, max_buffer_bytes)
+        self.compact_tx_io = compact_tx_io
+
+    def schema(self, table):
+        schema = ARROW_SCHEMAS[table]
+        if self.compact_tx_io and table == 'transaction':
+            for name in ('inputs', 'outputs'):
+                schema = schema.set(schema.get_field_index(name),
+                                    pa.field(name, pa.binary()))
+        return schema
+
+    def write_file(self, table, table_dir, rows):
+        columns = TABLE_COLUMNS[table]
+        schema = self.schema(table)
+        arrays = [pa.array([row[i] for row in rows], schema.field(name).type)
+                  for (i, name) in enumerate(columns)]
+        partition_col = PARTITION_COLUMNS.get(table)
+        pq.write_to_dataset(
+            pa.Table.from_arrays(arrays, schema=schema),
+            table_dir,
+            partition_cols=[partition_col] if partition_col else None,
+            basename_template=self.file_name('{i}.parquet'))
+
+
+class CsvSink(FileSink):
+    '''Write rows to CSV files that can be bulk-loaded into Cassandra.
+
+    Each flushed file is sorted by primary key, so that rows of the same
+    partition are adjacent. Files have a header row; blobs are written as
+    `0x`-prefixed hex strings and collections of user-defined types as JSON,
+    as expected by DataStax Bulk Loader (`dsbulk load -header true`).
+    '''
+
+    def write_file(self, table, table_dir, rows):
+        key_length = len(PRIMARY_KEYS[table])
+        rows.sort(key=lambda row: tuple(row[:key_length]))
+        columns = TABLE_COLUMNS[table]
+        with open(os.path.join(table_dir, self.file_name('csv')), 'w',
+                  newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([csv_value(value, UDT_FIELDS.get(name))
+                                 for (name, value) in zip(columns, row)])
+
+
+if pa is not None:
+    TX_IO_TYPE = pa.list_(pa.struct([('address', pa.list_(pa.string())),
+                                     ('value', pa.int64()),
+                                     ('address_type', pa.int16())]))
+    TX_SUMMARY_TYPE = pa.list_(pa.struct([('tx_id', pa.int64()),
+                                          ('no_inputs', pa.int32()),
+                                          ('no_outputs', pa.int32()),
+                                          ('total_input', pa.int64()),
+                                          ('total_output', pa.int64())]))
+    ARROW_SCHEMAS = {
+        'block': pa.schema([('block_id_group', pa.int32()),
+                            ('block_id', pa.int32()),
+                            ('block_hash', pa.binary()),
+                            ('timestamp', pa.int32()),
+                            ('no_transactions', pa.int32())]),
+        'transaction': pa.schema([('tx_id_group', pa.int32()),
+                                  ('tx_id', pa.int64()),
+                                  ('tx_hash', pa.binary()),
+                                  ('block_id', pa.int32()),
+                                  ('timestamp', pa.int32()),
+                                  ('coinbase', pa.bool_()),
+                                  ('total_input', pa.int64()),
+                                  ('total_output', pa.int64()),
+                                  ('inputs', TX_IO_TYPE),
+                                  ('outputs', TX_IO_TYPE),
+                                  ('coinjoin', pa.bool_())]),
+        'transaction_by_tx_prefix': pa.schema([('tx_prefix', pa.string()),
+                                               ('tx_hash', pa.binary()),
+                                               ('tx_id', pa.int64())]),
+        'block_transactions': pa.schema([('block_id_group', pa.int32()),
+                                         ('block_id', pa.int32()),
+                                         ('txs', TX_SUMMARY_TYPE)]),
+        'summary_statistics': pa.schema([('id', pa.string()),
+                                         ('timestamp', pa.int32()),
+                                         ('no_blocks', pa.int32()),
+                                         ('no_txs', pa.int64())]),
+        'configuration': pa.schema([('id', pa.string()),
+                                    ('block_bucket_size', pa.int32()),
+                                    ('tx_prefix_length', pa.int32()),
+                                    ('tx_bucket_size', pa.int32()),
+                                    ('address_prefix_length', pa.int32())]),
+        'transaction_coinjoin': pa.schema([('tx_id_group', pa.int32()),
+                                           ('tx_id', pa.int64()),
+                                           ('coinjoin', pa.bool_())]),
+        'address_transactions': pa.schema([('address_prefix', pa.string()),
+                                           ('address', pa.string()),
+                                           ('tx_id', pa.int64()),
+                                           ('is_outgoing', pa.bool_()),
+                                           ('value', pa.int64())]),
+        'daily_statistics': pa.schema(
+            [('date', pa.string())] +
+            [(x, pa.int64()) for x in AGGREGATE_COLUMNS]),
+        'block_group_statistics': pa.schema(
+            [('block_id_group', pa.int32())] +
+            [(x, pa.int64()) for x in AGGREGATE_COLUMNS])
+    }
+
+
+class WorkerPool:
+    '''Worker processes shared by all stages of a run.
+
+    Every worker sets up the chain, its sink (with its session and prepared
+    statements) and the progress ledger once; work units are sent together
+    with the query manager function and the settings of their stage. With
+    num_proc 0, work units are run in this process.
+    '''
+
+    def __init__(self, sink_factory, chain, num_proc=1, batch_size=100,
+                 config_file=None, profiler=None):
+        self.chain = chain
+        self.profiler = profiler
+        init_args = (sink_factory, chain, batch_size, config_file, profiler)
+        if num_proc == 0:
+            self.pool = None
+            QueryManager._setup(*init_args)
+        else:
+            self.pool = Pool(processes=num_proc,
+                             initializer=QueryManager._init_worker,
+                             initargs=init_args)
+
+    def reload(self, chain):
+        '''Make workers reload the chain before their next work unit.'''
+        self.chain = chain
+        if self.pool is None:
+            QueryManager.chain = chain
+
+    def imap(self, fun, work_units, settings):
+        tasks = ((fun, settings, len(self.chain), x) for x in work_units)
+        if self.pool is None:
+            return map(run_work_unit, tasks)
+        # work units are taken from a shared queue as workers become idle
+        return self.pool.imap_unordered(run_work_unit, tasks)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.profiler is not None:
+            self.profiler.report()
+
+
+def run_work_unit(task):
+    '''Run a query manager function on a work unit in a pool worker.'''
+    (fun, settings, chain_length, params) = task
+    QueryManager.refresh_chain(chain_length)
+    METRICS.stage = settings.stages[0]
+    fun = partial(fun, settings=settings)
+    profiler = QueryManager.profiler
+    if profiler is None or not profiler.covers(params):
+        return fun(params)
+    return profiler.run(METRICS.stage, fun, params)
+
+
 class QueryManager(ABC):
 
     counter = Value('d', 0)
+    # settings of a stage; its options override them
+    defaults = {'stages': (),
+                'checkpoint_interval': 100,
+                'ledger': None,
+                **PARTITIONING_DEFAULTS}
+
+    def __init__(self, pool, **options):
+        unknown = sorted(set(options) - set(self.defaults))
+        if unknown:
+            raise TypeError(f'{type(self).__name__} got unknown options '
+                            f'{", ".join(unknown)}')
+        # sent along with every work unit of the stage
+        self.settings = Namespace(**{**self.defaults, **options})
+        self.pool = pool
 
-    def __init__(self, cluster, keyspace, chain, cql_str,
-                 num_proc=1, num_chunks=None, concurrency=100):
-        if not num_chunks:
-            num_chunks = num_proc
-        self.num_proc = num_proc
-        self.num_chunks = num_chunks
-        init_args = (cluster, chain, keyspace, cql_str, concurrency)
-        self.pool = Pool(processes=num_proc,
-                         initializer=self._setup,
-                         initargs=init_args)
+    @classmethod
+    def _init_worker(cls, *init_args):
+        # workers outlive stages; the parent handles interrupts and stops
+        # them after the current work units
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        cls._setup(*init_args)
+        # discard metrics inherited from the parent process
+        METRICS.drain()
 
     @classmethod
-    def _setup(cls, cluster, chain, keyspace, cql_str, concurrency):
-        cls.chain = chain
-        cls.concurrency = concurrency
-        cls.session = cluster.connect()
-        cls.session.default_timeout = 60
-        cls.session.set_keyspace(keyspace)
-        cls.prepared_stmt = cls.session.prepare(cql_str)
-
-    def close_pool(self):
-        self.pool.close()
-        self.pool.join()
+    def _setup(cls, sink_factory, chain, batch_size, config_file=None,
+               profiler=None):
+        # shared by the query managers of all stages
+        QueryManager.chain = chain
+        QueryManager.config_file = config_file
+        QueryManager.batch_size = batch_size
+        QueryManager.profiler = profiler
+        QueryManager.sink = sink_factory()
+        QueryManager.ledger = QueryManager.sink.ledger()
+
+    @staticmethod
+    def refresh_chain(chain_length):
+        '''Reload the chain of this worker if it has changed.'''
+        if len(QueryManager.chain) != chain_length:
+            QueryManager.chain = reload_chain(QueryManager.chain,
+                                              QueryManager.config_file)
 
     @timing
-    def execute(self, fun, params):
-        self.pool.map(fun, chunk(params, self.num_chunks))
+    def execute(self, fun, work_units):
+        # each work unit returns the metrics its worker collected meanwhile
+        for metrics in self.pool.imap(fun, work_units, self.settings):
+            METRICS.merge(metrics)
+
+    @classmethod
+    def checkpoint(cls, settings, block_start, block_end, watermark):
+        '''Wait for all pending writes, then record the watermark.'''
+        cls.sink.flush()
+        ledger = cls.ledger if settings.ledger is None else settings.ledger
+        for stage in settings.stages:
+            ledger.checkpoint(stage, block_start, block_end, watermark)
 
     @classmethod
-    def insert(cls, params):
+    def insert(cls, params, settings):
         pass
 
 
 class TxQueryManager(QueryManager):
+    '''Write the transaction and transaction_by_tx_prefix tables in a single
+    pass over the tx range, optionally including block_transactions and
+    address_transactions; with txs False, only the latter.'''
 
     counter = Value('d', 0)
+    defaults = dict(QueryManager.defaults,
+                    stages=('tx',),
+                    txs=True,
+                    block_txs=False,
+                    address_txs=False,
+                    deferred_coinjoin=False,
+                    compact_tx_io=False,
+                    cache_size=250_000)
 
     @classmethod
-    def insert(cls, params):
+    def insert(cls, params, settings):
 
-        idx_start, idx_end = params
+        block_start, block_end, idx_start, idx_end = params
+        configure_caches(settings.cache_size)
+
+        # tx stats of the block currently being traversed; work units are
+        # aligned to block boundaries, so every block is complete
+        block_height = None
+        block_tx_stats = None
 
-        param_list = []
+        batches = range(idx_start, idx_end, cls.batch_size)
+        for (batch_no, index) in enumerate(batches, 1):
 
-        for index in range(idx_start, idx_end, cls.concurrency):
+            tx_rows = []
+            lookup_rows = []
+            block_tx_rows = []
+            address_rows = []
 
-            curr_batch_size = min(cls.concurrency, idx_end - index)
+            curr_batch_size = min(cls.batch_size, idx_end - index)
+            start = time.perf_counter()
             for i in range(0, curr_batch_size):
                 tx = blocksci.Tx(index + i, cls.chain)
-                param_list.append(tx_summary(tx))
-
-            results = execute_concurrent_with_args(
-                session=cls.session,
-                statement=cls.prepared_stmt,
-                parameters=param_list,
-                concurrency=cls.concurrency)
-            for (i, (success, _)) in enumerate(results):
-                if not success:
-                    while True:
-                        try:
-                            tx = blocksci.Tx(index + i, cls.chain)
-                            cls.session.execute(cls.prepared_stmt,
-                                                tx_summary(tx))
-                        except Exception as e:
-                            print(e)
-                            continue
-                        break
-
-            param_list = []
-
-            with cls.counter.get_lock():
-                cls.counter.value += curr_batch_size
-            if (cls.counter.value % 1e4) == 0:
-                print(f'#tx {cls.counter.value:,.0f}')
-
-
-class TxLookupQueryManager(QueryManager):
+                ios = tx_io_summaries(tx)
+                if settings.txs:
+                    tx_rows.append(
+                        tx_summary(tx, settings.tx_bucket_size,
+                                   settings.deferred_coinjoin,
+                                   settings.compact_tx_io, ios))
+                    lookup_rows.append(tx_short_summary(
+                        tx.hash, tx.index, settings.tx_prefix_length))
+                if settings.address_txs:
+                    address_rows.extend(address_tx_summaries(
+                        tx.index, *ios, settings.address_prefix_length))
+
+                if not settings.block_txs:
+                    continue
+                if tx.is_coinbase:
+                    if block_tx_stats is not None:
+                        block_tx_rows.append(
+                            block_tx_summary(block_height, block_tx_stats,
+                                             settings.block_bucket_size))
+                    block_height = tx.block_height
+                    block_tx_stats = []
+                block_tx_stats.append(tx_stats(tx))
+            METRICS.observe('extract_seconds', time.perf_counter() - start)
+
+            if settings.txs:
+                cls.sink.write('transaction', tx_rows)
+                cls.sink.write('transaction_by_tx_prefix', lookup_rows)
+            if block_tx_rows:
+                cls.sink.write('block_transactions', block_tx_rows)
+            if address_rows:
+                cls.sink.write('address_transactions', address_rows)
+
+            report_progress(cls.counter, curr_batch_size, 'tx',
+                            sink=cls.sink)
+
+            if batch_no % settings.checkpoint_interval == 0:
+                # all blocks below the one of the last tx are written
+                cls.checkpoint(settings, block_start, block_end,
+                               tx.block_height)
+
+        if block_tx_stats is not None:
+            cls.sink.write('block_transactions',
+                           [block_tx_summary(block_height, block_tx_stats,
+                                             settings.block_bucket_size)])
+
+        cls.checkpoint(settings, block_start, block_end, block_end)
+
+        ADDRESS_CACHE.record_metrics('address')
+        OUTPUT_CACHE.record_metrics('output')
+        return METRICS.drain()
+
+
+class BlockTxQueryManager(QueryManager):
+    '''Write the block_transactions table; batches of blocks are read in
+    parts of at most max_batch_txs txs, so that large blocks do not pile up
+    in memory.'''
+
     counter = Value('d', 0)
+    defaults = dict(QueryManager.defaults,
+                    stages=('block_tx',),
+                    max_batch_txs=MEMORY_BUDGET // (4 * TX_STATS_MEMORY))
 
     @classmethod
-    def insert_lookup_table(cls, params):
+    def insert(cls, params, settings):
+
         idx_start, idx_end = params
 
-        for index in range(idx_start, idx_end, cls.concurrency):
-            param_list = deque()
+        batches = range(idx_start, idx_end, cls.batch_size)
+        for (batch_no, index) in enumerate(batches, 1):
 
-            curr_batch_size = min(cls.concurrency, idx_end - index)
-            for i in range(0, curr_batch_size):
-                t_id = index + i
-                tx = blocksci.Tx(t_id, cls.chain)
-                param_list.append(tx_short_summary(tx.hash, t_id))
-
-            results = execute_concurrent_with_args(
-                session=cls.session,
-                statement=cls.prepared_stmt,
-                parameters=param_list,
-                concurrency=cls.concurrency)
-
-            for (i, (success, _)) in enumerate(results):
-                if not success:
-                    while True:
-                        try:
-                            t_id = index + i
-                            tx = blocksci.Tx(t_id, cls.chain)
-                            cls.session.execute(
-                                cls.prepared_stmt,
-                                tx_short_summary(tx.hash, t_id))
-                        except Exception as e:
-                            print(e)
-                            continue
-                        break
-
-            with cls.counter.get_lock():
-                cls.counter.value += curr_batch_size
-            if (cls.counter.value % 1e4) == 0:
-                print(f'#tx {cls.counter.value:,.0f}')
+            curr_batch_size = min(cls.batch_size, idx_end - index)
+            batch = (index, index + curr_batch_size)
+            tx_counts = cls.chain[batch[0]:batch[1]].tx_count.tolist()
+            for (start, end) in count_intervals(batch, tx_counts,
+                                                settings.max_batch_txs):
+                extract_start = time.perf_counter()
+                rows = block_tx_summaries(cls.chain[start:end],
+                                          settings.block_bucket_size)
+                METRICS.observe('extract_seconds',
+                                time.perf_counter() - extract_start)
+                cls.sink.write('block_transactions', rows)
 
+            report_progress(cls.counter, curr_batch_size, 'blocks',
+                            sink=cls.sink)
 
-class BlockTxQueryManager(QueryManager):
+            if batch_no % settings.checkpoint_interval == 0:
+                cls.checkpoint(settings, idx_start, idx_end,
+                               index + curr_batch_size)
+
+        cls.checkpoint(settings, idx_start, idx_end, idx_end)
+        return METRICS.drain()
+
+
+class BlockQueryManager(QueryManager):
     counter = Value('d', 0)
+    defaults = dict(QueryManager.defaults, stages=('block',))
 
     @classmethod
-    def insert(cls, params):
+    def insert(cls, params, settings):
 
         idx_start, idx_end = params
 
-        param_list = []
+        batches = range(idx_start, idx_end, cls.batch_size)
+        for (batch_no, index) in enumerate(batches, 1):
 
-        for index in range(idx_start, idx_end, cls.concurrency):
+            curr_batch_size = min(cls.batch_size, idx_end - index)
+            start = time.perf_counter()
+            block_range = cls.chain[index:index + curr_batch_size]
+            rows = block_summaries(block_range, settings.block_bucket_size)
+            METRICS.observe('extract_seconds', time.perf_counter() - start)
+            cls.sink.write('block', rows)
 
-            curr_batch_size = min(cls.concurrency, idx_end - index)
-            for i in range(0, curr_batch_size):
-                block = cls.chain[index + i]
-                block_tx = [int(block.height // BLOCK_BUCKET_SIZE),
-                            block.height,
-                            [tx_stats(x) for x in block.txes]]
-                param_list.append(block_tx)
-
-            results = execute_concurrent_with_args(
-                session=cls.session,
-                statement=cls.prepared_stmt,
-                parameters=param_list,
-                concurrency=cls.concurrency)
-
-            for (i, (success, _)) in enumerate(results):
-                if not success:
-                    while True:
-                        try:
-                            block = cls.chain[index + i]
-                            block_tx = [block.height,
-                                        [tx_stats(x) for x in block.txes]]
-                            cls.session.execute(cls.prepared_stmt,
-                                                block_tx)
-                        except Exception as e:
-                            print(e)
-                            continue
-                        break
-
-            param_list = []
-
-            with cls.counter.get_lock():
-                cls.counter.value += curr_batch_size
-
-            if (cls.counter.value % 1e4) == 0:
-                print(f'#blocks {cls.counter.value:,.0f}')
-
-
-@timing
-def insert(cluster, keyspace, cql_stmt, generator, concurrency=100):
-    session = cluster.connect(keyspace)
-    session.default_timeout = 60
-    prepared_stmt = session.prepare(cql_stmt)
-
-    values = take(concurrency, generator)
-    count = 0
-    while values:
-
-        results = execute_concurrent_with_args(
-            session=session,
-            statement=prepared_stmt,
-            parameters=values,
-            concurrency=concurrency)
-
-        for (i, (success, _)) in enumerate(results):
-            if not success:
-                while True:
-                    try:
-                        session.execute(prepared_stmt, values[i])
-                    except Exception as e:
-                        print(e)
-                        continue
-                    break
+            report_progress(cls.counter, curr_batch_size, 'blocks',
+                            sink=cls.sink)
+
+            if batch_no % settings.checkpoint_interval == 0:
+                cls.checkpoint(settings, idx_start, idx_end,
+                               index + curr_batch_size)
+
+        cls.checkpoint(settings, idx_start, idx_end, idx_end)
+        return METRICS.drain()
+
+
+class StatsQueryManager(QueryManager):
+    '''Write the summary statistics, the configuration and the BIP30 fix
+    for the last block of a run.'''
+
+    defaults = dict(QueryManager.defaults,
+                    stages=('stats',),
+                    keyspace=None,
+                    summary_statistics=True,
+                    bip30_fix=False)
+
+    @classmethod
+    def insert(cls, last_height, settings):
+
+        if settings.summary_statistics:
+            insert_summary_stats(cls.sink, settings.keyspace,
+                                 cls.chain[last_height])
+
+        cls.sink.write('configuration',
+                       [(settings.keyspace, settings.block_bucket_size,
+                         settings.tx_prefix_length, settings.tx_bucket_size,
+                         settings.address_prefix_length)])
+
+        # handle BTC duplicate tx_hash issue
+        if settings.bip30_fix:
+            print("Applying fix for BIP30 (duplicate tx hashes)")
+            upsert_btc_duplicate_hashes(cls.sink, settings.tx_prefix_length)
+
+        cls.sink.flush()
+        return METRICS.drain()
 
-        values = take(concurrency, generator)
 
-        if (count % 1e4) == 0:
-            print('#blocks {:,.0f}'.format(count))
-        count += concurrency
+class AggregateQueryManager(QueryManager):
+    '''Write the daily_statistics and block_group_statistics rows of the
+    days and block_id_groups of a block range.
 
+    The aggregates of a work unit are computed from all blocks of its days
+    and groups, read from BlockSci, so that rows are complete (up to the
+    last exported block) and work units touching the same day or group
+    write the same values.
+    '''
+
+    counter = Value('d', 0)
+    defaults = dict(QueryManager.defaults, stages=('aggregates',))
+    chunk_size = 1_000
+
+    @classmethod
+    def insert(cls, params, settings):
+
+        block_start, block_end, limit = params
+        bucket_size = settings.block_bucket_size
+        (low, high) = aggregate_range(cls.chain, block_start, block_end,
+                                      limit, bucket_size)
+
+        days = {}
+        groups = {}
+        touched_days = set()
+        for index in range(low, high, cls.chunk_size):
+            start = time.perf_counter()
+            block_range = cls.chain[index:min(index + cls.chunk_size, high)]
+            heights = block_range.height
+            day_numbers = block_range.timestamp // SECONDS_PER_DAY
+            values = block_statistics(block_range)
+            add_statistics(days, day_numbers, values)
+            add_statistics(groups, heights // bucket_size, values)
+            touched_days.update(day_numbers[(heights >= block_start) &
+                                            (heights < block_end)].tolist())
+            METRICS.observe('extract_seconds', time.perf_counter() - start)
+
+        touched_groups = range(block_start // bucket_size,
+                               (block_end - 1) // bucket_size + 1)
+        cls.sink.write('daily_statistics',
+                       [(utc_date(x),) + tuple(days[x].tolist())
+                        for x in sorted(touched_days)])
+        cls.sink.write('block_group_statistics',
+                       [(x,) + tuple(groups[x].tolist())
+                        for x in touched_groups])
+
+        report_progress(cls.counter, block_end - block_start, 'blocks',
+                        sink=cls.sink)
+        cls.checkpoint(settings, block_start, block_end, block_end)
+        return METRICS.drain()
+
+
+class CoinjoinQueryManager(QueryManager):
+    '''Fill in the coinjoin column of candidate txs after the tx pass.'''
+
+    counter = Value('d', 0)
+    defaults = dict(QueryManager.defaults, stages=('coinjoin',))
+
+    @classmethod
+    def insert(cls, params, settings):
+
+        idx_start, idx_end = params
+
+        batches = range(idx_start, idx_end, cls.batch_size)
+        for (batch_no, index) in enumerate(batches, 1):
+
+            curr_batch_size = min(cls.batch_size, idx_end - index)
+            start = time.perf_counter()
+            block_range = cls.chain[index:index + curr_batch_size]
+            rows = coinjoin_summaries(cls.chain, block_range,
+                                      settings.tx_bucket_size)
+            METRICS.observe('extract_seconds', time.perf_counter() - start)
+            cls.sink.write('transaction_coinjoin', rows)
+
+            report_progress(cls.counter, curr_batch_size, 'blocks',
+                            sink=cls.sink)
 
-def take(n, iterable):
-    '''Return first n items of the iterable as a list
+            if batch_no % settings.checkpoint_interval == 0:
+                cls.checkpoint(settings, idx_start, idx_end,
+                               index + curr_batch_size)
 
-    >>> take(0, [1, 2])
+        cls.checkpoint(settings, idx_start, idx_end, idx_end)
+        return METRICS.drain()
+
+
+class DigestQueryManager(QueryManager):
+    '''Compare bucket digests of BlockSci and Cassandra.'''
+
+    defaults = dict(QueryManager.defaults, stages=('verify',))
+
+    def compare_buckets(self, work_units):
+        return list(self.pool.imap(self.compare, work_units, self.settings))
+
+    @classmethod
+    def compare(cls, params, settings):
+        (table, bucket, start, end, open_end) = params
+        expected = chain_bucket_rows(cls.chain, table, start, end)
+        actual = stored_bucket_rows(cls.sink.session, table, bucket, start,
+                                    None if open_end else end)
+        if bucket_digest(expected) == bucket_digest(actual):
+            status = 'ok'
+        elif not actual:
+            status = 'missing'
+        else:
+            status = 'differs'
+        return (table, bucket, start, end, status,
+                stale_rows(table, bucket, expected, actual,
+                           settings.tx_prefix_length))
+
+
+def subtract_intervals(interval, completed):
+    '''Return the parts of the interval [n1, n2) not covered by any of the
+    completed intervals
+
+    >>> subtract_intervals((0, 10), [])
+    [(0, 10)]
+
+    >>> subtract_intervals((0, 10), [(2, 4), (3, 6), (8, 12)])
+    [(0, 2), (6, 8)]
+
+    >>> subtract_intervals((5, 10), [(0, 10)])
     []
+    '''
 
-    >>> take(1, [1, 2])
-    [1]
+    remaining = []
+    n1, n2 = interval
+    for (start, end) in sorted(completed):
+        if start > n1:
+            remaining.append((n1, min(start, n2)))
+        n1 = max(n1, end)
+        if n1 >= n2:
+            break
+    if n1 < n2:
+        remaining.append((n1, n2))
+    return remaining
 
-    >>> take(2, [1, 2])
-    [1, 2]
 
-    >>> take(3, [1, 2])
-    [1, 2]
+def merge_intervals(intervals):
+    '''Return the union of intervals as sorted, disjoint intervals
+
+    >>> merge_intervals([(5, 8), (0, 2), (1, 3), (8, 9)])
+    [(0, 3), (5, 9)]
     '''
 
-    return list(islice(iterable, n))
+    merged = []
+    for (start, end) in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def cost_intervals(interval, costs, k):
+    '''Split the block interval [n1, n2) into about k intervals of similar
+    total cost, given the estimated cost of each block
+
+    >>> cost_intervals((0, 4), np.array([1, 1, 1, 1]), 2)
+    [(0, 2), (2, 4)]
+
+    >>> cost_intervals((10, 16), np.array([1, 1, 1, 1, 10, 10]), 3)
+    [(10, 15), (15, 16)]
+    '''
 
+    n1, n2 = interval
+    cum_costs = np.cumsum(costs)
+    targets = cum_costs[-1] * np.arange(1, k) / k
+    cuts = np.searchsorted(cum_costs, targets, side='left') + 1
+    bounds = sorted({0, n2 - n1} | set(cuts[cuts < n2 - n1].tolist()))
+    return [(n1 + b1, n1 + b2) for (b1, b2) in zip(bounds, bounds[1:])]
 
-def chunk(val_range, k):
-    '''Split the number range val_range=[n1, n2] into k evenly sized chunks
 
-    >>> chunk([0, 1], 1)
-    [(0, 1)]
+def count_intervals(interval, counts, limit):
+    '''Split the block interval [n1, n2) into consecutive intervals of at
+    most limit items in total, given the number of items of each block; a
+    block with more items forms an interval of its own.
 
-    >>> chunk([0, 4], 4)
-    [(0, 1), (1, 2), (2, 3), (3, 4)]
+    >>> count_intervals((10, 15), [3, 5, 2, 9, 1], 8)
+    [(10, 12), (12, 13), (13, 14), (14, 15)]
+    '''
 
-    >>> chunk([0, 5], 4)
-    [(0, 2), (2, 3), (3, 4), (4, 5)]
+    intervals = []
+    (start, total) = (interval[0], 0)
+    for (height, count) in enumerate(counts, interval[0]):
+        if total + count > limit and height > start:
+            intervals.append((start, height))
+            (start, total) = (height, 0)
+        total += count
+    intervals.append((start, interval[1]))
+    return intervals
+
+
+def block_costs(block_range):
+    '''Estimate the relative export cost of every block in a range from its
+    number of transactions, inputs and outputs.'''
+    return (block_range.tx_count +
+            block_range.input_count +
+            block_range.output_count)
+
+
+def schedule_work_units(chain, block_intervals, k):
+    '''Split block intervals into about k work units of similar estimated
+    cost, ordered from the most to the least expensive unit.'''
+
+    costs = [block_costs(chain[start:end]) for (start, end) in block_intervals]
+    total_cost = sum(x.sum() for x in costs)
+
+    units = []
+    for (interval, interval_costs) in zip(block_intervals, costs):
+        num_units = max(1, round(k * interval_costs.sum() / total_cost))
+        offset = interval[0]
+        for (start, end) in cost_intervals(interval, interval_costs,
+                                           num_units):
+            cost = interval_costs[start - offset:end - offset].sum()
+            units.append((cost, (start, end)))
+    # hand out expensive units first, so that cheap ones fill up the tail
+    units.sort(key=lambda x: x[0], reverse=True)
+    return [unit for (_, unit) in units]
+
+
+def first_tx_index(chain, height):
+    '''Return the index of the first tx of a block, or the number of txs if
+    the height is past the last block.'''
+    if height >= len(chain):
+        return chain[-1].txes[-1].index + 1
+    return chain[height].txes[0].index
+
+
+def tx_work_units(chain, block_intervals, k):
+    '''Return the work units of schedule_work_units() as (block_start,
+    block_end, tx_start, tx_end) tuples.'''
+
+    return [(start, end, first_tx_index(chain, start),
+             first_tx_index(chain, end))
+            for (start, end) in schedule_work_units(chain, block_intervals, k)]
+
+
+class LRUCache:
+    '''Bounded cache evicting the least recently used entry
+
+    >>> cache = LRUCache(2)
+    >>> cache.get('a', str.upper, 'a'), cache.get('b', str.upper, 'b')
+    ('A', 'B')
+    >>> cache.get('a', str.upper, 'a'), cache.get('c', str.upper, 'c')
+    ('A', 'C')
+    >>> 'b' in cache.entries, cache.hits, cache.misses
+    (False, 1, 3)
     '''
 
-    n1, n2 = val_range
-    assert n2 > n1
-    n = n2 - n1
-    assert 0 < k <= n
-    s, r = divmod(n, k)
-    t = s + 1
-    return ([(n1+p, n1+p+t) for p in range(0, r*t, t)] +
-            [(n1+p, n1+p+s) for p in range(r*t, n, s)])
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, *args):
+        '''Return the cached value for key, else compute(*args).'''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(*args)
+            self.put(key, value)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def record_metrics(self, name):
+        '''Add the hits and misses since the last call to the metrics.'''
+        METRICS.inc('cache_hits_total', self.hits, cache=name)
+        METRICS.inc('cache_misses_total', self.misses, cache=name)
+        (self.hits, self.misses) = (0, 0)
+
+
+# per-process caches of rendered addresses, keyed by address type and
+# number, and of output summaries, keyed by tx index and output index
+ADDRESS_CACHE = LRUCache(250_000)
+OUTPUT_CACHE = LRUCache(250_000)
+
+
+def configure_caches(max_size):
+    '''Resize the caches; cached entries are kept if the size is unchanged,
+    e.g., across updates in follow mode.'''
+    global ADDRESS_CACHE, OUTPUT_CACHE
+    if ADDRESS_CACHE.max_size != max_size:
+        ADDRESS_CACHE = LRUCache(max_size)
+    if OUTPUT_CACHE.max_size != max_size:
+        OUTPUT_CACHE = LRUCache(max_size)
 
 
 def addr_str(addr_obj):
@@ -329,29 +2146,148 @@ def addr_str(addr_obj):
     return res
 
 
-def block_summary(block, bucket_size):
-    return (int(block.height // bucket_size),
-            block.height,
-            bytearray.fromhex(str(block.hash)),
-            block.timestamp,
-            len(block))
+def block_summaries(block_range, bucket_size=BLOCK_BUCKET_SIZE):
+    '''Return the block table rows of a block range.
+
+    Heights, timestamps and tx counts are read as arrays from the range
+    rather than attribute by attribute from individual block objects.
+    '''
+
+    heights = block_range.height
+    hashes = [bytearray.fromhex(str(x)) for x in block_range.hash]
+    return list(zip((heights // bucket_size).tolist(),
+                    heights.tolist(),
+                    hashes,
+                    block_range.timestamp.tolist(),
+                    block_range.tx_count.tolist()))
 
 
 def tx_stats(tx, bucket_size=TX_BUCKET_SIZE):
     return (tx.index,
-            len(tx.inputs),
-            len(tx.outputs),
+            tx.input_count,
+            tx.output_count,
             tx.input_value,
             tx.output_value)
 
 
+def block_tx_summary(height, tx_stats_list, bucket_size=BLOCK_BUCKET_SIZE):
+    return (int(height // bucket_size),
+            height,
+            tx_stats_list)
+
+
+def block_tx_summaries(block_range, bucket_size=BLOCK_BUCKET_SIZE):
+    '''Return the block_transactions rows of a block range.
+
+    The tx statistics of all blocks are read as arrays from the flattened
+    tx range and then split per block using the block tx counts.
+    '''
+
+    txes = block_range.txes
+    all_tx_stats = list(zip(txes.index.tolist(),
+                            txes.input_count.tolist(),
+                            txes.output_count.tolist(),
+                            txes.input_value.tolist(),
+                            txes.output_value.tolist()))
+    tx_bounds = np.cumsum(block_range.tx_count).tolist()
+
+    rows = []
+    tx_start = 0
+    for (height, tx_end) in zip(block_range.height.tolist(), tx_bounds):
+        rows.append(block_tx_summary(height, all_tx_stats[tx_start:tx_end],
+                                     bucket_size))
+        tx_start = tx_end
+    return rows
+
+
+@lru_cache(maxsize=None)
+def address_type_code(addr_type):
+    return address_type[repr(addr_type)]
+
+
+def cached_addr_str(addr_obj):
+    if addr_obj.type in ADDRESS_TYPES_WITHOUT_STR:
+        return None
+    return ADDRESS_CACHE.get((addr_obj.type, addr_obj.address_num),
+                             addr_str, addr_obj)
+
+
+@lru_cache(maxsize=250_000)
+def cached_encode_address(address):
+    return encode_address(address)
+
+
+def tx_io_summaries(tx):
+    '''Return the input and output summaries of a tx.'''
+    return ([tx_input_summary(x) for x in tx.inputs], tx_output_summaries(tx))
+
+
 def tx_io_summary(x):
-    return [addr_str(x.address), x.value, address_type[repr(x.address_type)]]
+    return (cached_addr_str(x.address), x.value,
+            address_type_code(x.address_type))
+
+
+def tx_output_summaries(tx):
+    '''Return the output summaries of a tx and keep them in the output cache,
+    so that inputs spending these outputs can be summarized from cache.'''
+    summaries = [tx_io_summary(x) for x in tx.outputs]
+    for (i, summary) in enumerate(summaries):
+        OUTPUT_CACHE.put((tx.index, i), summary)
+    return summaries
+
+
+def tx_input_summary(x):
+    return OUTPUT_CACHE.get((x.spent_tx_index, x.spent_output.index),
+                            tx_io_summary, x)
+
+
+def coinjoin_candidates(input_counts, output_counts, is_coinbase):
+    '''Return whether txs can be classified as coinjoin at all, mirroring
+    the early exits of BlockSci's coinjoin heuristic: at least two inputs,
+    three outputs, and one input per participant (a participant receives a
+    payment and a change output). Works on scalars and on arrays.
+
+    >>> coinjoin_candidates(np.array([1, 2, 2, 3]), np.array([2, 3, 6, 5]),
+    ...                     np.array([False, False, False, True]))
+    array([False,  True, False, False])
+    '''
+
+    return (np.logical_not(is_coinbase) &
+            (input_counts >= 2) &
+            (output_counts >= 3) &
+            ((output_counts + 1) // 2 <= input_counts))
+
+
+def coinjoin(tx, deferred=False):
+    '''Apply the coinjoin heuristic to candidate txs. If deferred, return
+    None for candidates, to be filled in by coinjoin_summaries().'''
+    if not coinjoin_candidates(tx.input_count, tx.output_count,
+                               tx.is_coinbase):
+        return False
+    if deferred:
+        return None
+    return blocksci.heuristics.is_coinjoin(tx)
+
 
+def coinjoin_summaries(chain, block_range, bucket_size=TX_BUCKET_SIZE):
+    '''Return the coinjoin column of all candidate txs of a block range.'''
 
-def tx_summary(tx, bucket_size=TX_BUCKET_SIZE):
-    tx_inputs = [tx_io_summary(x) for x in tx.inputs]
-    tx_outputs = [tx_io_summary(x) for x in tx.outputs]
+    txes = block_range.txes
+    tx_ids = txes.index[coinjoin_candidates(txes.input_count,
+                                            txes.output_count,
+                                            txes.is_coinbase)]
+    return [(int(t_id // bucket_size),
+             t_id,
+             blocksci.heuristics.is_coinjoin(blocksci.Tx(t_id, chain)))
+            for t_id in tx_ids.tolist()]
+
+
+def tx_summary(tx, bucket_size=TX_BUCKET_SIZE, deferred_coinjoin=False,
+               compact_tx_io=False, ios=None):
+    (tx_inputs, tx_outputs) = ios or tx_io_summaries(tx)
+    if compact_tx_io:
+        tx_inputs = encode_tx_ios(tx_inputs, cached_encode_address)
+        tx_outputs = encode_tx_ios(tx_outputs, cached_encode_address)
     return (int(tx.index // bucket_size),
             tx.index,
             bytearray.fromhex(str(tx.hash)),
@@ -360,27 +2296,387 @@ def tx_summary(tx, bucket_size=TX_BUCKET_SIZE):
             tx.is_coinbase,
             tx.input_value,
             tx.output_value,
-            list(tx_inputs),
-            list(tx_outputs),
-            blocksci.heuristics.is_coinjoin(tx))
+            tx_inputs,
+            tx_outputs,
+            coinjoin(tx, deferred_coinjoin))
 
 
 def tx_short_summary(tx_hash, t_id, prefix_length=TX_HASH_PREFIX_LENGTH):
-    return (str(tx_hash)[:prefix_length],
-            bytearray.fromhex(str(tx_hash)),
+    tx_hash_hex = str(tx_hash)
+    return (tx_hash_hex[:prefix_length],
+            bytearray.fromhex(tx_hash_hex),
             t_id)
 
 
-def insert_summary_stats(cluster, keyspace, last_block):
+@lru_cache(maxsize=250_000)
+def address_prefix(address, length=ADDRESS_PREFIX_LENGTH):
+    '''Return the address_transactions partition of an address: a prefix of
+    the hex SHA-256 digest of the address, so that addresses are spread
+    evenly regardless of the leading characters of their format.
+
+    >>> address_prefix('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+    '31a9'
+    '''
+
+    return hashlib.sha256(address.encode('utf-8')).hexdigest()[:length]
+
+
+def address_tx_summaries(t_id, tx_inputs, tx_outputs,
+                         prefix_length=ADDRESS_PREFIX_LENGTH):
+    '''Return the address_transactions rows of a tx from its input and
+    output summaries: the total value per address and direction. Every
+    address of a multisig input or output gets its full value.
+
+    >>> address_tx_summaries(7, [(['1A'], 5, 3), (['1A'], 2, 3)],
+    ...                      [(['1A', '1B'], 4, 6), (None, 0, 7)], 2)
+    [('cf', '1A', 7, True, 7), ('cf', '1A', 7, False, 4), \
+('e3', '1B', 7, False, 4)]
+    '''
+
+    values = {}
+    for (is_outgoing, summaries) in ((True, tx_inputs), (False, tx_outputs)):
+        for (addresses, value, _) in summaries:
+            for address in addresses or ():
+                key = (address, is_outgoing)
+                values[key] = values.get(key, 0) + value
+    return [(address_prefix(address, prefix_length), address, t_id,
+             is_outgoing, value)
+            for ((address, is_outgoing), value) in values.items()]
+
+
+def insert_summary_stats(sink, keyspace, last_block):
     total_blocks = last_block.height + 1
     total_txs = last_block.txes[-1].index + 1
     timestamp = last_block.timestamp
 
-    session = cluster.connect(keyspace)
-    cql_str = '''INSERT INTO summary_statistics
-                 (id, timestamp, no_blocks, no_txs)
-                 VALUES (%s, %s, %s, %s)'''
-    session.execute(cql_str, (keyspace, timestamp, total_blocks, total_txs))
+    sink.write('summary_statistics',
+               [(keyspace, timestamp, total_blocks, total_txs)])
+
+
+def block_statistics(block_range):
+    '''Return the values of AGGREGATE_COLUMNS per block of a range, as an
+    int64 array with one row per block, from the range's tx arrays.'''
+
+    txes = block_range.txes
+    is_coinbase = txes.is_coinbase
+    input_value = txes.input_value.astype(np.int64)
+    output_value = txes.output_value.astype(np.int64)
+    tx_counts = block_range.tx_count
+    # every block has a coinbase tx, so no segment is empty
+    tx_starts = np.concatenate(([0], np.cumsum(tx_counts)[:-1]))
+    per_tx = np.column_stack((
+        txes.input_count.astype(np.int64),
+        txes.output_count.astype(np.int64),
+        input_value,
+        output_value,
+        np.where(is_coinbase, 0, input_value - output_value),
+        np.where(is_coinbase, output_value, 0)))
+    return np.column_stack((np.ones(len(tx_counts), dtype=np.int64),
+                            tx_counts.astype(np.int64),
+                            np.add.reduceat(per_tx, tx_starts)))
+
+
+def add_statistics(totals, keys, values):
+    '''Add rows of block statistics to the totals of their keys.
+
+    >>> totals = {}
+    >>> add_statistics(totals, np.array([3, 4, 3]),
+    ...                np.array([[1, 2], [1, 5], [1, 1]]))
+    >>> {k: v.tolist() for (k, v) in totals.items()}
+    {3: [2, 3], 4: [1, 5]}
+    '''
+
+    (unique, inverse) = np.unique(keys, return_inverse=True)
+    sums = np.zeros((len(unique), values.shape[1]), dtype=np.int64)
+    np.add.at(sums, inverse, values)
+    for (key, row) in zip(unique.tolist(), sums):
+        totals[key] = totals[key] + row if key in totals else row
+
+
+def utc_date(day):
+    '''
+    >>> utc_date(1231006505 // SECONDS_PER_DAY)
+    '2009-01-03'
+    '''
+    return dt.utcfromtimestamp(day * SECONDS_PER_DAY).strftime('%Y-%m-%d')
+
+
+def aggregate_range(chain, start, end, limit, bucket_size=BLOCK_BUCKET_SIZE,
+                    margin=SECONDS_PER_DAY):
+    '''Return the blocks to aggregate for complete statistics of all UTC days
+    and block_id_groups of the blocks from start to end, up to limit.
+
+    Block timestamps are not monotonic, but deviate by far less than margin
+    from those of neighbouring blocks; blocks before and after are included
+    until one is timestamped margin seconds outside of these days.
+    '''
+
+    timestamps = chain[start:end].timestamp
+    first_day = int(timestamps.min()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    last_day_end = (int(timestamps.max()) // SECONDS_PER_DAY + 1) * \
+        SECONDS_PER_DAY
+    low = start // bucket_size * bucket_size
+    while low > 0 and chain[low - 1].timestamp >= first_day - margin:
+        low -= 1
+    high = min(limit, -(-end // bucket_size) * bucket_size)
+    while high < limit and chain[high].timestamp < last_day_end + margin:
+        high += 1
+    return (low, high)
+
+
+def replay_failures(sink, journal_dir):
+    '''Re-ingest the rows recorded in the failure journal.
+
+    Journal files are removed once their rows have been written; rows that
+    fail again are recorded in a new journal file.
+    '''
+
+    files = FailureJournal.files(journal_dir)
+    if not files:
+        print(f'No failed writes in {journal_dir}')
+        return
+
+    for file_name in files:
+        count = 0
+        for (table, row) in FailureJournal.read(file_name):
+            sink.write(table, [row])
+            count += 1
+        sink.flush()
+        os.remove(file_name)
+        print(f'Replayed {count:,.0f} rows from {file_name}')
+
+
+# tables compared by --verify, with the column compared per row
+VERIFY_TABLES = {
+    'block': ('block', 'block_hash'),
+    'block_tx': ('block_transactions', 'txs'),
+    'tx': ('transaction', 'tx_hash')
+}
+
+
+def bucket_work_units(table, index_range, bucket_size, at_tip=False):
+    '''Return (table, bucket, start, end, open_end) tuples for all buckets of
+    an index range. At the chain tip, the last bucket and the one after it
+    are also checked for rows beyond the range, e.g., after a reorg.
+
+    >>> bucket_work_units('block', (150, 320), 100)
+    [('block', 1, 150, 200, False), ('block', 2, 200, 300, False), \
+('block', 3, 300, 320, False)]
+
+    >>> bucket_work_units('block', (150, 200), 100, at_tip=True)
+    [('block', 1, 150, 200, True), ('block', 2, 200, 200, True)]
+    '''
+
+    (start, end) = index_range
+    first = start // bucket_size
+    last = (end - 1) // bucket_size
+    units = [(table, bucket, max(start, bucket * bucket_size),
+              min(end, (bucket + 1) * bucket_size), False)
+             for bucket in range(first, last + 1)]
+    if at_tip:
+        units[-1] = units[-1][:4] + (True,)
+        units.append((table, last + 1, end, end, True))
+    return units
+
+
+def bucket_digest(rows):
+    '''Return a digest of the (key, value) pairs of a bucket.
+
+    >>> bucket_digest({1: b'a', 2: b'b'}) == bucket_digest({2: b'b', 1: b'a'})
+    True
+
+    >>> bucket_digest({1: b'a'}) == bucket_digest({1: b'b'})
+    False
+    '''
+
+    digest = hashlib.blake2b(digest_size=16)
+    for item in sorted(rows.items()):
+        digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+def chain_bucket_rows(chain, table, start, end):
+    '''Return the compared (key, value) pairs of a bucket from BlockSci.'''
+
+    if start >= end:
+        return {}
+    if table == 'block':
+        return {row[1]: bytes(row[2])
+                for row in block_summaries(chain[start:end])}
+    if table == 'block_transactions':
+        return {row[1]: tuple(tuple(x) for x in row[2])
+                for row in block_tx_summaries(chain[start:end])}
+    return {i: bytes.fromhex(str(blocksci.Tx(i, chain).hash))
+            for i in range(start, end)}
+
+
+def stored_bucket_rows(session, table, bucket, start, end=None):
+    '''Return the compared (key, value) pairs of a bucket from Cassandra;
+    without end, all rows from start on.'''
+
+    (group_col, key_col) = PRIMARY_KEYS[table]
+    (_, value_col) = [x for x in VERIFY_TABLES.values() if x[0] == table][0]
+    cql = (f'SELECT {key_col}, {value_col} FROM {table} '
+           f'WHERE {group_col}=%s AND {key_col}>=%s')
+    params = [bucket, start]
+    if end is not None:
+        cql += f' AND {key_col}<%s'
+        params.append(end)
+
+    rows = {}
+    for (key, value) in session.execute(cql, params):
+        if table == 'block_transactions':
+            # tx_summary UDTs, with their fields in TX_SUMMARY_FIELDS order
+            rows[key] = tuple(tuple(x) for x in value or ())
+        else:
+            rows[key] = bytes(value)
+    return rows
+
+
+def stale_rows(table, bucket, expected, actual,
+               prefix_length=TX_HASH_PREFIX_LENGTH):
+    '''Return (table, primary key) pairs of stored rows that do not belong
+    to the chain (anymore), including lookup rows of replaced tx hashes.
+
+    >>> stale_rows('transaction', 0, {1: b'\\x0a\\xbc'},
+    ...            {1: b'\\x0a\\xbd', 2: b'\\xff\\xff'})
+    [('transaction_by_tx_prefix', ('0abd', b'\\n\\xbd')), \
+('transaction_by_tx_prefix', ('ffff', b'\\xff\\xff')), \
+('transaction', (0, 2))]
+    '''
+
+    rows = []
+    for (key, value) in sorted(actual.items()):
+        if table == 'transaction' and expected.get(key) != value:
+            rows.append(('transaction_by_tx_prefix',
+                         (value.hex()[:prefix_length], value)))
+        if key not in expected:
+            rows.append((table, (bucket, key)))
+    return rows
+
+
+def replaced_address_rows(session, chain, bucket, start,
+                          prefix_length=ADDRESS_PREFIX_LENGTH):
+    '''Return the keys of the address_transactions rows of stored txs from
+    start on in a transaction bucket that are no longer part of the chain
+    or whose hash differs from BlockSci, e.g., after a reorg.'''
+
+    num_txs = chain[-1].txes[-1].index + 1
+    cql = ('SELECT tx_id, tx_hash, inputs, outputs FROM transaction '
+           'WHERE tx_id_group=%s AND tx_id>=%s')
+    keys = []
+    rows = session.execute(cql, [bucket, start])
+    for (tx_id, tx_hash, inputs, outputs) in rows:
+        if tx_id < num_txs:
+            chain_hash = bytes.fromhex(str(blocksci.Tx(tx_id, chain).hash))
+            if bytes(tx_hash) == chain_hash:
+                continue
+        # see schema_compact.cql
+        ios = [decode_tx_ios(x) if isinstance(x, (bytes, bytearray))
+               else x or [] for x in (inputs, outputs)]
+        summaries = address_tx_summaries(tx_id, *ios, prefix_length)
+        keys += [row[:4] for row in summaries]
+    return keys
+
+
+def verify_buckets(args, chain, block_range, tables, pool):
+    '''Compare bucket digests of the selected tables and return the buckets
+    that are missing or differ.'''
+
+    block_index_range = (block_range[0].height, block_range[-1].height + 1)
+    tx_index_range = (block_range[0].txes[0].index,
+                      block_range[-1].txes[-1].index + 1)
+    at_tip = block_index_range[1] == len(chain)
+
+    work_units = []
+    for (name, (table, _)) in VERIFY_TABLES.items():
+        if name not in tables:
+            continue
+        if table == 'transaction':
+            work_units += bucket_work_units(table, tx_index_range,
+                                            args.tx_bucket_size, at_tip)
+        else:
+            work_units += bucket_work_units(table, block_index_range,
+                                            args.block_bucket_size, at_tip)
+
+    print(f'Verifying {len(work_units):,.0f} buckets')
+    qm = DigestQueryManager(pool=pool, **partitioning(args))
+    results = qm.compare_buckets(work_units)
+
+    divergent = [x for x in results if x[4] != 'ok' or x[5]]
+    for (table, _) in VERIFY_TABLES.values():
+        table_results = [x for x in results if x[0] == table]
+        if not table_results:
+            continue
+        missing = sum(1 for x in table_results if x[4] == 'missing')
+        differs = sum(1 for x in table_results if x[4] == 'differs')
+        stale = sum(len(x[5]) for x in table_results)
+        print(f'{table}: {len(table_results):,.0f} buckets, '
+              f'{missing:,.0f} missing, {differs:,.0f} differ, '
+              f'{stale:,.0f} stale rows')
+    for (table, bucket, start, end, status, _) in sorted(divergent):
+        print(f'    {table} bucket {bucket} [{start:,.0f}, {end:,.0f}): '
+              f'{status}')
+    return divergent
+
+
+def repair_buckets(args, chain, divergent, sink, pool):
+    '''Delete stale rows and re-export divergent buckets with the regular
+    row builders; the progress ledger is left unchanged.'''
+
+    stale = [x for (_, _, _, _, _, rows) in divergent for x in rows]
+    # address rows of replaced txs, read before the txs are overwritten
+    address_index = sink.has_table('address_transactions')
+    if address_index:
+        for (table, bucket, start, _, _, _) in divergent:
+            if table != 'transaction':
+                continue
+            stale += [('address_transactions', key) for key
+                      in replaced_address_rows(sink.session, chain, bucket,
+                                               start,
+                                               args.address_prefix_length)]
+
+    delete_stmts = {}
+    for (table, key) in stale:
+        if table not in delete_stmts:
+            delete_stmts[table] = sink.session.prepare(delete_cql(table))
+        sink.session.execute(delete_stmts[table], key)
+
+    ranges = {}
+    for (table, _, start, end, _, _) in divergent:
+        if start < end:
+            ranges.setdefault(table, []).append((start, end))
+    tx_intervals = merge_intervals(ranges.pop('transaction', []))
+    work_units = [(blocksci.Tx(start, chain).block_height,
+                   blocksci.Tx(end - 1, chain).block_height + 1,
+                   start, end)
+                  for (start, end) in tx_intervals]
+    # block_transactions rows summarize the txs of their blocks
+    ranges.setdefault('block_transactions', []).extend(
+        x[:2] for x in work_units)
+    intervals = {table: merge_intervals(x) for (table, x) in ranges.items()
+                 if x}
+
+    if work_units:
+        qm = TxQueryManager(pool=pool, ledger=NullLedger(),
+                            address_txs=address_index,
+                            cache_size=args.cache_size,
+                            compact_tx_io=args.tx_io_encoding == 'compact',
+                            **partitioning(args))
+        qm.execute(TxQueryManager.insert, work_units)
+
+    if 'block_transactions' in intervals:
+        qm = BlockTxQueryManager(pool=pool, ledger=NullLedger(),
+                                 max_batch_txs=max_batch_txs(args),
+                                 **partitioning(args))
+        qm.execute(BlockTxQueryManager.insert, intervals['block_transactions'])
+
+    if 'block' in intervals:
+        qm = BlockQueryManager(pool=pool, ledger=NullLedger(),
+                               **partitioning(args))
+        qm.execute(BlockQueryManager.insert, intervals['block'])
+
+    print(f'Repaired {len(divergent):,.0f} buckets')
 
 
 def create_parser():
@@ -393,12 +2689,28 @@ def create_parser():
     parser.add_argument('-c', '--config', dest='blocksci_config',
                         required=True,
                         help='BlockSci configuration file')
+    parser.add_argument('--batch-size', dest='batch_size',
+                        type=int, default=100,
+                        help='number of rows extracted per batch '
+                             '(default 100)')
     parser.add_argument('--concurrency', dest='concurrency',
                         type=int, default=100,
-                        help='Cassandra concurrency parameter (default 100)')
+                        help='maximum number of in-flight Cassandra write '
+                             'requests per process, or the initial number '
+                             'with --max-concurrency (default 100)')
+    parser.add_argument('--coinjoin', dest='coinjoin', default='inline',
+                        choices=['inline', 'deferred'],
+                        help='apply the coinjoin heuristic while exporting '
+                             'transactions, or in a separate pass after the '
+                             'transaction export (default "inline")')
     parser.add_argument('--continue', action='store_true',
                         dest='continue_ingest',
-                        help='continue ingest from last block/tx id')
+                        help='continue ingest from last block/tx id, '
+                             'as recorded in the export progress ledger')
+    parser.add_argument('--ignore-ledger', action='store_true',
+                        help='with --continue, also export blocks the '
+                             'export progress ledger records as exported '
+                             '(progress is still recorded)')
     parser.add_argument('--db-keyspace', dest='keyspace', required=True,
                         help='Cassandra keyspace')
     parser.add_argument('--db-nodes', dest='db_nodes', nargs='+',
@@ -408,15 +2720,144 @@ def create_parser():
                         type=int, default=9042,
                         help='Cassandra CQL native transport port; '
                              'default 9042')
+    parser.add_argument('--failure-journal', dest='journal_dir',
+                        default='failed_writes', metavar='DIR',
+                        help='directory for rows that could not be written '
+                             'to Cassandra (default "failed_writes")')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep running and export newly parsed blocks '
+                             'as they appear in the BlockSci data directory, '
+                             'until terminated')
     parser.add_argument('-i', '--info', action='store_true',
                         help='display block information and exit')
+    parser.add_argument('--metrics-file', dest='metrics_file',
+                        metavar='FILE',
+                        help='export per-stage metrics (rows and bytes per '
+                             'table, extraction and write latency, retries, '
+                             'in-flight requests) after every stage, as JSON '
+                             'if FILE ends with ".json", otherwise in the '
+                             'Prometheus textfile format')
+    parser.add_argument('--profile', dest='profile_dir', metavar='DIR',
+                        help='profile the work units of all worker '
+                             'processes and write one merged report per '
+                             'stage to DIR')
+    parser.add_argument('--profile-mode', default='deterministic',
+                        choices=Profiler.MODES,
+                        help='profile every function call with cProfile '
+                             '(STAGE.prof, STAGE.txt) or sample the stack '
+                             '(STAGE.folded, collapsed stacks for flame '
+                             'graphs) (default "deterministic")')
+    parser.add_argument('--profile-blocks', type=int, nargs=2,
+                        metavar=('START', 'END'),
+                        help='only profile work units overlapping the '
+                             'blocks START <= height < END')
+    parser.add_argument('--profile-interval', type=float, default=0.005,
+                        metavar='SECONDS',
+                        help='CPU time between stack samples of '
+                             '--profile-mode sampling (default 0.005)')
+    parser.add_argument('--sink', dest='sink', default='cassandra',
+                        choices=['cassandra', 'parquet', 'csv'],
+                        help='write rows to Cassandra, to local Parquet '
+                             'files, or to CSV files for bulk loading '
+                             '(default "cassandra")')
+    parser.add_argument('--output-dir', dest='output_dir',
+                        help='output directory for file sinks; one '
+                             'Hive-partitioned dataset per table')
+    parser.add_argument('--max-batch-bytes', dest='max_batch_bytes',
+                        type=int, default=48 * 1024,
+                        help='upper limit of the adaptive batch size in '
+                             'bytes for --write-mode batches '
+                             '(default 49152)')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int,
+                        default=MEMORY_BUDGET // 2**20, metavar='MIB',
+                        help='estimated size in MiB of the rows each process '
+                             'keeps in flight or buffered for file sinks, '
+                             'and of the txs read at once for table '
+                             'block_transactions (default 256)')
+    parser.add_argument('--max-mutation-bytes', dest='max_mutation_bytes',
+                        type=int, default=MAX_MUTATION_BYTES,
+                        help='mutation size limit of the Cassandra cluster '
+                             '(max_mutation_size); larger rows are written '
+                             'to the failure journal, rows above half of it '
+                             'reported (default 16777216)')
+    parser.add_argument('--max-concurrency', dest='max_concurrency',
+                        type=int,
+                        help='adapt the number of in-flight Cassandra write '
+                             'requests per process between 1 and this value '
+                             'to the observed latency and timeouts, '
+                             'starting at --concurrency')
+    parser.add_argument('--latency-target', dest='latency_target',
+                        type=float, default=0.5, metavar='SECONDS',
+                        help='99th percentile write latency up to which '
+                             '--max-concurrency raises the number of '
+                             'in-flight requests (default 0.5)')
+    parser.add_argument('--max-retries', dest='max_retries',
+                        type=int, default=10,
+                        help='number of retries with exponential backoff '
+                             'before a row is written to the failure journal '
+                             '(default 10)')
+    parser.add_argument('--replay-failures', action='store_true',
+                        help='re-ingest the rows recorded in the failure '
+                             'journal and exit')
+    parser.add_argument('--repair', action='store_true',
+                        help='like --verify, then delete rows of blocks and '
+                             'txs no longer in the chain and re-export all '
+                             'missing or divergent buckets')
+    parser.add_argument('--write-mode', dest='write_mode', default='rows',
+                        choices=['rows', 'batches'],
+                        help='write one INSERT per row, or group rows of '
+                             'the same partition into UNLOGGED batches '
+                             '(default "rows")')
     parser.add_argument('--processes', dest='num_proc',
                         type=int, default=1,
                         help='number of processes (default 1)')
+    parser.add_argument('--cache-size', dest='cache_size',
+                        type=int, default=250_000,
+                        help='number of rendered addresses and of output '
+                             'summaries cached per process (default 250000)')
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval',
+                        type=int, default=100,
+                        help='record progress in the export ledger every '
+                             'CHECKPOINT_INTERVAL batches (default 100)')
     parser.add_argument('--chunks', dest='num_chunks',
                         type=int,
-                        help='number of chunks to split tx/block range '
-                             '(default `NUM_PROC`)')
+                        help='number of work units to split the tx/block '
+                             'range into, based on the estimated cost per '
+                             'block (default 8 * `NUM_PROC`)')
+    parser.add_argument('--address-prefix-length',
+                        dest='address_prefix_length', type=int,
+                        help='number of hex characters of the SHA-256 '
+                             'digest of an address in the '
+                             'address_transactions partition key '
+                             f'(default {ADDRESS_PREFIX_LENGTH}, or the '
+                             'value recorded for the keyspace)')
+    parser.add_argument('--block-bucket-size', dest='block_bucket_size',
+                        type=int,
+                        help='number of blocks per block_id_group partition '
+                             f'(default {BLOCK_BUCKET_SIZE}, or the value '
+                             'recorded for the keyspace)')
+    parser.add_argument('--tx-bucket-size', dest='tx_bucket_size',
+                        type=int,
+                        help='number of txs per tx_id_group partition '
+                             f'(default {TX_BUCKET_SIZE}, or the value '
+                             'recorded for the keyspace)')
+    parser.add_argument('--tx-io-encoding', dest='tx_io_encoding',
+                        choices=['udt', 'compact'],
+                        help='write tx inputs and outputs as lists of '
+                             'tx_input_output UDTs, or as compact binary '
+                             'blobs (see schema_compact.cql and '
+                             'tx_io_codec.py); default: as required by the '
+                             'keyspace, else "udt"')
+    parser.add_argument('--tx-prefix-length', dest='tx_prefix_length',
+                        type=int,
+                        help='number of hex characters of the '
+                             'transaction_by_tx_prefix partition key '
+                             f'(default {TX_HASH_PREFIX_LENGTH}, or the '
+                             'value recorded for the keyspace)')
+    parser.add_argument('--poll-interval', dest='poll_interval',
+                        type=float, default=10,
+                        help='seconds between checks for new blocks in '
+                             'follow mode (default 10)')
     parser.add_argument('-p', '--previous-day', dest='prev_day',
                         action='store_true',
                         help='only ingest blocks up to the previous day, '
@@ -431,20 +2872,33 @@ def create_parser():
                         help='only blocks with height smaller than or equal '
                              'to this value are included; a negative index '
                              'counts back from the end (default -1)')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare digests of the block hashes, block tx '
+                             'lists and tx hashes per bucket (block_id_group, '
+                             'tx_id_group) between BlockSci and Cassandra '
+                             'for the selected tables and block range, and '
+                             'exit; the exit status is 1 if any bucket is '
+                             'missing or differs')
     parser.add_argument('-t', '--tables', nargs='*', metavar='TABLE',
                         help='list of tables to ingest, possible values:'
                              '    "block" (block table), '
                              '    "block_tx" (block transactions table), '
                              '    "tx" (transactions table), '
+                             '    "address_tx" (address transactions '
+                             'index, only if given), '
+                             '    "aggregates" (daily and block group '
+                             'statistics, only if given), '
                              '    "stats" (summary statistics table); '
-                             'ingests all tables if not specified')
+                             'ingests all other tables if not specified')
     return parser
 
 
-def check_tables_arg(tables, table_list=['tx', 'block_tx', 'block', 'stats']):
+def check_tables_arg(tables, table_list=['tx', 'block_tx', 'block', 'stats'],
+                     optional_tables=['address_tx', 'aggregates']):
     all_tables = tables is None
     table_list_intersect = table_list
     if not all_tables:
+        table_list = table_list + optional_tables
         set_diff = set(tables) - set(table_list)
         if len(tables) == 0:
             print('No tables specified in --tables/-t argument.')
@@ -463,20 +2917,333 @@ def check_tables_arg(tables, table_list=['tx', 'block_tx', 'block', 'stats']):
     return list(table_list_intersect)
 
 
-def upsert_btc_duplicate_hashes(session, stmt):
+def upsert_btc_duplicate_hashes(sink, prefix_length=TX_HASH_PREFIX_LENGTH):
     """Ensures for duplicated tx hashes that most recent transaction is
        ingested, since BIP30 dictates that it is the newest version of these
        transactions that is spendable.
        See https://bitcoin.stackexchange.com/a/88667/48795"""
     for tx, tid in [("e3bf3d07d4b0375638d5f1db5255fe07ba2c4cb067cd81b84ee974b6585fb468", 142841),
                     ("d5d27987d2a3dfc724e359870c6644b40e497bdc0589a033220fe15429d88599", 142783)]:
-        session.execute(stmt, tx_short_summary(tx, tid))
+        sink.write('transaction_by_tx_prefix',
+                   [tx_short_summary(tx, tid, prefix_length)])
+
+
+def max_batch_txs(args):
+    '''Return the number of txs read at once for block_transactions rows,
+    a quarter of the memory budget.'''
+    return max(1, args.memory_budget * 2**20 // (4 * TX_STATS_MEMORY))
+
+
+def partitioning(args):
+    '''Return the partitioning parameters of a run as keyword options.'''
+    return {name: getattr(args, name) for name in PARTITIONING_DEFAULTS}
+
+
+def resolve_partitioning(args, stored):
+    '''Fill in partitioning parameters not given as arguments from those
+    stored for the keyspace, else from the defaults; return the names of
+    arguments that conflict with the stored parameters.
+
+    >>> from argparse import Namespace
+    >>> args = Namespace(block_bucket_size=None, tx_prefix_length=4,
+    ...                  tx_bucket_size=10_000, address_prefix_length=None)
+    >>> resolve_partitioning(args, {'block_bucket_size': 50,
+    ...                             'tx_prefix_length': 5,
+    ...                             'tx_bucket_size': 10_000,
+    ...                             'address_prefix_length': None})
+    ['tx_prefix_length']
+    >>> args.block_bucket_size
+    50
+    '''
+
+    conflicts = []
+    for (name, default) in PARTITIONING_DEFAULTS.items():
+        value = getattr(args, name)
+        if stored is not None and stored[name] is not None:
+            if value is not None and value != stored[name]:
+                conflicts.append(name)
+            value = stored[name]
+        setattr(args, name, default if value is None else value)
+    return conflicts
+
+
+def chain_config(config_file):
+    '''Return the contents of a BlockSci configuration file.'''
+    with open(config_file) as fh:
+        return json.load(fh)
+
+
+def max_block_count(config):
+    '''Return the number of blocks to export at most according to the
+    `maxBlockNum` setting of the BlockSci parser, or None.
+
+    A negative `maxBlockNum` is a confirmation depth relative to the tip of
+    the node, which the parser already applies; a positive one limits the
+    chain to that many blocks.
+
+    >>> max_block_count({'parser': {'maxBlockNum': 700000}})
+    700000
+
+    >>> max_block_count({'parser': {'maxBlockNum': -6}}) is None
+    True
+    '''
+
+    max_block_num = config.get('parser', {}).get('maxBlockNum', 0)
+    return max_block_num if max_block_num > 0 else None
+
+
+def select_block_range(args, chain, start_index, max_blocks=None):
+    '''Return the blocks from start_index up to --end-index, the
+    `maxBlockNum` limit and, with --previous-day, the last block of the
+    previous day; None if there are none.'''
+
+    # handle negative end index
+    if args.end_index < 0:
+        end_index = len(chain) + args.end_index + 1
+    else:
+        end_index = args.end_index + 1
+    if max_blocks is not None:
+        end_index = min(end_index, max_blocks)
+    if start_index >= end_index:
+        return None
+    block_range = chain[start_index:end_index]
+
+    if args.prev_day:
+        tstamp_today = time.mktime(dt.today().date().timetuple())
+        block_tstamps = block_range.time.astype(dt)/1e9
+        v = np.where(block_tstamps < tstamp_today)[0]
+        if not len(v):
+            return None
+        last_index = np.max(v)
+        last_height = block_range[last_index].height
+        if last_height != block_range[-1].height:
+            print('Discarding blocks %d ... %d' %
+                  (last_height + 1, block_range[-1].height))
+            block_range = chain[start_index:(last_height + 1)]
+
+    return block_range
+
+
+def remaining_intervals(args, ledger, stage, block_index_range):
+    '''Return the block intervals of a stage not yet exported according to
+    the ledger when resuming with --continue, else the whole range.'''
+    if args.ignore_ledger or not args.continue_ingest:
+        return [block_index_range]
+    remaining = ledger.remaining(stage, block_index_range)
+    skipped = subtract_intervals(block_index_range, remaining)
+    if skipped:
+        print(f'Skipping {stage} blocks recorded as exported: ' +
+              ', '.join(f'[{start:,.0f}, {end:,.0f})'
+                        for (start, end) in skipped) +
+              ' (use --ignore-ledger to export them again)')
+    return remaining
+
+
+def export_block_range(args, chain, block_range, tables, pool, ledger):
+    '''Export all selected tables for a block range with the workers of
+    pool.'''
+
+    deferred_coinjoin = args.coinjoin == 'deferred'
+
+    num_blocks = len(block_range)
+    block_index_range = (block_range[0].height, block_range[-1].height + 1)
+    tx_index_range = (block_range[0].txes[0].index,
+                      block_range[-1].txes[-1].index + 1)
+    num_tx = tx_index_range[1] - tx_index_range[0] + 1
+
+    # transactions, lookup table, block transactions and the address index
+    # in a single pass
+    tx_pass = 'tx' in tables or 'address_tx' in tables
+    if tx_pass:
+
+        print('Transactions ({:,.0f} tx)'.format(num_tx))
+        print('{:,.0f} <= tx id < {:,.0f}'.format(*tx_index_range))
+        stages = tuple(x for x in ('tx', 'block_tx', 'address_tx')
+                       if x in tables)
+        block_intervals = merge_intervals(
+            [x for stage in stages
+             for x in remaining_intervals(args, ledger, stage,
+                                          block_index_range)])
+        if block_intervals:
+            with METRICS.timed_stage(stages[0]):
+                qm = TxQueryManager(
+                    pool=pool,
+                    txs='tx' in tables,
+                    block_txs='block_tx' in tables,
+                    address_txs='address_tx' in tables,
+                    stages=stages,
+                    checkpoint_interval=args.checkpoint_interval,
+                    cache_size=args.cache_size,
+                    deferred_coinjoin=deferred_coinjoin,
+                    compact_tx_io=args.tx_io_encoding == 'compact',
+                    **partitioning(args))
+                qm.execute(TxQueryManager.insert,
+                           tx_work_units(chain, block_intervals,
+                                         args.num_chunks))
+        for stage in stages:
+            ledger.complete(stage, block_index_range)
+
+    # coinjoin heuristic for candidate txs, in a separate pass
+    if 'tx' in tables and deferred_coinjoin:
+        print('Coinjoin heuristic ({:,.0f} blocks)'.format(num_blocks))
+        block_intervals = remaining_intervals(args, ledger, 'coinjoin',
+                                              block_index_range)
+        if block_intervals:
+            with METRICS.timed_stage('coinjoin'):
+                qm = CoinjoinQueryManager(
+                    pool=pool,
+                    checkpoint_interval=args.checkpoint_interval,
+                    **partitioning(args))
+                qm.execute(CoinjoinQueryManager.insert,
+                           schedule_work_units(chain, block_intervals,
+                                               args.num_chunks))
+        ledger.complete('coinjoin', block_index_range)
+
+    # block transactions
+    if 'block_tx' in tables and not tx_pass:
+        print('Block transactions ({:,.0f} blocks)'.format(num_blocks))
+        print('{:,.0f} <= block index < {:,.0f}'.format(*block_index_range))
+        block_intervals = remaining_intervals(args, ledger, 'block_tx',
+                                              block_index_range)
+        if block_intervals:
+            with METRICS.timed_stage('block_tx'):
+                qm = BlockTxQueryManager(
+                    pool=pool,
+                    checkpoint_interval=args.checkpoint_interval,
+                    max_batch_txs=max_batch_txs(args),
+                    **partitioning(args))
+                qm.execute(BlockTxQueryManager.insert,
+                           schedule_work_units(chain, block_intervals,
+                                               args.num_chunks))
+        ledger.complete('block_tx', block_index_range)
+
+    # blocks
+    if 'block' in tables:
+        print('Blocks ({:,.0f} blocks)'.format(num_blocks))
+        print('{:,.0f} <= block index < {:,.0f}'.format(*block_index_range))
+        block_intervals = remaining_intervals(args, ledger, 'block',
+                                              block_index_range)
+        if block_intervals:
+            with METRICS.timed_stage('block'):
+                qm = BlockQueryManager(
+                    pool=pool,
+                    checkpoint_interval=args.checkpoint_interval,
+                    **partitioning(args))
+                qm.execute(BlockQueryManager.insert,
+                           schedule_work_units(chain, block_intervals,
+                                               args.num_chunks))
+        ledger.complete('block', block_index_range)
+
+    # daily and block_id_group statistics
+    if 'aggregates' in tables:
+        print('Aggregate statistics ({:,.0f} blocks)'.format(num_blocks))
+        block_intervals = remaining_intervals(args, ledger, 'aggregates',
+                                              block_index_range)
+        if block_intervals:
+            with METRICS.timed_stage('aggregates'):
+                qm = AggregateQueryManager(pool=pool, **partitioning(args))
+                qm.execute(AggregateQueryManager.insert,
+                           [(start, end, block_index_range[1])
+                            for (start, end) in schedule_work_units(
+                                chain, block_intervals, args.num_chunks)])
+        ledger.complete('aggregates', block_index_range)
+
+    # summary statistics and configuration details
+    with METRICS.timed_stage('stats'):
+        qm = StatsQueryManager(
+            pool=pool,
+            keyspace=args.keyspace,
+            summary_statistics='stats' in tables,
+            bip30_fix='tx' in tables and args.bip30_fix,
+            **partitioning(args))
+        qm.execute(StatsQueryManager.insert, [block_range[-1].height])
+
+
+def data_dir_mtime(data_dir):
+    '''Return the latest modification time of the BlockSci chain files.'''
+    chain_dir = os.path.join(data_dir, 'chain')
+    if not os.path.isdir(chain_dir):
+        chain_dir = data_dir
+    with os.scandir(chain_dir) as entries:
+        return max((x.stat().st_mtime for x in entries if x.is_file()),
+                   default=0)
+
+
+def reload_chain(chain, config_file):
+    '''Make newly parsed blocks visible.'''
+    if hasattr(chain, 'reload'):
+        chain.reload()
+        return chain
+    return blocksci.Blockchain(config_file)
+
+
+def follow(args, config, chain, next_block, max_blocks, tables, sink, pool,
+           ledger):
+    '''Export newly parsed blocks until SIGINT or SIGTERM is received.
+
+    The chain, the worker pool, the Cassandra session of this process and
+    the caches are kept across updates; updates of up to FOLLOW_INLINE_TXS
+    txs are exported in this process, skipping the round trip to the
+    workers.
+    '''
+
+    inline_pool = WorkerPool(lambda: sink, chain, 0, args.batch_size,
+                             args.blocksci_config, pool.profiler)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    data_dir = config['chainConfig']['dataDirectory']
+    mtime = data_dir_mtime(data_dir)
+    print(f'Following {data_dir} (polling every {args.poll_interval}s)')
+
+    while not stop.wait(args.poll_interval):
+        current_mtime = data_dir_mtime(data_dir)
+        if current_mtime != mtime:
+            mtime = current_mtime
+            chain = reload_chain(chain, args.blocksci_config)
+            pool.reload(chain)
+            inline_pool.reload(chain)
+        if next_block >= len(chain):
+            continue
+        # the range also grows without new blocks once --previous-day
+        # moves on to the next day
+        block_range = select_block_range(args, chain, next_block, max_blocks)
+        if block_range is None:
+            continue
+
+        num_txs = (block_range[-1].txes[-1].index + 1 -
+                   block_range[0].txes[0].index)
+        print(f'{dt.now():%F %T} new blocks {next_block:,.0f} ... '
+              f'{block_range[-1].height:,.0f} ({num_txs:,.0f} tx)')
+        export_block_range(args, chain, block_range, tables,
+                           inline_pool if num_txs <= FOLLOW_INLINE_TXS
+                           else pool, ledger)
+        next_block = block_range[-1].height + 1
 
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
 
+    METRICS.file_name = args.metrics_file
+    METRICS.const_labels = (('keyspace', args.keyspace),)
+
+    if args.replay_failures:
+        cluster = connect_cluster(args.db_nodes, args.db_port)
+        sink = CassandraSink(cluster, args.keyspace, args.concurrency,
+                             args.journal_dir, args.max_retries,
+                             max_concurrency=args.max_concurrency,
+                             latency_target=args.latency_target,
+                             max_in_flight_bytes=args.memory_budget * 2**20,
+                             max_mutation_bytes=args.max_mutation_bytes)
+        with METRICS.timed_stage('replay'):
+            replay_failures(sink, args.journal_dir)
+            sink.close()
+        cluster.shutdown()
+        raise SystemExit(0)
+
     chain = blocksci.Blockchain(args.blocksci_config)
 
     last_parsed_block = chain[-1]
@@ -485,10 +3252,89 @@ def main():
           (last_parsed_block.height,
            dt.strftime(last_parsed_block.time, '%F %T')))
 
-    cluster = Cluster(args.db_nodes, port=args.db_port)
+    if args.sink != 'cassandra' and not args.output_dir:
+        print('Error: --output-dir argument is required for file sinks')
+        raise SystemExit(1)
+
+    if args.sink == 'parquet':
+        sink_factory = partial(ParquetSink, args.output_dir,
+                               max_buffer_bytes=args.memory_budget * 2**20,
+                               compact_tx_io=args.tx_io_encoding == 'compact')
+    elif args.sink == 'csv':
+        sink_factory = partial(CsvSink, args.output_dir,
+                               max_buffer_bytes=args.memory_budget * 2**20)
+    else:
+        if args.write_mode == 'batches':
+            max_batch_bytes = args.max_batch_bytes
+        else:
+            max_batch_bytes = None
+        sink_factory = partial(CassandraSink.connect,
+                               partial(connect_cluster, args.db_nodes,
+                                       args.db_port),
+                               args.keyspace, args.concurrency,
+                               args.journal_dir, args.max_retries,
+                               max_batch_bytes, args.max_concurrency,
+                               args.latency_target,
+                               args.memory_budget * 2**20,
+                               args.max_mutation_bytes)
+    sink = sink_factory()
+    ledger = sink.ledger()
+
+    tx_io_encoding = sink.tx_io_encoding()
+    if args.tx_io_encoding is None:
+        args.tx_io_encoding = tx_io_encoding or 'udt'
+    elif tx_io_encoding not in (None, args.tx_io_encoding):
+        print(f'Error: the transaction table of keyspace {args.keyspace} '
+              f'requires --tx-io-encoding {tx_io_encoding}')
+        raise SystemExit(1)
+
+    # added after the other partitioning parameters
+    if not sink.has_column('configuration', 'address_prefix_length'):
+        print(f'Error: table configuration in keyspace {args.keyspace} has '
+              f'no column address_prefix_length; add it with "ALTER TABLE '
+              f'configuration ADD address_prefix_length int"')
+        raise SystemExit(1)
+
+    conflicts = resolve_partitioning(args, sink.configuration(args.keyspace))
+    if conflicts:
+        names = ', '.join('--' + x.replace('_', '-') for x in conflicts)
+        print(f'Error: {names} differs from the value recorded for keyspace '
+              f'{args.keyspace} in table configuration')
+        raise SystemExit(1)
+
+    if min(args.block_bucket_size, args.tx_bucket_size,
+           args.tx_prefix_length, args.address_prefix_length) < 1 or \
+            max(args.tx_prefix_length, args.address_prefix_length) > 64:
+        print('Error: bucket sizes must be strictly positive and the tx '
+              'and address prefix lengths between 1 and 64.')
+        raise SystemExit(1)
+
+    tables = check_tables_arg(args.tables)
+    for (name, table) in (('address_tx', 'address_transactions'),
+                          ('aggregates', 'daily_statistics'),
+                          ('aggregates', 'block_group_statistics')):
+        if name in tables and not sink.has_table(table):
+            print(f'Error: table {table} does not exist in keyspace '
+                  f'{args.keyspace}; create it as in schema.cql')
+            raise SystemExit(1)
+    deferred_coinjoin = args.coinjoin == 'deferred'
+
     if args.continue_ingest:
-        # get most recent block from database
-        most_recent_block = query_most_recent_block(cluster, args.keyspace)
+        # get next block from the progress ledger, falling back to the most
+        # recent block in the database
+        stages = [x for x in tables if x != 'stats']
+        if 'tx' in tables and deferred_coinjoin:
+            stages.append('coinjoin')
+        frontiers = [ledger.load(stage)[0] for stage in stages]
+        if frontiers and None not in frontiers:
+            most_recent_block = min(frontiers) - 1
+            if most_recent_block < 0:
+                most_recent_block = None
+        elif args.sink == 'cassandra':
+            most_recent_block = query_most_recent_block(sink.cluster,
+                                                        args.keyspace)
+        else:
+            most_recent_block = None
         if most_recent_block is not None and \
            most_recent_block > last_parsed_block.height:
             print('Error: inconsistent number of parsed and ingested blocks')
@@ -504,28 +3350,26 @@ def main():
                    dt.strftime(last_ingested_block.time, '%F %T')))
         args.start_index = next_block
     print('-' * 58)
-    cluster.shutdown()
 
     if args.info:
+        sink.close()
         raise SystemExit(0)
 
-    # handle negative end index
-    if args.end_index < 0:
-        end_index = len(chain) + args.end_index + 1
-    else:
-        end_index = args.end_index + 1
-    block_range = chain[args.start_index:end_index]
+    if args.follow and args.end_index >= 0:
+        print('Error: --follow requires a negative --end-index argument')
+        raise SystemExit(1)
 
-    if args.start_index >= len(chain) and args.continue_ingest:
+    if args.start_index >= len(chain) and args.continue_ingest and \
+       not args.follow:
         print('No blocks/transactions to ingest')
         raise SystemExit(0)
 
-    if args.start_index >= len(chain):
+    if args.start_index >= len(chain) and not args.continue_ingest:
         print('Error: --start_index argument must be smaller than %d' %
               len(chain))
         raise SystemExit(1)
 
-    if args.start_index >= end_index:
+    if args.end_index >= 0 and args.start_index > args.end_index:
         print('Error: --start_index argument must be smaller than '
               '--end_index argument')
         raise SystemExit(1)
@@ -534,110 +3378,91 @@ def main():
         print('Error: --concurrency argument must be strictly positive.')
         raise SystemExit(1)
 
-    if not args.num_chunks:
-        args.num_chunks = args.num_proc
+    if args.max_concurrency is not None and \
+       args.max_concurrency < args.concurrency:
+        print('Error: --max-concurrency argument must not be smaller than '
+              '--concurrency.')
+        raise SystemExit(1)
 
-    if args.prev_day:
-        tstamp_today = time.mktime(dt.today().date().timetuple())
-        block_tstamps = block_range.time.astype(dt)/1e9
-        v = np.where(block_tstamps < tstamp_today)[0]
-        if len(v):
-            last_index = np.max(v)
-            last_height = block_range[last_index].height
-            if last_height != chain[args.end_index].height:
-                print('Discarding blocks %d ... %d' %
-                      (last_height + 1, chain[args.end_index].height))
-                block_range = chain[args.start_index:(last_height + 1)]
-        else:
-            print('No blocks to ingest.')
-            raise SystemExit
+    if args.latency_target <= 0:
+        print('Error: --latency-target argument must be strictly positive.')
+        raise SystemExit(1)
 
-    num_blocks = len(block_range)
-    block_index_range = (block_range[0].height, block_range[-1].height + 1)
-    tx_index_range = (block_range[0].txes[0].index,
-                      block_range[-1].txes[-1].index + 1)
-    num_tx = tx_index_range[1] - tx_index_range[0] + 1
+    if args.memory_budget < 1 or args.max_mutation_bytes < 1:
+        print('Error: --memory-budget and --max-mutation-bytes arguments '
+              'must be strictly positive.')
+        raise SystemExit(1)
 
-    tables = check_tables_arg(args.tables)
-    print('-' * 58)
+    if args.batch_size < 1:
+        print('Error: --batch-size argument must be strictly positive.')
+        raise SystemExit(1)
 
-    cluster = Cluster(args.db_nodes, port=args.db_port)
+    if args.max_batch_bytes < 1:
+        print('Error: --max-batch-bytes argument must be strictly positive.')
+        raise SystemExit(1)
 
-    # transactions
-    if 'tx' in tables:
+    if args.checkpoint_interval < 1:
+        print('Error: --checkpoint-interval argument must be strictly '
+              'positive.')
+        raise SystemExit(1)
 
-        print('Transactions ({:,.0f} tx)'.format(num_tx))
-        print('{:,.0f} <= tx id < {:,.0f}'.format(*tx_index_range))
-        cql_str = '''INSERT INTO transaction
-                     (tx_id_group, tx_id, tx_hash, block_id,
-                      timestamp, coinbase, total_input, total_output,
-                      inputs, outputs, coinjoin)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        qm = TxQueryManager(cluster, args.keyspace, chain, cql_str,
-                            args.num_proc, args.num_chunks, args.concurrency)
-        qm.execute(TxQueryManager.insert, tx_index_range)
-        qm.close_pool()
-
-        print('Transactions by tx_hash lookup table')
-        cql_str = '''INSERT INTO transaction_by_tx_prefix
-                     (tx_prefix, tx_hash, tx_id)
-                     VALUES (?, ?, ?)'''
-        qm = TxLookupQueryManager(cluster, args.keyspace, chain, cql_str,
-                                  args.num_proc, args.num_chunks,
-                                  args.concurrency)
-        qm.execute(TxLookupQueryManager.insert_lookup_table, tx_index_range)
-        qm.close_pool()
+    if args.profile_interval <= 0:
+        print('Error: --profile-interval argument must be strictly '
+              'positive.')
+        raise SystemExit(1)
 
-    # block transactions
-    if 'block_tx' in tables:
-        print('Block transactions ({:,.0f} blocks)'.format(num_blocks))
-        print('{:,.0f} <= block index < {:,.0f}'.format(*block_index_range))
-        cql_str = '''INSERT INTO block_transactions
-                     (block_id_group, block_id, txs) VALUES (?, ?, ?)'''
-        qm = BlockTxQueryManager(cluster, args.keyspace, chain, cql_str,
-                                 args.num_proc, args.num_chunks,
-                                 args.concurrency)
-        qm.execute(BlockTxQueryManager.insert, block_index_range)
-        qm.close_pool()
+    if not args.num_chunks:
+        args.num_chunks = 8 * args.num_proc
 
-    # blocks
-    if 'block' in tables:
-        print('Blocks ({:,.0f} blocks)'.format(num_blocks))
-        print('{:,.0f} <= block index < {:,.0f}'.format(*block_index_range))
-        cql_str = '''INSERT INTO block
-                     (block_id_group, block_id, block_hash,
-                      timestamp, no_transactions)
-                     VALUES (?, ?, ?, ?, ?)'''
-        generator = (block_summary(x, int(BLOCK_BUCKET_SIZE))
-                     for x in block_range)
-        insert(cluster, args.keyspace, cql_str, generator, args.concurrency)
-
-    # summary statistics
-    if 'stats' in tables:
-        insert_summary_stats(cluster,
-                             args.keyspace,
-                             chain[block_range[-1].height])
-
-    # configuration details
-    session = cluster.connect(args.keyspace)
-    cql_str = '''INSERT INTO configuration
-                 (id, block_bucket_size, tx_prefix_length, tx_bucket_size)
-                 VALUES (%s, %s, %s, %s)'''
-    session.execute(cql_str,
-                    (args.keyspace,
-                     int(BLOCK_BUCKET_SIZE),
-                     int(TX_HASH_PREFIX_LENGTH),
-                     int(TX_BUCKET_SIZE)))
-
-    if 'tx' in tables and args.bip30_fix:  # handle BTC duplicate tx_hash issue
-        print("Applying fix for BIP30 (duplicate tx hashes)")
-        session = cluster.connect(args.keyspace)
-        cql_str = '''INSERT INTO transaction_by_tx_prefix
-                     (tx_prefix, tx_hash, tx_id) VALUES (?, ?, ?)'''
-        prep_stmt = session.prepare(cql_str)
-        upsert_btc_duplicate_hashes(session, prep_stmt)
-
-    cluster.shutdown()
+    config = chain_config(args.blocksci_config)
+    max_blocks = max_block_count(config)
+
+    if (args.verify or args.repair) and args.sink != 'cassandra':
+        print('Error: --verify and --repair require the Cassandra sink')
+        raise SystemExit(1)
+
+    block_range = select_block_range(args, chain, args.start_index,
+                                     max_blocks)
+    if block_range is None and not args.follow:
+        print('No blocks to verify.' if args.verify or args.repair
+              else 'No blocks to ingest.')
+        raise SystemExit
+
+    # workers are set up once and run the work units of all stages
+    profiler = None
+    if args.profile_dir:
+        profiler = Profiler(args.profile_dir, args.profile_mode,
+                            args.profile_blocks, args.profile_interval)
+    pool = WorkerPool(sink_factory, chain, args.num_proc, args.batch_size,
+                      args.blocksci_config, profiler)
+
+    if args.verify or args.repair:
+        divergent = verify_buckets(args, chain, block_range, tables, pool)
+        if args.repair and divergent:
+            repair_buckets(args, chain, divergent, sink, pool)
+        pool.close()
+        sink.close()
+        raise SystemExit(1 if divergent and not args.repair else 0)
+
+    if block_range is not None:
+        export_block_range(args, chain, block_range, tables, pool, ledger)
+        next_block = block_range[-1].height + 1
+    else:
+        next_block = args.start_index
+
+    if args.follow:
+        follow(args, config, chain, next_block, max_blocks, tables, sink,
+               pool, ledger)
+
+    pool.close()
+    sink.close()
+
+    print('Throughput per stage and table:')
+    METRICS.print_rates()
+
+    if FailureJournal.files(args.journal_dir):
+        print(f'Warning: some rows could not be written, see '
+              f'{args.journal_dir}; re-ingest them with --replay-failures')
 
 
 if __name__ == '__main__':
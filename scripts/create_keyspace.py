@@ -3,11 +3,59 @@
 '''Script to setup GraphSense raw keyspace.'''
 
 from argparse import ArgumentParser
+import subprocess
+
 from cassandra.cluster import Cluster
 
 DEFAULT_TIMEOUT = 60
 KEYSPACE_PLACEHOLDER = 'graphsense'
 
+# bucketed tables the export appends to; all other tables are small
+PROFILE_TABLES = ('block', 'transaction', 'transaction_by_tx_prefix',
+                  'block_transactions', 'address_transactions')
+
+# table options of PROFILE_TABLES
+TABLE_PROFILES = {
+    # initial load: size-tiered compaction merges fewer, larger SSTables,
+    # large compression chunks, and no caches churned by writes
+    'write': {
+        'compaction': {'class': 'SizeTieredCompactionStrategy',
+                       'min_threshold': '8', 'max_threshold': '32'},
+        'compression': {'class': 'LZ4Compressor',
+                        'chunk_length_in_kb': '64'},
+        'caching': {'keys': 'NONE', 'rows_per_partition': 'NONE'},
+        'bloom_filter_fp_chance': 0.01
+    },
+    # lookups after the load: leveled compaction reads a partition from few
+    # SSTables, small compression chunks decompress less per read
+    'read': {
+        'compaction': {'class': 'LeveledCompactionStrategy',
+                       'sstable_size_in_mb': '160'},
+        'compression': {'class': 'LZ4Compressor',
+                        'chunk_length_in_kb': '16'},
+        'caching': {'keys': 'ALL', 'rows_per_partition': 'NONE'},
+        'bloom_filter_fp_chance': 0.01
+    }
+}
+
+
+def cql_options(options):
+    '''Format table options as the WITH clause of a CQL statement.
+
+    >>> print(cql_options({'caching': {'keys': 'ALL'},
+    ...                    'bloom_filter_fp_chance': 0.01}))
+    caching = {'keys': 'ALL'} AND bloom_filter_fp_chance = 0.01
+    '''
+
+    def value(x):
+        if isinstance(x, dict):
+            return '{' + ', '.join(f"'{k}': '{v}'" for (k, v) in x.items()) \
+                + '}'
+        return str(x)
+
+    return ' AND '.join(f'{name} = {value(x)}'
+                        for (name, x) in options.items())
+
 
 class StorageError(Exception):
     '''Class for Cassandra-related errors'''
@@ -52,8 +100,9 @@ class Cassandra:
         except Exception as e:
             raise StorageError(f'Error when executing query:\n{query}', e)
 
-    def setup_keyspace(self, keyspace, schema_file):
-        '''Setup keyspace and tables.'''
+    def setup_keyspace(self, keyspace, schema_file, profile=None):
+        '''Setup keyspace and tables, optionally with the table options of a
+        profile in TABLE_PROFILES.'''
         if not self.session:
             raise StorageError('Session not available, call connect() first')
 
@@ -69,32 +118,147 @@ class Cassandra:
             if len(stmt) > 0:
                 self.session.execute(stmt + ';')
 
+        if profile is not None:
+            self.apply_profile(keyspace, profile)
+
+    def tables(self, keyspace):
+        '''Return the names of the tables of a keyspace.'''
+        query = 'SELECT table_name FROM system_schema.tables ' \
+                'WHERE keyspace_name=%s'
+        try:
+            result = self.session.execute(query, [keyspace])
+            return [row.table_name for row in result]
+        except Exception as e:
+            raise StorageError(f'Error when executing query:\n{query}', e)
+
+    def apply_profile(self, keyspace, profile):
+        '''Set the table options of a profile on the PROFILE_TABLES of a
+        keyspace and return the altered tables.'''
+        tables = [x for x in PROFILE_TABLES if x in self.tables(keyspace)]
+        options = cql_options(TABLE_PROFILES[profile])
+        for table in tables:
+            stmt = f'ALTER TABLE {keyspace}.{table} WITH {options};'
+            try:
+                self.session.execute(stmt)
+            except Exception as e:
+                raise StorageError(f'Error when executing query:\n{stmt}', e)
+        return tables
+
+    def unfinished_stages(self, keyspace):
+        '''Return the export stages with work units of an unfinished run in
+        the progress ledger, or None if no run has been recorded.'''
+        if 'export_progress' not in self.tables(keyspace):
+            return None
+        query = f'SELECT table_name, next_block, chunk_start ' \
+                f'FROM {keyspace}.export_progress'
+        try:
+            result = list(self.session.execute(query))
+        except Exception as e:
+            raise StorageError(f'Error when executing query:\n{query}', e)
+        if not any(row.next_block is not None for row in result):
+            return None
+        return sorted({row.table_name for row in result
+                       if row.chunk_start is not None})
+
     def close(self):
         '''Closes the cassandra cluster connection.'''
         self.cluster.shutdown()
 
 
+def maintenance_commands(db_nodes, keyspace, tables):
+    '''Return the nodetool commands rewriting the SSTables of tables with
+    their current options, one per node.
+
+    >>> maintenance_commands(['cassandra1'], 'btc_raw', ['block'])
+    [['nodetool', '-h', 'cassandra1', 'upgradesstables', '-a', 'btc_raw', \
+'block']]
+    '''
+
+    return [['nodetool', '-h', node, 'upgradesstables', '-a', keyspace,
+             *tables] for node in db_nodes]
+
+
+def switch_profile(cassandra, args):
+    '''Switch the tables of an existing keyspace to another profile.'''
+    if not cassandra.has_keyspace(args.keyspace_name):
+        print(f'Error: Keyspace "{args.keyspace_name}" does not exist.')
+        raise SystemExit(1)
+
+    unfinished = cassandra.unfinished_stages(args.keyspace_name)
+    if unfinished is None and not args.force:
+        print('Error: the progress ledger records no completed export; '
+              'use --force to switch anyway')
+        raise SystemExit(1)
+    if unfinished and not args.force:
+        print(f'Error: the export of {", ".join(unfinished)} has not '
+              f'completed; use --force to switch anyway')
+        raise SystemExit(1)
+
+    tables = cassandra.apply_profile(args.keyspace_name, args.profile)
+    print(f'Success: Switched {", ".join(tables)} to profile '
+          f'"{args.profile}".')
+
+    # existing SSTables keep their compression until they are rewritten
+    for cmd in maintenance_commands(args.db_nodes, args.keyspace_name,
+                                    tables):
+        if not args.maintenance:
+            print(f'Run: {" ".join(cmd)}')
+            continue
+        print(f'Running {" ".join(cmd)}')
+        if subprocess.run(cmd).returncode != 0:
+            print(f'Error: maintenance failed on {cmd[2]}')
+            raise SystemExit(1)
+
+
 def main():
     '''Main function.'''
 
     parser = ArgumentParser(description='Create raw keyspace in Cassandra',
                             epilog='GraphSense - http://graphsense.info')
     parser.add_argument('-d', '--db_nodes', dest='db_nodes', nargs='+',
-                        default='localhost', metavar='DB_NODE',
+                        default=['localhost'], metavar='DB_NODE',
                         help='list of Cassandra nodes (default "localhost")')
     parser.add_argument('-k', '--keyspace', dest='keyspace_name',
                         required=True, metavar='KEYSPACE',
                         help='name of GraphSense raw keyspace')
     parser.add_argument('-s', '--schema', dest='schema_template',
-                        required=True, metavar='CQL_SCHEMA',
+                        metavar='CQL_SCHEMA',
                         help='Cassandra schema for GraphSense raw keyspace')
+    parser.add_argument('-p', '--profile', choices=list(TABLE_PROFILES),
+                        help='compaction, compression and caching options '
+                             'of the bucketed tables: "write" for the '
+                             'initial load, "read" once it has completed '
+                             '(default: options of the schema)')
+    parser.add_argument('--switch', action='store_true',
+                        help='switch the tables of an existing keyspace to '
+                             '--profile once the export has completed')
+    parser.add_argument('--force', action='store_true',
+                        help='switch even if the progress ledger does not '
+                             'record a completed export')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='after switching, rewrite the SSTables of the '
+                             'tables on every DB_NODE with nodetool '
+                             'upgradesstables (requires JMX access)')
     args = parser.parse_args()
 
+    if args.switch and args.profile is None:
+        parser.error('--switch requires --profile')
+    if not args.switch and args.schema_template is None:
+        parser.error('--schema is required to create a keyspace')
+
     cassandra = Cassandra(args.db_nodes)
     cassandra.connect()
+    if args.switch:
+        try:
+            switch_profile(cassandra, args)
+        finally:
+            cassandra.close()
+        return
     if not cassandra.has_keyspace(args.keyspace_name):
-        cassandra.setup_keyspace(args.keyspace_name, args.schema_template)
-        print(f'Success: Keyspace "{args.keyspace_name}" created.')
+        cassandra.setup_keyspace(args.keyspace_name, args.schema_template,
+                                 args.profile)
+        profile = f' with profile "{args.profile}"' if args.profile else ''
+        print(f'Success: Keyspace "{args.keyspace_name}"{profile} created.')
     else:
         print(f'Error: Keyspace "{args.keyspace_name}" already exists.')
     cassandra.close()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Export several chains concurrently with blocksci_export.py under a
+global budget of worker processes and in-flight Cassandra requests.
+
+The table stages of each chain are run one after the other as separate
+exports; stages of different chains run at the same time. Every stage
+starts with an equal share of the process budget among the chains that
+still have stages to run, so chains finishing early leave their share to
+the others. The in-flight budget is split per process, bounding the total
+load on the cluster; within their share, exports lower the number of
+in-flight requests on timeouts and high latency. All other arguments are
+passed on to every export.
+'''
+
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import blocksci
+
+
+EXPORT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'blocksci_export.py')
+TABLES = ('tx', 'block_tx', 'address_tx', 'block', 'aggregates', 'stats')
+# set by the orchestrator for each export
+RESERVED_ARGS = ('-c', '--config', '--db-keyspace', '-t', '--tables',
+                 '--processes', '--concurrency', '--max-concurrency',
+                 '--follow', '--failure-journal', '--metrics-file',
+                 '--output-dir', '--profile', '--replay-failures')
+
+
+class ChainExport:
+    '''The remaining stages of a chain and its running export.'''
+
+    def __init__(self, config, keyspace, stages, end_index=None):
+        self.config = config
+        self.keyspace = keyspace
+        self.stages = list(stages)
+        self.end_index = end_index
+        self.process = None
+        self.num_proc = 0
+        self.failed = False
+        self.waiting_since = 0.0
+
+    @property
+    def done(self):
+        return self.failed or (not self.stages and self.process is None)
+
+    def command(self, num_proc, concurrency, args):
+        tables = self.stages[0]
+        cmd = [sys.executable, '-u', EXPORT_SCRIPT,
+               '-c', self.config, '--db-keyspace', self.keyspace,
+               '-t', *tables,
+               '--processes', str(num_proc),
+               '--concurrency', str(concurrency),
+               '--max-concurrency', str(concurrency),
+               '--failure-journal',
+               os.path.join(args.journal_dir, self.keyspace)]
+        if self.end_index is not None:
+            cmd += ['--end-index', str(self.end_index)]
+        if args.output_dir:
+            cmd += ['--output-dir',
+                    os.path.join(args.output_dir, self.keyspace)]
+        if args.profile_dir:
+            cmd += ['--profile',
+                    os.path.join(args.profile_dir, self.keyspace)]
+        if args.metrics_dir:
+            cmd += ['--metrics-file',
+                    os.path.join(args.metrics_dir,
+                                 f'{self.keyspace}_{"_".join(tables)}.prom')]
+        return cmd + args.export_args
+
+    def start(self, num_proc, concurrency, args):
+        tables = self.stages[0]
+        print(f'Starting {self.keyspace} {",".join(tables)} with '
+              f'{num_proc} processes', flush=True)
+        self.process = subprocess.Popen(
+            self.command(num_proc, concurrency, args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        self.num_proc = num_proc
+        prefix = f'[{self.keyspace} {",".join(tables)}] '
+        threading.Thread(target=forward_output,
+                         args=(self.process.stdout, prefix),
+                         daemon=True).start()
+
+    def poll(self):
+        '''Release the processes of a finished export; return True if one
+        has finished.'''
+        if self.process is None or self.process.poll() is None:
+            return False
+        tables = self.stages.pop(0)
+        if self.process.returncode != 0:
+            print(f'Error: export of {self.keyspace} {",".join(tables)} '
+                  f'failed with exit code {self.process.returncode}; '
+                  f'skipping its remaining stages', flush=True)
+            self.failed = True
+        self.process = None
+        self.num_proc = 0
+        self.waiting_since = time.monotonic()
+        return True
+
+
+def forward_output(stream, prefix):
+    for line in stream:
+        print(prefix + line, end='', flush=True)
+
+
+def fair_share(num_proc, free, num_active):
+    '''Return the number of processes for a starting stage: an equal share
+    of the budget among the active chains, limited to the free processes.
+
+    >>> fair_share(16, 16, 3)
+    5
+    >>> fair_share(16, 2, 3)
+    2
+    >>> fair_share(2, 1, 4)
+    1
+    >>> fair_share(2, 0, 4)
+    0
+    '''
+
+    return min(free, max(1, num_proc // num_active))
+
+
+def parse_stages(stages):
+    '''Return the table lists of comma-separated stage arguments.
+
+    >>> parse_stages(['block', 'tx,block_tx,stats'])
+    [['block'], ['tx', 'block_tx', 'stats']]
+    '''
+
+    result = [x.split(',') for x in stages]
+    for table in (y for x in result for y in x):
+        if table not in TABLES:
+            print(f'Error: unknown table {table}; choose from '
+                  f'{", ".join(TABLES)}')
+            raise SystemExit(1)
+    return result
+
+
+def schedule(chains, args):
+    '''Run the stages of all chains within the process budget.'''
+
+    concurrency = max(1, args.max_in_flight // args.num_proc)
+    while True:
+        for chain in chains:
+            chain.poll()
+        active = [x for x in chains if not x.done]
+        if not active:
+            break
+        free = args.num_proc - sum(x.num_proc for x in active)
+        # chains waiting longest first
+        waiting = sorted((x for x in active if x.process is None),
+                         key=lambda x: x.waiting_since)
+        for chain in waiting:
+            num_proc = fair_share(args.num_proc, free, len(active))
+            if num_proc == 0:
+                break
+            chain.start(num_proc, concurrency, args)
+            free -= num_proc
+        time.sleep(args.poll_interval)
+
+
+def create_parser():
+    parser = ArgumentParser(description='Export several chains '
+                                        'concurrently under a shared budget '
+                                        'of processes and in-flight '
+                                        'requests; other arguments are '
+                                        'passed on to blocksci_export.py',
+                            epilog='GraphSense - http://graphsense.info',
+                            allow_abbrev=False)
+    parser.add_argument('--chain', dest='chains', nargs=2, action='append',
+                        required=True, metavar=('CONFIG', 'KEYSPACE'),
+                        help='BlockSci configuration file and Cassandra '
+                             'keyspace of a chain; repeat for every chain')
+    parser.add_argument('--processes', dest='num_proc', type=int,
+                        default=os.cpu_count(),
+                        help='total number of worker processes of all '
+                             'exports (default: number of CPUs)')
+    parser.add_argument('--max-in-flight', type=int, default=1000,
+                        help='total number of in-flight Cassandra write '
+                             'requests of all exports (default 1000)')
+    parser.add_argument('--stages', nargs='+',
+                        default=['block', 'tx,block_tx,stats'],
+                        metavar='TABLES',
+                        help='comma-separated tables of each stage, run in '
+                             'this order for every chain (default "block" '
+                             '"tx,block_tx,stats")')
+    parser.add_argument('--failure-journal', dest='journal_dir',
+                        default='failed_writes', metavar='DIR',
+                        help='directory for the failure journals, one '
+                             'subdirectory per keyspace (default '
+                             '"failed_writes")')
+    parser.add_argument('--output-dir', metavar='DIR',
+                        help='output directory of file sinks, one '
+                             'subdirectory per keyspace')
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help='write the metrics of each stage to '
+                             'KEYSPACE_TABLES.prom in this directory')
+    parser.add_argument('--profile', dest='profile_dir', metavar='DIR',
+                        help='profile the exports and write their reports '
+                             'to one subdirectory per keyspace')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between checks for finished stages '
+                             '(default 1)')
+    return parser
+
+
+def main():
+    parser = create_parser()
+    (args, args.export_args) = parser.parse_known_args()
+
+    reserved = [x for x in args.export_args
+                if x.split('=')[0] in RESERVED_ARGS]
+    if reserved:
+        print(f'Error: {", ".join(reserved)} cannot be passed on; they are '
+              f'set per chain and stage')
+        raise SystemExit(1)
+
+    if args.num_proc < 1 or args.max_in_flight < 1:
+        print('Error: --processes and --max-in-flight must be strictly '
+              'positive.')
+        raise SystemExit(1)
+
+    if len({x[1] for x in args.chains}) != len(args.chains):
+        print('Error: every chain needs its own keyspace')
+        raise SystemExit(1)
+
+    stages = parse_stages(args.stages)
+    if args.metrics_dir:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+
+    chains = []
+    for (config, keyspace) in args.chains:
+        # all stages of a chain export up to the same block
+        end_index = None
+        if '--end-index' not in (x.split('=')[0] for x in args.export_args):
+            end_index = len(blocksci.Blockchain(config)) - 1
+        chains.append(ChainExport(config, keyspace, stages, end_index))
+
+    start = time.perf_counter()
+    schedule(chains, args)
+    print(f'Exported {len(chains)} chains in '
+          f'{time.perf_counter() - start:.1f} seconds')
+    failed = [x.keyspace for x in chains if x.failed]
+    if failed:
+        print(f'Error: exports failed for {", ".join(failed)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
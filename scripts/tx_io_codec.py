@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Compact binary encoding of transaction inputs and outputs.
+
+Keyspaces created from `schema_compact.cql` store the inputs and outputs of
+a transaction as blobs instead of lists of `tx_input_output` UDTs. A blob
+holds a list of (address, value, address_type) entries, where address is a
+list of address strings or None:
+
+    varint      number of entries
+    per entry:
+      varint    address_type
+      varint    value, zigzag-encoded
+      varint    number of addresses + 1, or 0 if address is None
+      per address:
+        byte    address encoding (BASE58, SEGWIT or TEXT)
+        varint  payload length
+        bytes   payload
+
+BASE58 payloads are base58check-decoded addresses without their checksum
+(version bytes and hash), SEGWIT payloads the witness version, the length
+and characters of the human-readable part and the witness program, and TEXT
+payloads UTF-8 strings for all other address formats. An address is only
+stored as BASE58 or SEGWIT if encoding the payload again results in the
+same string (lowercase bech32 with the checksum variant of its witness
+version, canonical padding), so decoding is lossless.
+
+>>> ios = [(['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'], 5_000_000_000, 3),
+...        (['bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq'], 1_000, 8),
+...        (None, 0, 7)]
+>>> blob = encode_tx_ios(ios)
+>>> len(blob)
+64
+>>> decode_tx_ios(blob) == ios
+True
+'''
+
+from collections import namedtuple
+import hashlib
+
+
+BASE58 = 0
+SEGWIT = 1
+TEXT = 2
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B58_INDEX = {c: i for (i, c) in enumerate(B58_ALPHABET)}
+
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_INDEX = {c: i for (i, c) in enumerate(BECH32_CHARSET)}
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+BECH32_GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd,
+                    0x2a1462b3)
+
+TxIO = namedtuple('TxIO', ('address', 'value', 'address_type'))
+
+
+def write_varint(buffer, value):
+    '''Append an unsigned LEB128 varint to a bytearray.
+
+    >>> buffer = bytearray()
+    >>> write_varint(buffer, 300)
+    >>> buffer.hex()
+    'ac02'
+    '''
+
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, pos):
+    '''Return an unsigned varint read at pos and the position after it.
+
+    >>> read_varint(bytes.fromhex('ac02'), 0)
+    (300, 2)
+    '''
+
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def zigzag(value):
+    '''Map signed to unsigned integers, small magnitudes to small values.
+
+    >>> [zigzag(x) for x in (0, -1, 1, -2)]
+    [0, 1, 2, 3]
+    '''
+
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    '''
+    >>> [unzigzag(x) for x in (0, 1, 2, 3)]
+    [0, -1, 1, -2]
+    '''
+
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def b58check_payload(address):
+    '''Return the payload of a base58check string, or None if the string is
+    not base58check-encoded.
+
+    >>> b58check_payload('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa').hex()
+    '0062e907b15cbf27d5425399ebf6f0fb50ebb88f18'
+    '''
+
+    number = 0
+    for c in address:
+        digit = B58_INDEX.get(c)
+        if digit is None:
+            return None
+        number = number * 58 + digit
+    zeros = len(address) - len(address.lstrip('1'))
+    data = b'\x00' * zeros + number.to_bytes((number.bit_length() + 7) // 8,
+                                             'big')
+    if len(data) < 5:
+        return None
+    (payload, checksum) = (data[:-4], data[-4:])
+    if b58check_checksum(payload) != checksum:
+        return None
+    return payload
+
+
+def b58check_checksum(payload):
+    return hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+
+
+def b58check_encode(payload):
+    '''
+    >>> b58check_encode(bytes.fromhex(
+    ...     '0062e907b15cbf27d5425399ebf6f0fb50ebb88f18'))
+    '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+    '''
+
+    data = payload + b58check_checksum(payload)
+    number = int.from_bytes(data, 'big')
+    chars = []
+    while number:
+        (number, digit) = divmod(number, 58)
+        chars.append(B58_ALPHABET[digit])
+    zeros = len(data) - len(data.lstrip(b'\x00'))
+    return '1' * zeros + ''.join(reversed(chars))
+
+
+def bech32_generator_table():
+    '''Return the XOR of the generator values selected by each value of the
+    top 5 bits of the checksum.'''
+    table = []
+    for top in range(32):
+        value = 0
+        for (i, generator) in enumerate(BECH32_GENERATOR):
+            if (top >> i) & 1:
+                value ^= generator
+        table.append(value)
+    return tuple(table)
+
+
+BECH32_TABLE = bech32_generator_table()
+
+
+def bech32_polymod(values):
+    checksum = 1
+    for value in values:
+        checksum = ((checksum & 0x1ffffff) << 5 ^ value ^
+                    BECH32_TABLE[checksum >> 25])
+    return checksum
+
+
+def bech32_hrp_expand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def convert_bits(data, from_bits, to_bits, pad):
+    '''Regroup a sequence of from_bits-bit values into to_bits-bit values;
+    None if the input is not a valid padded sequence.'''
+
+    acc = 0
+    bits = 0
+    result = []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append((acc >> bits) & max_value)
+    if pad:
+        if bits:
+            result.append((acc << (to_bits - bits)) & max_value)
+    elif bits >= from_bits or (acc << (to_bits - bits)) & max_value:
+        return None
+    return result
+
+
+def segwit_payload(address):
+    '''Return the witness version, human-readable part and witness program
+    of a bech32 or bech32m segwit address, or None.
+
+    >>> segwit_payload('bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq')[:2]
+    (0, 'bc')
+    '''
+
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address):
+        return None
+    hrp = address[:pos]
+    data = [BECH32_INDEX.get(c) for c in address[pos + 1:]]
+    if None in data or not hrp.isascii():
+        return None
+    # segwit version 0 uses bech32, later versions bech32m
+    const = BECH32_CONST if data[0] == 0 else BECH32M_CONST
+    if bech32_polymod(bech32_hrp_expand(hrp) + data) != const:
+        return None
+    program = convert_bits(data[1:-6], 5, 8, False)
+    if not data[1:-6] or program is None:
+        return None
+    return (data[0], hrp, bytes(program))
+
+
+def segwit_encode(version, hrp, program):
+    '''
+    >>> segwit_encode(*segwit_payload(
+    ...     'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq'))
+    'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq'
+    '''
+
+    data = [version] + convert_bits(program, 8, 5, True)
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data +
+                             [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[x] for x in data + checksum)
+
+
+def encode_address(address):
+    '''Return the encoding, payload length and payload of an address.
+
+    >>> encode_address('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')[:2]
+    b'\\x00\\x15'
+    >>> encode_address('qpm2qsznhks23z7629mms6s4cwef74vcwvy22gdx6a')[0] == TEXT
+    True
+    '''
+
+    # decoding base58 is a bijection; segwit_payload() rejects all strings
+    # that would not be encoded again exactly
+    payload = b58check_payload(address)
+    if payload is not None:
+        kind = BASE58
+    else:
+        segwit = segwit_payload(address)
+        if segwit is not None:
+            (version, hrp, program) = segwit
+            kind = SEGWIT
+            payload = (bytes([version, len(hrp)]) + hrp.encode('ascii') +
+                       program)
+        else:
+            kind = TEXT
+            payload = address.encode('utf-8')
+    buffer = bytearray([kind])
+    write_varint(buffer, len(payload))
+    buffer += payload
+    return bytes(buffer)
+
+
+def decode_address(data, pos):
+    '''Return the address encoded at pos and the position after it.'''
+
+    kind = data[pos]
+    (length, pos) = read_varint(data, pos + 1)
+    payload = bytes(data[pos:pos + length])
+    pos += length
+    if kind == BASE58:
+        return (b58check_encode(payload), pos)
+    if kind == SEGWIT:
+        (version, hrp_length) = payload[:2]
+        hrp = payload[2:2 + hrp_length].decode('ascii')
+        return (segwit_encode(version, hrp, payload[2 + hrp_length:]), pos)
+    if kind == TEXT:
+        return (payload.decode('utf-8'), pos)
+    raise ValueError(f'Unknown address encoding {kind}')
+
+
+def encode_tx_ios(ios, encode_address=encode_address):
+    '''Return the blob of a list of (address, value, address_type) entries.
+
+    Pass a cached variant of encode_address to avoid encoding frequently
+    used addresses again.
+    '''
+
+    buffer = bytearray()
+    write_varint(buffer, len(ios))
+    for (addresses, value, address_type) in ios:
+        write_varint(buffer, address_type)
+        write_varint(buffer, zigzag(value))
+        if addresses is None:
+            buffer.append(0)
+            continue
+        write_varint(buffer, len(addresses) + 1)
+        for address in addresses:
+            buffer += encode_address(address)
+    return bytes(buffer)
+
+
+def decode_tx_ios(blob):
+    '''Return the TxIO entries of a blob.
+
+    >>> decode_tx_ios(encode_tx_ios([(['3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+    ...                                '1BoatSLRHtKNngkdXEeobR76b53LETtpyT'],
+    ...                               -1, 6)]))
+    [TxIO(address=['3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy', \
+'1BoatSLRHtKNngkdXEeobR76b53LETtpyT'], value=-1, address_type=6)]
+    '''
+
+    (count, pos) = read_varint(blob, 0)
+    ios = []
+    for _ in range(count):
+        (address_type, pos) = read_varint(blob, pos)
+        (value, pos) = read_varint(blob, pos)
+        (num_addresses, pos) = read_varint(blob, pos)
+        addresses = None
+        if num_addresses:
+            addresses = []
+            for _ in range(num_addresses - 1):
+                (address, pos) = decode_address(blob, pos)
+                addresses.append(address)
+        ios.append(TxIO(addresses, unzigzag(value), address_type))
+    return ios